@@ -1,4 +1,6 @@
 import json
+import asyncio
+import contextlib
 import websockets
 from uuid import UUID
 from http.cookies import SimpleCookie
@@ -89,13 +91,21 @@ class ChatRouter:
 		# establish websocket connection
 		await websocket.accept()
 
+		# the next frame from the frontend, also awaited while an answer is relayed to notice a closed tab
+		receive = None
+
 		try:
 			while True:
 				chat_history = await self.db.get_chat_history(chat_id)
 				for d in chat_history: d.pop("created_at")
 
 				# send the question to chatbot
-				question = await websocket.receive_text()
+				if receive is None: receive = asyncio.create_task(websocket.receive())
+				event = await receive
+				receive = None
+				if event["type"] == "websocket.disconnect": break
+				question = event.get("text")
+
 				async with websockets.connect(self.chatbot_url) as upstream:
 					request = {
 						"action": "generate_answer",
@@ -106,35 +116,54 @@ class ChatRouter:
 					}
 					await upstream.send(json.dumps(request))
 
-					full_response = ""
-
-					# Stream responses back to frontend
-					async for message in upstream:
-						msg = json.loads(message)
-						mtype = msg.get("type")
-
-						if mtype == "stream_chunk":
-							full_response += msg.get("content", "")
-						elif mtype == "stream_complete":
-							await websocket.send_text(full_response)
-							break
-						elif mtype == "error":
-							await websocket.send_text(f"[ERROR] {msg.get('error')}")
-						else:
-							print(f"Unknown message type: {mtype}")
-							break
-
-					# log the message into the database
-					user_id = await self.db.get_chat_owner(chat_id)
-					status = await self.db.log_chat(chat_id, user_id, question)
-					if not status: raise HTTPException(404, "Cannot log message to chat")
-					status = await self.db.log_chat(chat_id, -1, full_response)
-					if not status: raise HTTPException(404, "Cannot log message to chat")
+					# Stream responses back to frontend, unless it goes away first
+					relay = asyncio.create_task(self.relay_answer(websocket, upstream))
+					receive = asyncio.create_task(websocket.receive())
+					await asyncio.wait({relay, receive}, return_when=asyncio.FIRST_COMPLETED)
+
+					if not relay.done() and receive.result()["type"] == "websocket.disconnect":
+						# leaving the block closes upstream, which cancels the generation on the chatbot server
+						relay.cancel()
+						with contextlib.suppress(asyncio.CancelledError): await relay
+						break
+
+					# a new question sent early is kept in receive for the next round
+					full_response = await relay
+
+				# log the message into the database
+				user_id = await self.db.get_chat_owner(chat_id)
+				status = await self.db.log_chat(chat_id, user_id, question)
+				if not status: raise HTTPException(404, "Cannot log message to chat")
+				status = await self.db.log_chat(chat_id, -1, full_response)
+				if not status: raise HTTPException(404, "Cannot log message to chat")
 
 		except:
+			if receive is not None: receive.cancel()
 			await websocket.close()
 
 
+	async def relay_answer(self, websocket: WebSocket, upstream) -> str:
+		""" Collect the streamed answer from the chatbot and send it to the frontend, returns the full answer. """
+		full_response = ""
+
+		async for message in upstream:
+			msg = json.loads(message)
+			mtype = msg.get("type")
+
+			if mtype == "stream_chunk":
+				full_response += msg.get("content", "")
+			elif mtype == "stream_complete":
+				await websocket.send_text(full_response)
+				break
+			elif mtype == "error":
+				await websocket.send_text(f"[ERROR] {msg.get('error')}")
+			else:
+				print(f"Unknown message type: {mtype}")
+				break
+
+		return full_response
+
+
 	async def delete_chat(self, chat_id: str, request: Request, response: Response) -> bool:
 		""" Delete a chat by a specific chat UUID. """
 		# check if the user is logged in 
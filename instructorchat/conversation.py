@@ -1,4 +1,5 @@
 from enum import IntEnum, auto
+from functools import lru_cache
 from typing import List, Tuple, Literal, Optional
 from PIL import Image
 from openai.types.chat import ChatCompletionMessageParam, ChatCompletionContentPartParam
@@ -14,11 +15,17 @@ GPT4O_MINI_MAX_TOKENS = 128000
 ENCODING_NAME = "gpt-4o"
 MAX_TOKEN_RATIO = 0.7
 
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = ENCODING_NAME) -> tiktoken.Encoding:
+    # Building an encoding parses its whole vocabulary, so it is done once per model
+    return tiktoken.encoding_for_model(encoding_name)
+
 def count_tokens_tiktoken(text: str, encoding_name: str = ENCODING_NAME) -> int:
-    encoding = tiktoken.encoding_for_model(encoding_name)
+    encoding = get_encoding(encoding_name)
     return len(encoding.encode(text))
 
 from instructorchat.utils import image_to_base64
+from instructorchat.model.clients import get_async_client
 
 
 Role = Literal["user", "assistant"]
@@ -39,7 +46,11 @@ class Message:
         return self
 
     def add_image(self, image: Image.Image) -> 'Message':
-        self.content.append((ContentType.IMAGE, image_to_base64(image)))
+        return self.add_image_url(f"data:image/jpeg;base64,{image_to_base64(image)}")
+
+    def add_image_url(self, url: str) -> 'Message':
+        """Add an image by URL, e.g. a data URL cached by the page image store."""
+        self.content.append((ContentType.IMAGE, url))
         return self
 
     def to_dict(self):
@@ -60,7 +71,7 @@ class Message:
             else:
                 openai_content.append({
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{content_part[1]}"}
+                    "image_url": {"url": content_part[1]}
                 })
 
         return {
@@ -122,7 +133,7 @@ class Conversation:
             f"Create a concise title for this conversation session. "
             f"User asked: '{user_text}'. Assistant replied: '{assistant_text}'."
         )
-        client = openai.AsyncOpenAI(api_key=api_key)
+        client = get_async_client(api_key)
         response = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
@@ -171,7 +182,7 @@ class Conversation:
             "The summary should be clear and useful for continuing the conversation.\n\n"
             f"Conversation:\n{conversation_text}\n\nSummary:"
         )
-        client = openai.AsyncOpenAI(api_key=api_key)
+        client = get_async_client(api_key)
         response = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
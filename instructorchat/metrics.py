@@ -0,0 +1,129 @@
+"""Process-wide counters and stage latencies, recorded by retrieval and the server alike."""
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Optional
+import math
+import re
+import threading
+import time
+
+# Upper bounds in seconds of the Prometheus histogram buckets, from a cached lookup to a long answer
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Percentiles are of this many most recent observations of a stage
+SAMPLE_WINDOW = 1024
+PERCENTILES = (0.5, 0.95, 0.99)
+
+METRIC_PREFIX = "instructorchat"
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of sorted samples, q between 0 and 1."""
+    if not samples:
+        return None
+    return samples[max(math.ceil(q * len(samples)) - 1, 0)]
+
+
+class Histogram:
+    """Durations of one stage: cumulative bucket counts since start, and the most recent samples."""
+
+    def __init__(self) -> None:
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent: Deque[float] = deque(maxlen=SAMPLE_WINDOW)
+
+    def observe(self, seconds: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def percentiles(self) -> Dict[str, float]:
+        samples = sorted(self.recent)
+        if not samples:
+            return {}
+
+        return {f"p{round(q * 100)}": percentile(samples, q) for q in PERCENTILES}
+
+    def to_dict(self) -> Dict:
+        return {"count": self.count, "sum": self.sum, **self.percentiles()}
+
+
+class Metrics:
+    """Named counters and stage histograms that can be updated from any thread or task."""
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """
+        Time the block as one observation of stage. A block that raises is counted in
+        <stage>.errors instead, and a cancelled one not at all, so that neither skews the latencies.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.incr(f"{stage}.errors")
+            raise
+        self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "stages": {stage: histogram.to_dict() for stage, histogram in self.histograms.items()},
+            }
+
+    def prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                metric = f"{METRIC_PREFIX}_{_metric_name(name)}_total"
+                lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+
+            histograms = sorted(self.histograms.items())
+            stage_seconds = f"{METRIC_PREFIX}_stage_seconds"
+            lines.append(f"# TYPE {stage_seconds} histogram")
+            for stage, histogram in histograms:
+                for bound, count in zip(BUCKETS, histogram.bucket_counts):
+                    lines.append(f'{stage_seconds}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{stage_seconds}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{stage_seconds}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{stage_seconds}_count{{stage="{stage}"}} {histogram.count}')
+
+            recent = f"{METRIC_PREFIX}_stage_recent_seconds"
+            lines.append(f"# TYPE {recent} gauge")
+            for stage, histogram in histograms:
+                for q in PERCENTILES:
+                    value = histogram.percentiles().get(f"p{round(q * 100)}")
+                    if value is not None:
+                        lines.append(f'{recent}{{stage="{stage}",quantile="{q}"}} {value}')
+
+        return "\n".join(lines) + "\n"
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+metrics = Metrics()
+
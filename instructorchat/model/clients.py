@@ -0,0 +1,56 @@
+"""Shared OpenAI clients, so that requests reuse warm HTTP connections instead of opening new ones."""
+from typing import Dict, Optional, Tuple
+import threading
+
+import httpx
+import openai
+
+# Connection pool of each client
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+KEEPALIVE_EXPIRY = 120.0
+
+# Streams can run for minutes, connecting should not
+TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+
+_clients: Dict[Tuple[Optional[str], Optional[str]], openai.AsyncOpenAI] = {}
+_lock = threading.Lock()
+
+
+def get_async_client(api_key: Optional[str] = None, base_url: Optional[str] = None) -> openai.AsyncOpenAI:
+    """
+    Return the long-lived client of an API key and base URL, creating it on first use.
+
+    Args:
+        api_key (str, optional): API key. Defaults to the OPENAI_API_KEY environment variable.
+        base_url (str, optional): OpenAI-compatible endpoint. Defaults to the OpenAI API.
+    """
+    key = (api_key, base_url)
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = openai.AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=openai.DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=MAX_CONNECTIONS,
+                        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=KEEPALIVE_EXPIRY
+                    ),
+                    timeout=TIMEOUT
+                )
+            )
+
+    return client
+
+
+async def close_async_clients() -> None:
+    """Close every shared client, e.g. before the event loop that used them ends."""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+
+    for client in clients:
+        await client.close()
@@ -0,0 +1,216 @@
+"""
+A deterministic stand-in for an OpenAI-compatible chat completions server, to benchmark
+the serve path offline. Answers are made of words picked from a fixed vocabulary by a
+hash of the prompt, streamed after a configurable time to first token at a configurable rate.
+
+Usage:
+python3 -m instructorchat.model.fake_server --port 8800 --tokens-per-second 50 --ttft-ms 300
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+
+# Defaults of the command line, and of the backend the adapter starts for "fake"
+TOKENS_PER_SECOND = 50.0
+TTFT = 0.3
+ANSWER_TOKENS = 200
+
+VOCABULARY = (
+    "the a data model python list function value test mean variance sample loop index array "
+    "class object return print error file read write sort key dictionary string number plot "
+    "probability distribution regression homework exam project lecture example step result"
+).split()
+
+
+def prompt_text(messages: List[Dict]) -> str:
+    """Text of all messages, including the text parts of multi-part ones."""
+    texts = []
+    for message in messages:
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(part.get("text", "") for part in content if part.get("type") == "text")
+
+    return "\n".join(texts)
+
+
+def fake_answer(messages: List[Dict], num_tokens: int) -> List[str]:
+    """The same words for the same prompt, one per token."""
+    seed = int.from_bytes(hashlib.sha256(prompt_text(messages).encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    words = [rng.choice(VOCABULARY) for _ in range(num_tokens)]
+    return [words[0].capitalize()] + [f" {word}" for word in words[1:]]
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    # Keeps connections open between requests, like the hosted API
+    protocol_version = "HTTP/1.1"
+
+    server: "FakeLLMServer"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json({"object": "list", "data": [{"id": "fake", "object": "model", "owned_by": "fake"}]})
+        else:
+            self._send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+            return
+
+        messages = body.get("messages", [])
+        tokens = fake_answer(messages, body.get("max_tokens") or self.server.answer_tokens)
+        usage = {
+            # Roughly four characters a token, tiktoken is not needed for a stand-in
+            "prompt_tokens": len(prompt_text(messages)) // 4,
+            "completion_tokens": len(tokens),
+            "total_tokens": len(prompt_text(messages)) // 4 + len(tokens),
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get("model", "fake")
+
+        if not body.get("stream"):
+            time.sleep(self.server.ttft + len(tokens) / self.server.tokens_per_second)
+            self._send_json({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(delta: Dict, finish_reason: Optional[str] = None) -> Dict:
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+
+        try:
+            # Tokens are due at fixed times from the start, so slow writes do not add up
+            start = time.monotonic()
+            time.sleep(self.server.ttft)
+            self._send_event(chunk({"role": "assistant", "content": ""}))
+
+            for i, token in enumerate(tokens):
+                delay = start + self.server.ttft + i / self.server.tokens_per_second - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self._send_event(chunk({"content": token}))
+
+            self._send_event(chunk({}, "stop"))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._send_event({**chunk({}), "choices": [], "usage": usage})
+            self._send_event("[DONE]")
+            self._write_chunk(b"")
+
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream, e.g. because its request was cancelled
+            self.close_connection = True
+
+    def _send_json(self, payload: Dict, status: int = 200) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_event(self, payload) -> None:
+        data = payload if isinstance(payload, str) else json.dumps(payload)
+        self._write_chunk(f"data: {data}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """
+    The fake server, answering each connection in its own thread.
+
+    Args:
+        host (str): Interface to listen on.
+        port (int): Port to listen on, 0 for any free one.
+        tokens_per_second (float, optional): Streaming rate of answer tokens. Defaults to 50.
+        ttft (float, optional): Seconds before the first token. Defaults to 0.3.
+        answer_tokens (int, optional): Tokens of an answer, unless the request sets max_tokens. Defaults to 200.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        tokens_per_second: float = TOKENS_PER_SECOND,
+        ttft: float = TTFT,
+        answer_tokens: int = ANSWER_TOKENS
+    ) -> None:
+        super().__init__((host, port), FakeLLMHandler)
+        self.tokens_per_second = tokens_per_second
+        self.ttft = ttft
+        self.answer_tokens = answer_tokens
+
+    @property
+    def url(self) -> str:
+        """Base URL to give an OpenAI client."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def start_fake_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    tokens_per_second: float = TOKENS_PER_SECOND,
+    ttft: float = TTFT,
+    answer_tokens: int = ANSWER_TOKENS
+) -> FakeLLMServer:
+    """Start a fake server in a background thread of this process."""
+    server = FakeLLMServer(host, port, tokens_per_second, ttft, answer_tokens)
+    threading.Thread(target=server.serve_forever, name="fake-llm", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--tokens-per-second", type=float, default=TOKENS_PER_SECOND)
+    parser.add_argument("--ttft-ms", type=float, default=TTFT * 1000, help="Time to first token")
+    parser.add_argument("--answer-tokens", type=int, default=ANSWER_TOKENS)
+    args = parser.parse_args()
+
+    server = FakeLLMServer(args.host, args.port, args.tokens_per_second, args.ttft_ms / 1000, args.answer_tokens)
+    print(f"Fake LLM serving on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("exit...")
@@ -1,8 +1,24 @@
-"""Model adapter for GPT-4-mini."""
+"""Model adapter for GPT-4-mini, and the backends that serve its chat completions."""
 import os
-from typing import Optional
+import math
+import logging
+from typing import Dict, List, Optional, Sequence
 import openai
+import trio
 from instructorchat.conversation import Conversation, get_conv_template
+from instructorchat.model.clients import get_async_client
+
+logger = logging.getLogger(__name__)
+
+OPENAI_BACKEND = "openai"
+# Deterministic local stand-in, started in this process on first use
+FAKE_BACKEND = "fake"
+
+# Further backends, as comma separated "name=base_url" or "name=base_url#model"
+BACKENDS_ENV = "LLM_BACKENDS"
+
+# Seconds given to closing the stream of a backend that is given up on
+STREAM_CLOSE_TIMEOUT = 2.0
 
 class BaseModelAdapter:
     """Base model adapter."""
@@ -50,4 +66,166 @@ def get_model_adapter(model_path: str) -> BaseModelAdapter:
 def load_model(model_path: str, api_key: Optional[str] = None):
     """Load a model and its tokenizer."""
     adapter = get_model_adapter(model_path)
-    return adapter.load_model(model_path, api_key)
\ No newline at end of file
+    return adapter.load_model(model_path, api_key)
+
+
+class ModelBackend:
+    """
+    A named endpoint of the OpenAI chat completions API.
+
+    Args:
+        name (str): Name that requests select the backend by.
+        base_url (str, optional): OpenAI-compatible endpoint. Defaults to the OpenAI API.
+        model (str, optional): Model to ask for in place of the requested one, e.g. of a self-hosted server.
+        api_key (str, optional): API key of the endpoint. Defaults to the key of the request.
+    """
+
+    def __init__(self, name: str, base_url: Optional[str] = None, model: Optional[str] = None, api_key: Optional[str] = None):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+
+    def client(self, api_key: Optional[str] = None) -> openai.AsyncOpenAI:
+        return get_async_client(self.api_key or api_key, self.base_url)
+
+    def __repr__(self) -> str:
+        return f"ModelBackend(name={self.name}, base_url={self.base_url}, model={self.model})"
+
+
+_backends: Dict[str, ModelBackend] = {OPENAI_BACKEND: ModelBackend(OPENAI_BACKEND)}
+
+
+def register_backend(name: str, base_url: Optional[str] = None, model: Optional[str] = None, api_key: Optional[str] = None) -> ModelBackend:
+    """
+    Add or replace a named backend. Self-hosted servers rarely check the key, so unless one is
+    given it is read from LLM_BACKEND_<NAME>_API_KEY, falling back to a placeholder.
+    """
+    if api_key is None and base_url is not None:
+        api_key = os.environ.get(f"LLM_BACKEND_{name.upper()}_API_KEY", "EMPTY")
+
+    backend = _backends[name] = ModelBackend(name, base_url, model, api_key)
+    return backend
+
+
+def register_backends(spec: str) -> List[ModelBackend]:
+    """Register the backends of a comma separated list of "name=base_url" or "name=base_url#model"."""
+    backends = []
+    for entry in filter(None, (entry.strip() for entry in spec.split(","))):
+        name, separator, target = entry.partition("=")
+        if not separator or not name or not target:
+            raise ValueError(f"Backend must be given as name=base_url[#model], got: {entry}")
+
+        base_url, _, model = target.partition("#")
+        backends.append(register_backend(name.strip(), base_url.strip(), model.strip() or None))
+
+    return backends
+
+
+def get_backend(name: str) -> ModelBackend:
+    """A registered backend by name, starting the fake server the first time "fake" is asked for."""
+    backend = _backends.get(name)
+    if backend is not None:
+        return backend
+
+    if name != FAKE_BACKEND:
+        raise ValueError(f"Unknown model backend: {name}. Known backends: {', '.join(sorted(_backends))}")
+
+    from instructorchat.model.fake_server import TOKENS_PER_SECOND, TTFT, start_fake_server
+
+    server = start_fake_server(
+        tokens_per_second=float(os.environ.get("FAKE_LLM_TOKENS_PER_SECOND", TOKENS_PER_SECOND)),
+        ttft=float(os.environ.get("FAKE_LLM_TTFT_MS", TTFT * 1000)) / 1000
+    )
+    logger.info(f"Started fake LLM on {server.url}")
+    return register_backend(FAKE_BACKEND, server.url, api_key="fake")
+
+
+def select_backends(name: Optional[str] = None, base_url: Optional[str] = None, fallbacks: Sequence[str] = ()) -> List[ModelBackend]:
+    """
+    The backend a request asked for, followed by the fallbacks to try when it fails.
+
+    Args:
+        name (str, optional): Registered backend. Defaults to "openai".
+        base_url (str, optional): An unregistered OpenAI-compatible endpoint, used instead of name.
+        fallbacks (Sequence[str], optional): Names of the backends to fail over to, in order.
+    """
+    first = ModelBackend(base_url, base_url) if base_url else get_backend(name or OPENAI_BACKEND)
+    return [first] + [get_backend(fallback) for fallback in fallbacks if fallback != first.name]
+
+
+class ModelStream:
+    """
+    A streamed chat completion whose first chunk was already received, which is how a
+    backend is known to be answering. Iterates over all chunks, the first included.
+    """
+
+    def __init__(self, stream, chunks, first_chunk, backend: ModelBackend):
+        self.stream = stream
+        self.backend = backend
+        self._chunks = chunks
+        self._first_chunk = first_chunk
+
+    def __aiter__(self) -> "ModelStream":
+        return self
+
+    async def __anext__(self):
+        if self._first_chunk is not None:
+            chunk, self._first_chunk = self._first_chunk, None
+            return chunk
+        return await self._chunks.__anext__()
+
+    async def close(self) -> None:
+        await self.stream.close()
+
+
+async def open_stream(
+    backends: Sequence[ModelBackend],
+    api_key: Optional[str],
+    first_token_timeout: Optional[float] = None,
+    **params
+) -> ModelStream:
+    """
+    Stream a chat completion from the first backend that starts answering. A backend that
+    fails, or does not send its first chunk within first_token_timeout seconds, is given up
+    on for the next one. The last backend is given all the time it needs.
+
+    Args:
+        backends (Sequence[ModelBackend]): Backends to try, in order.
+        api_key (str, optional): Key for backends without one of their own.
+        first_token_timeout (float, optional): Seconds to wait for a first chunk. Defaults to no limit.
+        **params: Arguments of chat.completions.create besides stream.
+    """
+    for i, backend in enumerate(backends):
+        is_last = i == len(backends) - 1
+        stream = None
+
+        try:
+            with trio.fail_after(first_token_timeout if first_token_timeout and not is_last else math.inf):
+                stream = await backend.client(api_key).chat.completions.create(
+                    **{**params, "model": backend.model or params["model"]},
+                    stream=True
+                )
+                chunks = stream.__aiter__()
+                try:
+                    first_chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    first_chunk = None
+
+            return ModelStream(stream, chunks, first_chunk, backend)
+
+        except (openai.OpenAIError, trio.TooSlowError) as e:
+            if stream is not None:
+                with trio.move_on_after(STREAM_CLOSE_TIMEOUT) as close_scope:
+                    close_scope.shield = True
+                    await stream.close()
+
+            if is_last:
+                raise
+            logger.warning(f"Backend {backend.name} failed ({e!r}), failing over to {backends[i + 1].name}")
+
+    raise ValueError("No model backend to stream from")
+
+
+# Backends configured for the whole process
+register_backends(os.environ.get(BACKENDS_ENV, ""))
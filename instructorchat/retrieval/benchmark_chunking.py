@@ -0,0 +1,138 @@
+"""
+Micro-benchmark for store.clean_text/store.chunk_text over the KnowledgeBase PDFs.
+
+Compares the current single-pass chunker against the previous implementation
+(kept below as a reference) and checks that both produce identical chunks.
+
+Usage:
+python -m instructorchat.retrieval.benchmark_chunking --repeat 5 --scale 10
+"""
+from pathlib import Path
+from typing import Callable, List
+import argparse
+import re
+import time
+
+import pymupdf4llm
+
+from instructorchat.retrieval.store import clean_text, chunk_text
+
+
+def legacy_clean_text(md_text):
+    lines = md_text.splitlines()
+    fixed_lines = []
+    i = 0
+
+    while i < len(lines):
+        current = lines[i].strip()
+
+        if current == "" and i > 0 and i < len(lines) - 1:
+            prev = lines[i - 1].strip()
+            next_ = lines[i + 1].strip()
+
+            if re.search(r'[a-zA-Z]$', prev) and re.match(r'^[a-z]', next_):
+                combined = prev + " " + next_
+                fixed_lines[-1] = combined
+                i += 2
+                continue
+
+        fixed_lines.append(current)
+        i += 1
+
+    return "\n".join(fixed_lines)
+
+
+def legacy_chunk_text(text, min_length=300, max_length=1000):
+    delimiter_pattern = r'(?:\n{2,}|#+\s|(?<=\n)\*\*[^\n]+\*\*(?=\n))'
+    raw_chunks = re.split(delimiter_pattern, text)
+
+    matches = list(re.finditer(delimiter_pattern, text))
+    for i in range(len(matches)):
+        delimiter = text[matches[i].start():matches[i].end()]
+        raw_chunks[i+1] = delimiter + raw_chunks[i+1] if i+1 < len(raw_chunks) else raw_chunks[i+1]
+
+    final_chunks = []
+    buffer = ""
+
+    def split_long_chunk(chunk):
+        sentences = re.split(r'(?<=[.?!])\s+', chunk)
+        chunks = []
+        temp = ""
+        for sentence in sentences:
+            if len(temp) + len(sentence) < max_length:
+                temp += sentence + " "
+            else:
+                if temp.strip():
+                    chunks.append(temp.strip())
+                temp = sentence + " "
+        if temp.strip():
+            chunks.append(temp.strip())
+        return chunks
+
+    for part in raw_chunks:
+        part = part.strip()
+        if not part:
+            continue
+        if len(buffer) + len(part) < min_length:
+            buffer += " " + part
+        else:
+            if buffer:
+                chunk = buffer.strip()
+                if len(chunk) > max_length:
+                    final_chunks.extend(split_long_chunk(chunk))
+                else:
+                    final_chunks.append(chunk)
+                buffer = ""
+            if len(part) > max_length:
+                final_chunks.extend(split_long_chunk(part))
+            else:
+                buffer = part
+
+    if buffer.strip():
+        chunk = buffer.strip()
+        final_chunks.extend(split_long_chunk(chunk) if len(chunk) > max_length else [chunk])
+
+    return final_chunks
+
+
+def run(pages: List[str], clean: Callable, chunk: Callable, repeat: int) -> tuple[float, List[List[str]]]:
+    """Return the best time over repeat runs and the chunks of the last run."""
+    best = float("inf")
+    chunks: List[List[str]] = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = [chunk(clean(page)) for page in pages]
+        best = min(best, time.perf_counter() - start)
+
+    return best, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--kb-dir", type=str, default=str(Path(__file__).parent / "KnowledgeBase"))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=int, default=1, help="Concatenate each page with itself to simulate larger documents")
+    args = parser.parse_args()
+
+    for pdf_path in sorted(Path(args.kb_dir).glob("*.pdf")):
+        md_pages = pymupdf4llm.to_markdown(str(pdf_path), page_chunks=True)
+        pages = ["\n\n".join([p["text"]] * args.scale) for p in md_pages]
+        size_mb = sum(len(page.encode("utf-8")) for page in pages) / 1e6
+
+        legacy_time, legacy_chunks = run(pages, legacy_clean_text, legacy_chunk_text, args.repeat)
+        current_time, current_chunks = run(pages, clean_text, chunk_text, args.repeat)
+
+        identical = legacy_chunks == current_chunks
+        print(f"{pdf_path.name}: {len(pages)} pages, {size_mb:.2f} MB, "
+              f"{sum(len(c) for c in current_chunks)} chunks")
+        print(f"  legacy:  {legacy_time * 1000:.1f} ms ({size_mb / legacy_time:.1f} MB/s)")
+        print(f"  current: {current_time * 1000:.1f} ms ({size_mb / current_time:.1f} MB/s)")
+        print(f"  identical output: {identical}")
+
+        if not identical:
+            raise SystemExit(f"Chunk output differs for {pdf_path.name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+"""
+Chunk-level MongoDB storage.
+
+Every searchable unit (a post, a PDF text chunk, or a PDF page image) is its own
+document in the <collection>_chunks collection, keyed by its chunk id and carrying
+the fields needed to filter and score it: doc_id, folders, file_type, kind,
+content_hash and a binary embedding. Parent documents in <collection> keep the
+file-level fields (filename, metadata, image, aliases) without their chunks.
+
+The same operations are implemented by LocalChunkStore (local_store.py) for
+single-node deployments and offline runs. open_chunk_store picks the backend from
+RAG_STORE_BACKEND ("mongo" or "local").
+
+Usage (migrate a collection stored with nested chunks):
+python -m instructorchat.retrieval.chunk_store ece20875
+"""
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+import abc
+import argparse
+import hashlib
+import os
+import zlib
+
+import certifi
+import torch
+from bson.binary import Binary
+from dotenv import load_dotenv
+from pymongo import ASCENDING, MongoClient, ReplaceOne
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+TEXT_CHUNK = "text"
+PAGE_CHUNK = "page"
+
+MONGO_BACKEND = "mongo"
+LOCAL_BACKEND = "local"
+LOCAL_STORE_DIR = Path(__file__).parent / "KnowledgeBase" / "local_store"
+
+# Chunks fetched per round trip when scanning a folder
+SCAN_BATCH_SIZE = 1000
+
+# Parent fields returned with a search hit
+HIT_DOCUMENT_FIELDS = {"filename": 1, "metadata": 1, "file_type": 1, "image_path": 1, "image_hash": 1}
+
+# Kinds of ChunkChange
+UPSERT = "upsert"
+DELETE = "delete"
+RESET = "reset"
+
+# How long a change stream waits for new events before yielding None
+CHANGE_WAIT_MS = 1000
+
+
+class ChunkChange(NamedTuple):
+    """
+    A change to the chunk collection. Upserts carry the chunk's folders and embedding,
+    deletes only its id, and a reset means every resident copy of the collection is stale.
+    """
+    kind: str
+    chunk_id: Optional[str]
+    folders: List[str]
+    embedding: Optional[torch.Tensor]
+    token: Optional[Dict]
+
+
+class ChangeStreamUnsupported(Exception):
+    """The server cannot stream changes (e.g. a standalone MongoDB), so changes must be polled."""
+
+
+def encode_embedding(embedding: torch.Tensor) -> Tuple[Binary, List[int]]:
+    """Raw bfloat16 bytes of the embedding and its shape."""
+    data = embedding.detach().to(dtype=torch.bfloat16).contiguous().cpu().view(torch.int16).numpy().tobytes()
+    return Binary(data), list(embedding.shape)
+
+
+def decode_embedding(data: bytes, shape: List[int]) -> torch.Tensor:
+    return torch.frombuffer(bytearray(data), dtype=torch.int16).view(torch.bfloat16).reshape(shape)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def page_chunk_id(doc_id: str) -> str:
+    return f"{doc_id}:page"
+
+
+def shard_hash(chunk_id: str) -> int:
+    """CRC32 of the chunk id, stored with the chunk so that a hash shard can scan only its own chunks."""
+    return zlib.crc32(chunk_id.encode("utf-8"))
+
+
+def in_shard(chunk_id: str, shard: Optional[Tuple[int, int]]) -> bool:
+    """Whether the chunk belongs to shard (index, number of shards), always true without a shard."""
+    return shard is None or shard_hash(chunk_id) % shard[1] == shard[0]
+
+
+class ChunkStore(abc.ABC):
+    """Parent documents and their searchable chunks, as used by store.py, search.py and the resident index."""
+
+    name: str
+
+    @abc.abstractmethod
+    def ensure_indexes(self) -> None:
+        """Create whatever the store needs before documents are inserted."""
+
+    @abc.abstractmethod
+    def insert_document(self, document: Dict, chunks: List[Dict]) -> None:
+        """
+        Insert a parent document and its chunks.
+        Each chunk needs chunk_id, chunk_text and an embedding tensor, and may set kind.
+        """
+
+    @abc.abstractmethod
+    def add_aliases(self, doc_id: str, aliases: List[Dict], folders: List[str]) -> None:
+        """Link near-duplicate posts to a stored document, making it visible in their folders too."""
+
+    @abc.abstractmethod
+    def lsh_candidates(self, keys: List[str]) -> Iterator[Dict]:
+        """Yield the _id, minhash and lsh_bands of stored documents sharing any of the LSH keys."""
+
+    @abc.abstractmethod
+    def stored_hashes(self, hashes: Iterable[str]) -> Set[str]:
+        """The given content hashes that already belong to a stored chunk."""
+
+    @abc.abstractmethod
+    def scan(self, folder: str, shard: Optional[Tuple[int, int]] = None) -> Iterator[Tuple[str, torch.Tensor]]:
+        """Yield (chunk id, embedding) for every chunk in the folder, or only those in shard (index, number of shards)."""
+
+    @abc.abstractmethod
+    def lookup(self, chunk_ids: List[str]) -> Dict[str, Dict]:
+        """Map each found chunk id to its chunk_text merged with HIT_DOCUMENT_FIELDS of its parent."""
+
+    @abc.abstractmethod
+    def embeddings(self, chunk_ids: List[str]) -> Iterator[Tuple[str, List[str], torch.Tensor]]:
+        """Yield (chunk id, folders, embedding) for the given chunks."""
+
+    @abc.abstractmethod
+    def memberships(self, folders: List[str]) -> Dict[str, List[str]]:
+        """Folders of every chunk in any of the given folders."""
+
+    @abc.abstractmethod
+    def changes(self, resume_after: Optional[Dict] = None) -> Iterator[Optional[ChunkChange]]:
+        """
+        Yield changes to the chunks after resume_after, or None while there are none.
+
+        Raises:
+            ChangeStreamUnsupported: If changes can only be found by polling memberships.
+        """
+
+
+class MongoChunkStore(ChunkStore):
+    def __init__(self, db: Database, collection_name: str = "ece20875") -> None:
+        self.name = collection_name
+        self.documents = db[collection_name]
+        self.chunks = db[f"{collection_name}_chunks"]
+
+    def ensure_indexes(self) -> None:
+        # _id is the chunk id, so hit lookups use the default _id index
+        self.chunks.create_index([("folders", ASCENDING)])
+        self.chunks.create_index([("doc_id", ASCENDING)])
+        self.chunks.create_index([("content_hash", ASCENDING)])
+        self.documents.create_index([("lsh_bands", ASCENDING)])
+
+    def chunk_record(self, document: Dict, chunk: Dict) -> Dict:
+        embedding, shape = encode_embedding(chunk["embedding"])
+
+        return {
+            "_id": chunk["chunk_id"],
+            "shard_hash": shard_hash(chunk["chunk_id"]),
+            "doc_id": document["_id"],
+            "folders": document["folders"],
+            "file_type": document["file_type"],
+            "kind": chunk.get("kind", TEXT_CHUNK),
+            "chunk_text": chunk["chunk_text"],
+            "content_hash": content_hash(chunk["chunk_text"]),
+            "embedding": embedding,
+            "embedding_shape": shape,
+            "created_at": document["created_at"],
+        }
+
+    def insert_document(self, document: Dict, chunks: List[Dict]) -> None:
+        """
+        Insert a parent document and its chunks.
+        Each chunk needs chunk_id, chunk_text and an embedding tensor, and may set kind.
+        """
+        self.documents.insert_one(document)
+
+        if chunks:
+            self.chunks.insert_many([self.chunk_record(document, chunk) for chunk in chunks], ordered=False)
+
+    def add_aliases(self, doc_id: str, aliases: List[Dict], folders: List[str]) -> None:
+        """Link near-duplicate posts to a stored document, making it visible in their folders too."""
+        self.documents.update_one({"_id": doc_id}, {
+            "$push": {"aliases": {"$each": aliases}},
+            "$addToSet": {"folders": {"$each": folders}}
+        })
+        self.chunks.update_many({"doc_id": doc_id}, {"$addToSet": {"folders": {"$each": folders}}})
+
+    def lsh_candidates(self, keys: List[str]) -> Iterator[Dict]:
+        return self.documents.find({"lsh_bands": {"$in": keys}}, {"minhash": 1, "lsh_bands": 1})
+
+    def scan(self, folder: str, shard: Optional[Tuple[int, int]] = None) -> Iterator[Tuple[str, torch.Tensor]]:
+        """
+        Yield (chunk id, embedding) for every chunk in the folder, fetching only what scoring needs.
+        With a shard (index, number of shards), the server only returns the chunks of that shard.
+        """
+        query: Dict = {"folders": folder}
+        if shard is not None:
+            index, num_shards = shard
+            # Chunks stored before shard_hash was written are filtered here instead
+            query["$or"] = [{"shard_hash": {"$mod": [num_shards, index]}}, {"shard_hash": {"$exists": False}}]
+
+        cursor = self.chunks.find(
+            query,
+            {"embedding": 1, "embedding_shape": 1}
+        ).batch_size(SCAN_BATCH_SIZE)
+
+        for chunk in cursor:
+            if in_shard(chunk["_id"], shard):
+                yield chunk["_id"], decode_embedding(chunk["embedding"], chunk["embedding_shape"])
+
+    def lookup(self, chunk_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Fetch the text and parent fields of the given chunks, two queries in total.
+        Returns a dict from chunk id to the chunk's text merged with HIT_DOCUMENT_FIELDS of its parent.
+        """
+        chunks = {
+            chunk["_id"]: chunk
+            for chunk in self.chunks.find({"_id": {"$in": chunk_ids}}, {"doc_id": 1, "chunk_text": 1})
+        }
+        documents = {
+            document["_id"]: document
+            for document in self.documents.find(
+                {"_id": {"$in": list({chunk["doc_id"] for chunk in chunks.values()})}},
+                HIT_DOCUMENT_FIELDS
+            )
+        }
+
+        hits = {}
+        for chunk_id, chunk in chunks.items():
+            document = documents.get(chunk["doc_id"])
+            if document is not None:
+                hits[chunk_id] = {**document, "chunk_text": chunk["chunk_text"]}
+
+        return hits
+
+    def embeddings(self, chunk_ids: List[str]) -> Iterator[Tuple[str, List[str], torch.Tensor]]:
+        """Yield (chunk id, folders, embedding) for the given chunks."""
+        cursor = self.chunks.find(
+            {"_id": {"$in": chunk_ids}},
+            {"folders": 1, "embedding": 1, "embedding_shape": 1}
+        ).batch_size(SCAN_BATCH_SIZE)
+
+        for chunk in cursor:
+            yield chunk["_id"], chunk["folders"], decode_embedding(chunk["embedding"], chunk["embedding_shape"])
+
+    def memberships(self, folders: List[str]) -> Dict[str, List[str]]:
+        """Folders of every chunk in any of the given folders, without their embeddings."""
+        cursor = self.chunks.find({"folders": {"$in": folders}}, {"folders": 1}).batch_size(SCAN_BATCH_SIZE)
+        return {chunk["_id"]: chunk["folders"] for chunk in cursor}
+
+    def changes(self, resume_after: Optional[Dict] = None) -> Iterator[Optional[ChunkChange]]:
+        """
+        Stream changes to the chunk collection, yielding None whenever no change arrived
+        within CHANGE_WAIT_MS so that the caller can stop.
+
+        Raises:
+            ChangeStreamUnsupported: If the server is not a replica set or sharded cluster.
+        """
+        pipeline = [{"$project": {
+            "operationType": 1,
+            "documentKey": 1,
+            "fullDocument.folders": 1,
+            "fullDocument.embedding": 1,
+            "fullDocument.embedding_shape": 1
+        }}]
+
+        try:
+            stream = self.chunks.watch(
+                pipeline,
+                full_document="updateLookup",
+                resume_after=resume_after,
+                max_await_time_ms=CHANGE_WAIT_MS
+            )
+        except OperationFailure as e:
+            raise ChangeStreamUnsupported(str(e)) from e
+
+        with stream:
+            while stream.alive:
+                change = stream.try_next()
+                if change is None:
+                    yield None
+                    continue
+
+                operation = change["operationType"]
+                token = change["_id"]
+
+                if operation in ("insert", "update", "replace"):
+                    # The projection drops fullDocument._id, the chunk id is taken from the document key
+                    chunk_id = change["documentKey"]["_id"]
+                    chunk = change.get("fullDocument")
+                    if chunk is None:
+                        # Deleted again before the update could be looked up
+                        yield ChunkChange(DELETE, chunk_id, [], None, token)
+                    else:
+                        embedding = decode_embedding(chunk["embedding"], chunk["embedding_shape"])
+                        yield ChunkChange(UPSERT, chunk_id, chunk["folders"], embedding, token)
+                elif operation == "delete":
+                    yield ChunkChange(DELETE, change["documentKey"]["_id"], [], None, token)
+                else:
+                    # drop, rename or invalidate: the stream cannot be resumed past these
+                    yield ChunkChange(RESET, None, [], None, None)
+                    return
+
+    def stored_hashes(self, hashes: Iterable[str]) -> Set[str]:
+        """The given content hashes that already belong to a stored chunk."""
+        cursor = self.chunks.find({"content_hash": {"$in": list(set(hashes))}}, {"content_hash": 1, "_id": 0})
+        return {chunk["content_hash"] for chunk in cursor}
+
+    def migrate_nested(self) -> Tuple[int, int]:
+        """
+        Move chunks stored inside their parent documents (the previous layout) to the chunk
+        collection. Safe to re-run: chunk ids are kept and only parents that still hold
+        chunks are visited.
+
+        Returns:
+            Tuple[int, int]: (parent documents migrated, chunks written)
+        """
+        self.ensure_indexes()
+        migrated, written = 0, 0
+
+        for document in self.documents.find({"chunks": {"$exists": True}}):
+            document.setdefault("created_at", datetime.now(timezone.utc))
+            chunks = [
+                {
+                    "chunk_id": chunk["chunk_id"],
+                    "chunk_text": chunk["chunk_text"],
+                    "embedding": torch.tensor(chunk["embedding"], dtype=torch.bfloat16)
+                }
+                for chunk in document["chunks"] if chunk.get("embedding") is not None
+            ]
+
+            # PDF pages were searchable by the page image embedding stored on the parent
+            if document.get("file_type") == "pdf" and document.get("embedding") is not None:
+                chunks.append({
+                    "chunk_id": page_chunk_id(document["_id"]),
+                    "kind": PAGE_CHUNK,
+                    "chunk_text": "\n\n".join(chunk["chunk_text"] for chunk in document["chunks"]),
+                    "embedding": torch.tensor(document["embedding"], dtype=torch.bfloat16)
+                })
+
+            if chunks:
+                self.chunks.bulk_write([
+                    ReplaceOne({"_id": record["_id"]}, record, upsert=True)
+                    for record in (self.chunk_record(document, chunk) for chunk in chunks)
+                ], ordered=False)
+
+            self.documents.update_one({"_id": document["_id"]}, {"$unset": {"chunks": "", "embedding": ""}})
+            migrated += 1
+            written += len(chunks)
+
+        return migrated, written
+
+
+def open_chunk_store(collection_name: str = "ece20875", backend: Optional[str] = None) -> ChunkStore:
+    """
+    Open the chunk store configured by the environment.
+
+    Args:
+        collection_name (str, optional): Collection to open. Defaults to "ece20875".
+        backend (str, optional): "mongo" (MONGO_URL) or "local" (files under RAG_LOCAL_STORE_DIR).
+            Defaults to RAG_STORE_BACKEND, or "mongo" if it is not set.
+    """
+    load_dotenv()
+    backend = backend or os.environ.get("RAG_STORE_BACKEND", MONGO_BACKEND)
+
+    if backend == MONGO_BACKEND:
+        return connect(collection_name)
+
+    if backend == LOCAL_BACKEND:
+        from instructorchat.retrieval.local_store import LocalChunkStore
+        return LocalChunkStore(os.environ.get("RAG_LOCAL_STORE_DIR", LOCAL_STORE_DIR), collection_name)
+
+    raise ValueError(f"Unknown chunk store backend '{backend}'")
+
+
+def connect(collection_name: str = "ece20875", mongo_url: Optional[str] = None) -> MongoChunkStore:
+    load_dotenv()
+    mongo = MongoClient(
+        mongo_url or os.environ["MONGO_URL"],
+        tls=True,
+        tlsCAFile=certifi.where(),
+        serverSelectionTimeoutMS=5000
+    )
+    return MongoChunkStore(mongo["rag_database"], collection_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("collection", type=str, nargs="?", default="ece20875", help="Collection to migrate")
+    args = parser.parse_args()
+
+    migrated, written = connect(args.collection).migrate_nested()
+    print(f"Migrated {migrated} document(s), wrote {written} chunk(s) to '{args.collection}_chunks'")
@@ -1,14 +1,14 @@
-from typing import List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 import pdf2image
 from pathlib import Path
 from tqdm import tqdm
 from PIL import Image
 import os
+import threading
 import warnings
 
 import torch
-from torch.utils.data import DataLoader
 from transformers.utils.import_utils import is_flash_attn_2_available
 from transformers.utils.quantization_config import BitsAndBytesConfig
 
@@ -22,6 +22,11 @@ from fast_plaid.search.fast_plaid import FastPlaid
 
 from instructorchat.utils import images_to_base64
 
+COLPALI_MODEL_NAME = "vidore/colqwen2.5-v0.2"
+
+# Below this many tokens an input that still runs out of memory is reported instead of truncated further
+MIN_TRUNCATION_TOKENS = 32
+
 
 class ColPali:
     """
@@ -31,9 +36,17 @@ class ColPali:
             If None, no pooling is applied. Defaults to 3.
         device (Union[str, torch.device], optional): Device to run the model on.
             If None, automatically detects the best available device. Defaults to None.
+        quantized (bool, optional): Load the model in 4-bit. Defaults to False.
+        model_name (str, optional): Hugging Face id of the ColQwen2.5 checkpoint.
     """
 
-    def __init__(self, pool_factor: Optional[int] = 3, device: Optional[str] = None, quantized: bool = False):
+    def __init__(
+            self,
+            pool_factor: Optional[int] = 3,
+            device: Optional[str] = None,
+            quantized: bool = False,
+            model_name: str = COLPALI_MODEL_NAME
+        ):
         self.device = torch.device(device) if device is not None else torch.device(get_torch_device())
 
         if quantized:
@@ -45,7 +58,7 @@ class ColPali:
             )
 
             self.model = ColQwen2_5.from_pretrained(
-                "vidore/colqwen2.5-v0.2",
+                model_name,
                 torch_dtype=torch.bfloat16,
                 device_map=self.device,
                 attn_implementation="flash_attention_2" if is_flash_attn_2_available() else None,
@@ -53,96 +66,222 @@ class ColPali:
             ).eval()
         else:
             self.model = ColQwen2_5.from_pretrained(
-                "vidore/colqwen2.5-v0.2",
+                model_name,
                 torch_dtype=torch.bfloat16,
                 device_map=self.device,
                 attn_implementation="flash_attention_2" if is_flash_attn_2_available() else None,
             ).eval()
 
-        self.processor = ColQwen2_5_Processor.from_pretrained("vidore/colqwen2.5-v0.2", use_fast=True)
+        self.processor = ColQwen2_5_Processor.from_pretrained(model_name, use_fast=True)
 
-        self.pooler = HierarchicalTokenPooler() if pool_factor is not None else None
+        self.pooler = HierarchicalTokenPooler()
         self.pool_factor = pool_factor
 
+        # Largest batch size known to fit, lowered whenever a batch runs out of memory
+        self.max_batch_size: Optional[int] = None
+
     def embed_images(
             self,
             images: List[Image.Image],
             context_prompts: Optional[List[str]] = None,
-            batch_size: int = 1
+            batch_size: int = 1,
+            pool_factor: Optional[int] = None,
+            progress: Optional[Callable[[int, int], None]] = None
         ) -> List[torch.Tensor]:
 
-        embeddings: List[torch.Tensor] = []
-
-        dataloader = DataLoader(
-            dataset=range(len(images)),
-            batch_size=batch_size,
-            shuffle=False,
-            collate_fn=lambda x: self.processor.process_images(
-                [images[i] for i in x],
-                [context_prompts[i] for i in x] if context_prompts is not None else None
+        def embed_batch(indices: List[int], max_length: Optional[int]) -> List[torch.Tensor]:
+            batch_doc = self.processor.process_images(
+                [images[i] for i in indices],
+                [context_prompts[i] for i in indices] if context_prompts is not None else None
             )
-        )
 
-        for batch_doc in tqdm(dataloader):
             with torch.inference_mode():
                 batch_doc = {k: v.to(self.device) for k, v in batch_doc.items()}
                 image_embeddings: torch.Tensor = self.model(**batch_doc)
 
-            embeddings.extend(list(torch.unbind(image_embeddings.cpu())))
+            return list(torch.unbind(image_embeddings.cpu()))
 
-        if self.pooler is not None:
-            return self.pooler.pool_embeddings(embeddings, pool_factor=self.pool_factor)
-        else:
-            return embeddings
+        batches = [list(range(i, min(i + batch_size, len(images)))) for i in range(0, len(images), batch_size)]
+
+        embeddings: List[torch.Tensor] = []
 
-    def embed_texts(self, texts: List[str], batch_size: int = 4) -> List[torch.Tensor]:
-        embeddings = []
+        for batch in tqdm(self._cap_batches(batches)):
+            embeddings.extend(self._embed_adaptive(batch, embed_batch))
 
-        dataloader = DataLoader(
-            dataset=texts,
-            batch_size=batch_size,
-            shuffle=False,
-            collate_fn=lambda batch_texts: self.processor(
-                text=batch_texts,
+            if progress is not None:
+                progress(len(embeddings), len(images))
+
+        return self._pool(embeddings, pool_factor)
+
+    def embed_texts(
+            self,
+            texts: List[str],
+            batch_size: int = 4,
+            length_bucketing: bool = False,
+            max_batch_tokens: Optional[int] = None,
+            truncate_on_oom: bool = False,
+            pool_factor: Optional[int] = None,
+            progress: Optional[Callable[[int, int], None]] = None
+        ) -> List[torch.Tensor]:
+        """
+        Embed texts in batches.
+        Args:
+            texts (List[str]): Texts to embed. Exactly one embedding is returned per text, in the same order.
+            batch_size (int, optional): Maximum number of texts per batch. Defaults to 4.
+            length_bucketing (bool, optional): Sort texts by tokenized length before batching so
+                that texts of similar length are padded together. Defaults to False.
+            max_batch_tokens (int, optional): Token budget per batch, counted as padded tokens
+                (batch size * longest text in the batch). Only used with length_bucketing.
+                Defaults to None.
+            truncate_on_oom (bool, optional): If a single text still runs out of memory, retry it
+                with its token count halved instead of raising. Defaults to False.
+            pool_factor (int, optional): Pool factor for this call only. Defaults to the one
+                the model was created with, so shared instances are never mutated.
+            progress (Callable[[int, int], None], optional): Called after every batch with the
+                number of texts embedded so far and the total.
+        """
+        def embed_batch(indices: List[int], max_length: Optional[int]) -> List[torch.Tensor]:
+            batch_inputs = self.processor(
+                text=[texts[i] for i in indices],
                 return_tensors="pt",
                 padding=True,
                 truncation=True,
+                max_length=max_length,
             )
-        )
 
-        for batch_inputs in tqdm(dataloader):
-            try:
-                torch.cuda.reset_peak_memory_stats()
-                with torch.inference_mode():
-                    batch_inputs = {k: v.to(self.device) for k, v in batch_inputs.items()}
-                    text_embeddings = self.model(**batch_inputs)  # shape: [batch, seq_len, dim]
-                    attention_mask = batch_inputs["attention_mask"]  # shape: [batch, seq_len]
+            torch.cuda.reset_peak_memory_stats()
+            with torch.inference_mode():
+                batch_inputs = {k: v.to(self.device) for k, v in batch_inputs.items()}
+                text_embeddings = self.model(**batch_inputs)  # shape: [batch, seq_len, dim]
+                attention_mask = batch_inputs["attention_mask"]  # shape: [batch, seq_len]
+
+            peak = torch.cuda.max_memory_allocated() / 1e6
+            print(f"Peak GPU memory: {peak:.2f} MB")
+
+            # Trim padded tokens per sample
+            trimmed = []
+            for emb, mask in zip(text_embeddings, attention_mask):
+                num_tokens = mask.sum().item()
+                trimmed.append(emb[-num_tokens:].cpu())  # shape: [num_tokens, dim]
+
+            return trimmed
+
+        def text_length(idx: int) -> int:
+            return len(self.processor.tokenizer(texts[idx], truncation=True)["input_ids"])
+
+        if length_bucketing:
+            lengths = [len(ids) for ids in self.processor.tokenizer(texts, truncation=True)["input_ids"]]
+            batches = self._length_buckets(lengths, batch_size, max_batch_tokens)
+        else:
+            batches = [list(range(i, min(i + batch_size, len(texts)))) for i in range(0, len(texts), batch_size)]
+
+        embeddings: List[Optional[torch.Tensor]] = [None] * len(texts)
+        done = 0
 
-                peak = torch.cuda.max_memory_allocated() / 1e6
-                print(f"Peak GPU memory: {peak:.2f} MB")
+        for batch in tqdm(self._cap_batches(batches)):
+            batch_embeddings = self._embed_adaptive(batch, embed_batch, text_length if truncate_on_oom else None)
 
-                # Trim padded tokens per sample
-                for emb, mask in zip(text_embeddings, attention_mask):
-                    num_tokens = mask.sum().item()
-                    trimmed = emb[-num_tokens:].cpu()  # shape: [num_tokens, dim]
-                    embeddings.append(trimmed)
+            for idx, emb in zip(batch, batch_embeddings):
+                embeddings[idx] = emb
 
-            except torch.cuda.OutOfMemoryError:
-                print("OOM on batch — skipping text batch.")
-                continue
+            done += len(batch)
+            if progress is not None:
+                progress(done, len(texts))
 
         # After full loop
-        if self.pooler is not None:
-            return self.pooler.pool_embeddings(embeddings, pool_factor=self.pool_factor)
+        return self._pool(embeddings, pool_factor)
+
+    def _pool(self, embeddings: List[torch.Tensor], pool_factor: Optional[int] = None) -> List[torch.Tensor]:
+        pool_factor = pool_factor if pool_factor is not None else self.pool_factor
+
+        if pool_factor is not None:
+            return self.pooler.pool_embeddings(embeddings, pool_factor=pool_factor)
         else:
             return embeddings
 
-    def score(self, queries: List[str], image_embeddings: List[torch.Tensor]) -> torch.Tensor:
+    def _cap_batches(self, batches: List[List[int]]) -> List[List[int]]:
+        """Split batches that are larger than the batch size learned from earlier OOMs."""
+        if self.max_batch_size is None:
+            return batches
+
+        return [batch[i:i + self.max_batch_size] for batch in batches for i in range(0, len(batch), self.max_batch_size)]
+
+    def _embed_adaptive(
+            self,
+            indices: List[int],
+            embed_batch: Callable[[List[int], Optional[int]], List[torch.Tensor]],
+            length_of: Optional[Callable[[int], int]] = None,
+            max_length: Optional[int] = None
+        ) -> List[torch.Tensor]:
+        """
+        Run embed_batch on indices, halving the batch on CUDA OOM until it fits.
+        A single input that still does not fit is retried with max_length halved when
+        length_of is given, otherwise the error is raised. Never returns fewer embeddings
+        than indices, so callers can rely on positional alignment.
+        """
+        try:
+            return embed_batch(indices, max_length)
+        except torch.cuda.OutOfMemoryError:
+            torch.cuda.empty_cache()
+
+        if len(indices) > 1:
+            half = len(indices) // 2
+
+            if self.max_batch_size is None or half < self.max_batch_size:
+                self.max_batch_size = half
+                print(f"OOM on batch of {len(indices)} — batch size capped at {half} from now on.")
+
+            return (self._embed_adaptive(indices[:half], embed_batch, length_of, max_length) +
+                    self._embed_adaptive(indices[half:], embed_batch, length_of, max_length))
+
+        if length_of is not None:
+            current = max_length if max_length is not None else length_of(indices[0])
+            if current // 2 >= MIN_TRUNCATION_TOKENS:
+                print(f"OOM on single input — truncating to {current // 2} tokens.")
+                return self._embed_adaptive(indices, embed_batch, length_of, current // 2)
+
+        raise RuntimeError(f"Out of GPU memory embedding input {indices[0]} even with a batch size of 1")
+
+    @staticmethod
+    def _length_buckets(lengths: List[int], batch_size: int, max_batch_tokens: Optional[int] = None) -> List[List[int]]:
+        """
+        Group indices into batches of texts with similar length, shortest first.
+        A batch is closed once it holds batch_size texts or adding the next text would
+        push its padded size over max_batch_tokens. A single text longer than the budget
+        still gets a batch of its own.
+        """
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+
+        batches: List[List[int]] = []
+        current: List[int] = []
+
+        for idx in order:
+            # Sorted ascending, so the new text is the longest in the batch
+            padded = (len(current) + 1) * lengths[idx]
+
+            if current and (len(current) >= batch_size or (max_batch_tokens is not None and padded > max_batch_tokens)):
+                batches.append(current)
+                current = []
+
+            current.append(idx)
+
+        if current:
+            batches.append(current)
+
+        return batches
+
+    def embed_queries(self, queries: List[str]) -> torch.Tensor:
+        """Multi-vector embeddings of the queries, shaped (queries, tokens, dim)."""
         batch_queries = self.processor.process_queries(queries).to(self.device)
 
         with torch.inference_mode():
-            query_embeddings = self.model(**batch_queries)
+            return self.model(**batch_queries)
 
+    def score(self, queries: List[str], image_embeddings: List[torch.Tensor]) -> torch.Tensor:
+        return self.score_embedded(self.embed_queries(queries), image_embeddings)
+
+    def score_embedded(self, query_embeddings: torch.Tensor, image_embeddings: List[torch.Tensor]) -> torch.Tensor:
+        """Scores of queries already embedded with embed_queries, shaped (queries, documents)."""
         return self.processor.score_multi_vector(query_embeddings, image_embeddings, device=self.device)
 
     def search(self, queries: List[str], image_embeddings: List[torch.Tensor], top_k: int = 3) -> torch.return_types.topk:
@@ -168,7 +307,8 @@ class ColPali:
         file_path: Path,
         batch_size: int = 1,
         img_max_width: int = 512,
-        img_max_height: int = 512
+        img_max_height: int = 512,
+        progress: Optional[Callable[[int, int], None]] = None
     ) -> tuple[List[Image.Image], torch.Tensor]:
         print(f"Converting {file_path.name} to images...")
         images = pdf2image.convert_from_path(file_path)
@@ -176,7 +316,7 @@ class ColPali:
         images = self.resize_images(images, max_width=img_max_width, max_height=img_max_height)
 
         print(f"Embedding {file_path.name}...")
-        return images, self.embed_images(images, batch_size=batch_size)
+        return images, self.embed_images(images, batch_size=batch_size, progress=progress)
 
     def resize_images(self, images: List[Image.Image], max_width: int = 512, max_height: int = 512) -> List[Image.Image]:
         resized = []
@@ -189,9 +329,27 @@ class ColPali:
         return resized
 
 
+_registry: Dict[Tuple[str, str, bool], ColPali] = {}
+_registry_lock = threading.Lock()
+
+
+def get_colpali(model_name: str = COLPALI_MODEL_NAME, device: Optional[str] = None, quantized: bool = False) -> ColPali:
+    """
+    Return the process-wide ColPali for (model_name, device, quantized), loading it on first use.
+    Callers must not change attributes of the returned instance, pass per-call options instead.
+    """
+    key = (model_name, str(torch.device(device) if device is not None else torch.device(get_torch_device())), quantized)
+
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = ColPali(device=key[1], quantized=quantized, model_name=model_name)
+
+        return _registry[key]
+
+
 class InMemoryColPali:
     def __init__(self, docs_dir: str = "documents", use_fast_plaid: bool = True, reranking: bool = False) -> None:
-        self.colpali = ColPali()
+        self.colpali = get_colpali()
 
         if (use_fast_plaid and
                 not (self.colpali.device == torch.cuda or (isinstance(self.colpali.device, str) and "cuda" in self.colpali.device))):
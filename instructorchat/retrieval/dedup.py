@@ -0,0 +1,110 @@
+"""Near-duplicate detection for knowledge-base posts using MinHash and LSH banding."""
+from typing import Dict, Iterable, List, Sequence
+import random
+import re
+import zlib
+
+import numpy as np
+
+SHINGLE_SIZE = 5
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16  # 4 rows per band, candidates above roughly 0.5 Jaccard similarity
+SIMILARITY_THRESHOLD = 0.9
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+# Fixed seed so that signatures stored with one semester can be compared with the next
+_rng = random.Random(20875)
+_A = np.array([_rng.randint(1, (1 << 32) - 1) for _ in range(NUM_PERMUTATIONS)], dtype=np.uint64)
+_B = np.array([_rng.randint(0, (1 << 32) - 1) for _ in range(NUM_PERMUTATIONS)], dtype=np.uint64)
+
+_WORD_PATTERN = re.compile(r"\w+")
+_NUMBER_PATTERN = re.compile(r"\d+")
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> List[str]:
+    """Overlapping word n-grams of the lowercased text."""
+    words = _WORD_PATTERN.findall(text.lower())
+
+    if len(words) <= size:
+        return [" ".join(words)]
+
+    return [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+
+def minhash(text: str) -> List[int]:
+    """MinHash signature of the text's word shingles."""
+    hashes = np.array([zlib.crc32(s.encode("utf-8")) for s in set(shingles(text))], dtype=np.uint64)
+
+    # a, b and the hashes are all below 2**32, so a * h + b cannot overflow
+    permuted = (np.outer(hashes, _A) + _B) % _MERSENNE_PRIME & _MAX_HASH
+
+    return permuted.min(axis=0).tolist()
+
+
+def numbers_key(text: str) -> str:
+    """
+    Hash of the set of numbers in the text.
+    Templated posts such as "HW4 Grades Released" and "HW6 Grades Released", or the same
+    announcement with another semester's dates, differ only in their numbers and must not be merged.
+    """
+    return f"{zlib.crc32(' '.join(sorted(set(_NUMBER_PATTERN.findall(text)))).encode('utf-8')):08x}"
+
+
+def band_keys(signature: Sequence[int], numbers: str) -> List[str]:
+    """LSH keys of the signature. Two posts sharing any key are candidate duplicates."""
+    rows = len(signature) // NUM_BANDS
+
+    return [
+        f"{band}:{zlib.crc32(np.asarray(signature[band * rows:(band + 1) * rows], dtype=np.uint64).tobytes()):08x}:{numbers}"
+        for band in range(NUM_BANDS)
+    ]
+
+
+def similarity(signature_a: Sequence[int], signature_b: Sequence[int]) -> float:
+    """Estimated Jaccard similarity of the two posts."""
+    return sum(a == b for a, b in zip(signature_a, signature_b)) / len(signature_a)
+
+
+def cluster(signatures: List[List[int]], numbers: List[str], threshold: float = SIMILARITY_THRESHOLD) -> List[List[int]]:
+    """
+    Group indices of near-identical posts given their signatures and numbers keys.
+    Candidates come from shared LSH bands and are confirmed by their estimated similarity.
+    Each cluster lists its indices in ascending order, clusters are ordered by their first index.
+    """
+    parent = list(range(len(signatures)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    buckets: Dict[str, List[int]] = {}
+    for i, signature in enumerate(signatures):
+        for key in band_keys(signature, numbers[i]):
+            buckets.setdefault(key, []).append(i)
+
+    for members in buckets.values():
+        for n, i in enumerate(members):
+            for j in members[n + 1:]:
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j and similarity(signatures[i], signatures[j]) >= threshold:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    clusters: Dict[int, List[int]] = {}
+    for i in range(len(signatures)):
+        clusters.setdefault(find(i), []).append(i)
+
+    return list(clusters.values())
+
+
+def merge_folders(folder_lists: Iterable[List[str]]) -> List[str]:
+    """Union of folder lists, keeping first-seen order."""
+    merged: List[str] = []
+    for folders in folder_lists:
+        for folder in folders:
+            if folder not in merged:
+                merged.append(folder)
+    return merged
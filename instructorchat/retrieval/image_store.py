@@ -0,0 +1,85 @@
+"""Content-addressed store for PDF page images, with the data URLs sent to the LLM cached alongside."""
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from typing import Optional, Tuple, Union
+import base64
+import hashlib
+
+from PIL import Image
+
+IMAGE_STORE_DIR = Path(__file__).parent / "KnowledgeBase" / "images"
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp"}
+
+
+class PageImageStore:
+    """
+    Page images stored once under the SHA-256 of their encoded bytes.
+
+    Each image is saved as <root>/<hash[:2]>/<hash>.<ext> at the size it is sent to the LLM,
+    next to a <hash>.url file holding its ready-to-send base64 data URL.
+
+    Args:
+        root (Union[str, Path], optional): Directory of the store. Defaults to KnowledgeBase/images.
+        image_format (str, optional): "JPEG" or "WEBP". Defaults to "JPEG".
+        quality (int, optional): Encoder quality. Defaults to 85.
+        max_size (Tuple[int, int], optional): Images are shrunk to fit within this size. Defaults to (512, 512).
+    """
+
+    def __init__(
+        self,
+        root: Union[str, Path] = IMAGE_STORE_DIR,
+        image_format: str = "JPEG",
+        quality: int = 85,
+        max_size: Tuple[int, int] = (512, 512)
+    ) -> None:
+        if image_format not in _MIME_TYPES:
+            raise ValueError(f"Unsupported image format '{image_format}'")
+
+        self.root = Path(root)
+        self.image_format = image_format
+        self.quality = quality
+        self.max_size = max_size
+
+    def path(self, image_hash: str) -> Path:
+        return self.root / image_hash[:2] / f"{image_hash}{_EXTENSIONS[self.image_format]}"
+
+    def _url_path(self, image_hash: str) -> Path:
+        return self.root / image_hash[:2] / f"{image_hash}.url"
+
+    def put(self, image: Image.Image) -> str:
+        """Store the image if it is not already stored and return its hash."""
+        image = image.convert("RGB")
+        image.thumbnail(self.max_size, Image.Resampling.LANCZOS)
+
+        buffer = BytesIO()
+        image.save(buffer, format=self.image_format, quality=self.quality)
+        encoded = buffer.getvalue()
+
+        image_hash = hashlib.sha256(encoded).hexdigest()
+        image_path = self.path(image_hash)
+
+        # The data URL is written last, so its presence means the image is complete
+        if not self._url_path(image_hash).exists():
+            image_path.parent.mkdir(parents=True, exist_ok=True)
+            image_path.write_bytes(encoded)
+            self._url_path(image_hash).write_text(
+                f"data:{_MIME_TYPES[self.image_format]};base64,{base64.b64encode(encoded).decode('utf-8')}"
+            )
+
+        return image_hash
+
+    def data_url(self, image_hash: str) -> Optional[str]:
+        """Return the cached data URL of a stored image, or None if it is not in the store."""
+        try:
+            return _read_data_url(self._url_path(image_hash))
+        except FileNotFoundError:
+            return None
+
+
+@lru_cache(maxsize=256)
+def _read_data_url(url_path: Path) -> str:
+    # Stored images never change, so their data URLs can be kept in memory
+    return url_path.read_text()
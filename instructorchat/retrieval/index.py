@@ -0,0 +1,369 @@
+"""
+Resident retrieval index: the embeddings of each searched folder kept in memory and
+refreshed incrementally from the chunk store.
+
+A folder is loaded by a full scan the first time it is searched. From then on a
+background thread follows the store's change stream and applies inserts, updates and
+deletes to the loaded folders, so chunks written by another process (the ingestion
+worker, or store.py run from the CLI) become searchable within seconds. Servers that
+cannot stream changes (a standalone MongoDB) are polled instead.
+
+IndexManager holds one resident index per course collection and keeps the folders
+they hold within a memory budget, evicting the least recently searched ones.
+"""
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import logging
+import os
+import threading
+import time
+
+import torch
+
+from instructorchat.retrieval.chunk_store import (
+    ChangeStreamUnsupported, ChunkStore, DELETE, RESET, UPSERT, in_shard, open_chunk_store
+)
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5.0
+RETRY_INTERVAL = 5.0
+
+# Resident embeddings across all courses and folders, 0 for no limit
+DEFAULT_BUDGET_MB = 2048
+
+
+def default_budget_bytes() -> int:
+    """RAG_INDEX_BUDGET_MB in bytes, or DEFAULT_BUDGET_MB if it is not set."""
+    return int(float(os.environ.get("RAG_INDEX_BUDGET_MB", DEFAULT_BUDGET_MB)) * 1024 * 1024)
+
+
+def _nbytes(embedding: torch.Tensor) -> int:
+    return embedding.element_size() * embedding.nelement()
+
+
+class _Folder:
+    def __init__(self) -> None:
+        self.embeddings: Dict[str, torch.Tensor] = {}
+        self.nbytes = 0
+        # Chunks removed while the folder was loading, which the scan must not bring back
+        self.deleted: Set[str] = set()
+        self.loaded = threading.Event()
+
+    def put(self, chunk_id: str, embedding: torch.Tensor) -> None:
+        previous = self.embeddings.get(chunk_id)
+        if previous is not None:
+            self.nbytes -= _nbytes(previous)
+        self.embeddings[chunk_id] = embedding
+        self.nbytes += _nbytes(embedding)
+
+    def pop(self, chunk_id: str) -> None:
+        previous = self.embeddings.pop(chunk_id, None)
+        if previous is not None:
+            self.nbytes -= _nbytes(previous)
+
+
+class ResidentIndex:
+    """
+    In-memory embeddings of the searched folders of a chunk store.
+
+    Args:
+        chunk_store (ChunkStore): Store to load and follow.
+        poll_interval (float, optional): Seconds between polls when changes cannot be streamed. Defaults to 5.0.
+        shard (Tuple[int, int], optional): Keep only the chunks of shard (index, number of shards),
+            which the store selects when scanning. Defaults to keeping every chunk.
+    """
+
+    def __init__(
+        self,
+        chunk_store: ChunkStore,
+        poll_interval: float = POLL_INTERVAL,
+        shard: Optional[Tuple[int, int]] = None
+    ) -> None:
+        self.chunk_store = chunk_store
+        self.poll_interval = poll_interval
+        self.shard = shard
+
+        self._folders: Dict[str, _Folder] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start following the store in a daemon thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._follow, name="resident-index", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def folder(self, folder: str) -> Tuple[List[str], List[torch.Tensor]]:
+        """Chunk ids and embeddings of the folder, loading it on first use."""
+        while True:
+            with self._lock:
+                entry = self._folders.get(folder)
+                loading = entry is None
+                if loading:
+                    entry = self._folders[folder] = _Folder()
+
+            if loading:
+                self._load(folder, entry)
+            else:
+                entry.loaded.wait()
+
+            with self._lock:
+                # The load failed and the folder was dropped, try again
+                if self._folders.get(folder) is not entry:
+                    continue
+                return list(entry.embeddings.keys()), list(entry.embeddings.values())
+
+    def is_loaded(self, folder: str) -> bool:
+        with self._lock:
+            entry = self._folders.get(folder)
+            return entry is not None and entry.loaded.is_set()
+
+    def nbytes(self, folder: str) -> int:
+        """Bytes of resident embeddings in the folder, 0 if it is not loaded."""
+        with self._lock:
+            entry = self._folders.get(folder)
+            return entry.nbytes if entry is not None else 0
+
+    def evict(self, folder: str) -> None:
+        """Drop a loaded folder, it is scanned again on its next search."""
+        with self._lock:
+            entry = self._folders.get(folder)
+            if entry is not None and entry.loaded.is_set():
+                del self._folders[folder]
+
+    def _load(self, folder: str, entry: _Folder) -> None:
+        try:
+            for chunk_id, embedding in self.chunk_store.scan(folder, self.shard):
+                with self._lock:
+                    # Changes applied during the scan are newer than what it read
+                    if chunk_id not in entry.deleted and chunk_id not in entry.embeddings:
+                        entry.put(chunk_id, embedding)
+        except Exception:
+            with self._lock:
+                del self._folders[folder]
+            entry.loaded.set()
+            raise
+
+        with self._lock:
+            entry.deleted.clear()
+        entry.loaded.set()
+
+    def _upsert(self, chunk_id: str, folders: List[str], embedding: torch.Tensor) -> None:
+        if not in_shard(chunk_id, self.shard):
+            return
+
+        with self._lock:
+            for name, entry in self._folders.items():
+                if name in folders:
+                    entry.put(chunk_id, embedding)
+                    entry.deleted.discard(chunk_id)
+                else:
+                    self._remove(entry, chunk_id)
+
+    def _delete(self, chunk_id: str) -> None:
+        with self._lock:
+            for entry in self._folders.values():
+                self._remove(entry, chunk_id)
+
+    @staticmethod
+    def _remove(entry: _Folder, chunk_id: str) -> None:
+        entry.pop(chunk_id)
+        if not entry.loaded.is_set():
+            entry.deleted.add(chunk_id)
+
+    def _reset(self) -> None:
+        # Loaded folders are reloaded on their next search, folders still loading finish as they are
+        with self._lock:
+            self._folders = {name: entry for name, entry in self._folders.items() if not entry.loaded.is_set()}
+
+    def _follow(self) -> None:
+        resume_token = None
+
+        while not self._stopped.is_set():
+            try:
+                for change in self.chunk_store.changes(resume_token):
+                    if self._stopped.is_set():
+                        return
+                    if change is None:
+                        continue
+
+                    if change.kind == UPSERT:
+                        self._upsert(change.chunk_id, change.folders, change.embedding)
+                    elif change.kind == DELETE:
+                        self._delete(change.chunk_id)
+                    elif change.kind == RESET:
+                        self._reset()
+                    resume_token = change.token
+
+            except ChangeStreamUnsupported as e:
+                logger.info(f"Change streams unavailable ({e}), polling every {self.poll_interval}s")
+                self._poll()
+                return
+
+            except Exception as e:
+                # Network errors and the like: resume where the stream left off
+                logger.warning(f"Resident index change stream failed: {e}")
+                self._stopped.wait(RETRY_INTERVAL)
+
+    def _poll(self) -> None:
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self._poll_once()
+            except Exception as e:
+                logger.warning(f"Resident index poll failed: {e}")
+
+    def _poll_once(self) -> None:
+        """
+        Bring the loaded folders in line with the store by comparing chunk ids and folders.
+        Unlike the change stream, this does not notice embeddings replaced under the same chunk id.
+        """
+        with self._lock:
+            resident = {name: set(entry.embeddings) for name, entry in self._folders.items() if entry.loaded.is_set()}
+
+        if not resident:
+            return
+
+        memberships = self.chunk_store.memberships(list(resident))
+        if self.shard is not None:
+            memberships = {chunk_id: folders for chunk_id, folders in memberships.items() if in_shard(chunk_id, self.shard)}
+
+        missing = set()
+        for name, chunk_ids in resident.items():
+            missing.update(
+                chunk_id for chunk_id, folders in memberships.items()
+                if name in folders and chunk_id not in chunk_ids
+            )
+
+        for chunk_id, folders, embedding in self.chunk_store.embeddings(list(missing)):
+            self._upsert(chunk_id, folders, embedding)
+
+        with self._lock:
+            for name, chunk_ids in resident.items():
+                entry = self._folders.get(name)
+                if entry is None:
+                    continue
+                for chunk_id in chunk_ids:
+                    if name not in memberships.get(chunk_id, ()):
+                        entry.pop(chunk_id)
+
+
+class IndexManager:
+    """
+    Resident indices of many course collections within one memory budget.
+
+    Folders are loaded on their first search. Once the resident embeddings exceed the
+    budget, the least recently searched folders of any course are evicted until they fit
+    again. A folder that alone exceeds the budget is kept until another one is searched.
+
+    Args:
+        budget_bytes (int, optional): Memory budget, 0 for no limit. Defaults to default_budget_bytes().
+        open_store (Callable[[str], ChunkStore], optional): Opens the store of a collection. Defaults to open_chunk_store.
+        shard (Tuple[int, int], optional): Shard (index, number of shards) passed to every resident index.
+    """
+
+    def __init__(
+        self,
+        budget_bytes: Optional[int] = None,
+        open_store: Callable[[str], ChunkStore] = open_chunk_store,
+        shard: Optional[Tuple[int, int]] = None
+    ) -> None:
+        self.budget_bytes = default_budget_bytes() if budget_bytes is None else budget_bytes
+        self.open_store = open_store
+        self.shard = shard
+
+        self._stores: Dict[str, ChunkStore] = {}
+        self._indices: Dict[str, ResidentIndex] = {}
+        # (collection, folder) -> resident bytes, least recently searched first
+        self._resident: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+        self.last_load_seconds: Optional[float] = None
+
+    def store(self, collection_name: str) -> ChunkStore:
+        with self._lock:
+            if collection_name not in self._stores:
+                self._stores[collection_name] = self.open_store(collection_name)
+            return self._stores[collection_name]
+
+    def _index(self, collection_name: str) -> ResidentIndex:
+        store = self.store(collection_name)
+        with self._lock:
+            index = self._indices.get(collection_name)
+            if index is None:
+                index = self._indices[collection_name] = ResidentIndex(store, shard=self.shard)
+                index.start()
+            return index
+
+    def folder(self, collection_name: str, folder: str) -> Tuple[List[str], List[torch.Tensor]]:
+        """Chunk ids and embeddings of a folder of a collection, loading it (and evicting others) as needed."""
+        index = self._index(collection_name)
+        key = (collection_name, folder)
+
+        if index.is_loaded(folder):
+            ids, embeddings = index.folder(folder)
+            with self._lock:
+                self.hits += 1
+        else:
+            start = time.perf_counter()
+            ids, embeddings = index.folder(folder)
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.loads += 1
+                self.load_seconds += elapsed
+                self.last_load_seconds = elapsed
+            logger.info(f"Loaded {collection_name}/{folder}: {len(ids)} chunk(s) in {elapsed:.2f}s")
+
+        with self._lock:
+            # Sizes change with live updates, so they are refreshed on every search
+            self._resident[key] = index.nbytes(folder)
+            self._resident.move_to_end(key)
+            evicted = self._evict(keep=key)
+
+        for collection, name in evicted:
+            self._indices[collection].evict(name)
+            logger.info(f"Evicted {collection}/{name} to stay within {self.budget_bytes / 1024 / 1024:.0f} MB")
+
+        return ids, embeddings
+
+    def _evict(self, keep: Tuple[str, str]) -> List[Tuple[str, str]]:
+        evicted = []
+        if not self.budget_bytes:
+            return evicted
+
+        total = sum(self._resident.values())
+        for key in list(self._resident):
+            if total <= self.budget_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self._resident.pop(key)
+            evicted.append(key)
+            self.evictions += 1
+
+        return evicted
+
+    def stats(self) -> Dict:
+        """Loads, hits, evictions, load latency and resident bytes per course and folder."""
+        with self._lock:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "resident_bytes": sum(self._resident.values()),
+                "loads": self.loads,
+                "hits": self.hits,
+                "evictions": self.evictions,
+                "load_seconds_total": self.load_seconds,
+                "load_seconds_last": self.last_load_seconds,
+                "resident": {f"{collection}/{folder}": size for (collection, folder), size in self._resident.items()},
+            }
@@ -0,0 +1,121 @@
+"""
+Columnar knowledge-base files: one record per post with its content and metadata.
+
+Knowledge bases used to be shipped as Python modules holding a list of haystack
+Documents. Importing one compiles and executes the whole file, so they can be
+converted once to JSONL (or Parquet) and read back sequentially instead.
+
+Usage:
+python -m instructorchat.retrieval.knowledge_base KnowledgeBase/Piazza_S23_clean.py --format jsonl
+"""
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Union
+import argparse
+import ast
+import json
+
+SUPPORTED_EXTENSIONS = (".jsonl", ".parquet")
+PARQUET_BATCH_SIZE = 1024
+
+
+class KnowledgeRecord(NamedTuple):
+    """A post with the same content/meta fields as a haystack Document."""
+    content: str
+    meta: Dict[str, Any]
+
+
+def iter_records(path: Union[str, Path]) -> Iterator[KnowledgeRecord]:
+    """Stream the records of a .jsonl or .parquet knowledge-base file."""
+    path = Path(path)
+
+    if path.suffix == ".jsonl":
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield KnowledgeRecord(record["content"], record["meta"])
+
+    elif path.suffix == ".parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("Reading .parquet knowledge bases requires pyarrow") from e
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=PARQUET_BATCH_SIZE, columns=["content", "meta"]):
+            for content, meta in zip(batch.column("content").to_pylist(), batch.column("meta").to_pylist()):
+                yield KnowledgeRecord(content, json.loads(meta))
+
+    else:
+        raise ValueError(f"Unsupported knowledge-base format '{path.suffix}'")
+
+
+def read_module_docs(path: Union[str, Path], variable: str = "docs") -> List[KnowledgeRecord]:
+    """
+    Read the Document(...) literals assigned to variable in a knowledge-base module
+    without importing it (and without needing haystack).
+    """
+    tree = ast.parse(Path(path).read_text(encoding="utf-8"))
+
+    for node in tree.body:
+        if (isinstance(node, ast.Assign) and isinstance(node.value, ast.List) and
+                any(isinstance(target, ast.Name) and target.id == variable for target in node.targets)):
+            records = []
+            for element in node.value.elts:
+                kwargs = {keyword.arg: ast.literal_eval(keyword.value) for keyword in element.keywords}
+                records.append(KnowledgeRecord(kwargs["content"], kwargs.get("meta", {})))
+            return records
+
+    raise ValueError(f"{path} has no list assigned to '{variable}'")
+
+
+def write_jsonl(records: Iterable[KnowledgeRecord], path: Union[str, Path]) -> int:
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps({"content": record.content, "meta": record.meta}, ensure_ascii=False, default=str) + "\n")
+            count += 1
+    return count
+
+
+def write_parquet(records: Iterable[KnowledgeRecord], path: Union[str, Path]) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Writing .parquet knowledge bases requires pyarrow") from e
+
+    records = list(records)
+    # meta keys differ between posts, so it is kept as a JSON string column
+    table = pa.table({
+        "content": [record.content for record in records],
+        "meta": [json.dumps(record.meta, ensure_ascii=False, default=str) for record in records],
+    })
+    pq.write_table(table, path)
+    return len(records)
+
+
+def convert_module(module_path: Union[str, Path], fmt: str = "jsonl", variable: str = "docs") -> Path:
+    """Convert a knowledge-base module to a .jsonl or .parquet file next to it."""
+    module_path = Path(module_path)
+    out_path = module_path.with_suffix(f".{fmt}")
+
+    records = read_module_docs(module_path, variable)
+    count = write_parquet(records, out_path) if fmt == "parquet" else write_jsonl(records, out_path)
+
+    print(f"Wrote {count} records to {out_path}")
+    return out_path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", type=str, nargs="+", help="Knowledge-base modules to convert")
+    parser.add_argument("--format", type=str, choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--variable", type=str, default="docs", help="Name of the list of Documents in the module")
+    args = parser.parse_args()
+
+    for module in args.modules:
+        convert_module(module, args.format, args.variable)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""
+Embedded chunk store for single-node deployments and offline runs.
+
+A collection lives in two files under the store directory:
+    <collection>.sqlite3     documents, chunks, their folders and LSH bands, and a change log
+    <collection>.embeddings  the chunk embeddings as raw bfloat16, appended and memory-mapped
+
+Embeddings are returned as views of the mapped file, so a resident folder costs page
+cache rather than process memory. Writers from several processes are serialized by
+SQLite's write lock, and readers follow their writes through the change log.
+"""
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+import json
+import mmap
+import os
+import sqlite3
+import threading
+import time
+
+import torch
+
+from instructorchat.retrieval.chunk_store import (
+    CHANGE_WAIT_MS, DELETE, HIT_DOCUMENT_FIELDS, SCAN_BATCH_SIZE, TEXT_CHUNK, UPSERT,
+    ChunkChange, ChunkStore, content_hash, encode_embedding, in_shard
+)
+
+# Parameters per IN (...) query, below SQLite's limit on host parameters
+IN_BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, body TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS document_bands (band TEXT NOT NULL, doc_id TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS document_bands_band ON document_bands (band);
+CREATE TABLE IF NOT EXISTS chunks (
+    id TEXT PRIMARY KEY,
+    doc_id TEXT NOT NULL,
+    file_type TEXT,
+    kind TEXT,
+    chunk_text TEXT,
+    content_hash TEXT,
+    byte_offset INTEGER NOT NULL,
+    byte_length INTEGER NOT NULL,
+    shape TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_doc_id ON chunks (doc_id);
+CREATE INDEX IF NOT EXISTS chunks_content_hash ON chunks (content_hash);
+CREATE TABLE IF NOT EXISTS chunk_folders (folder TEXT NOT NULL, chunk_id TEXT NOT NULL, PRIMARY KEY (folder, chunk_id));
+CREATE INDEX IF NOT EXISTS chunk_folders_chunk_id ON chunk_folders (chunk_id);
+CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, chunk_id TEXT NOT NULL);
+"""
+
+
+def _batches(values: Sequence, size: int = IN_BATCH_SIZE) -> Iterator[Sequence]:
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _placeholders(values: Sequence) -> str:
+    return ", ".join("?" * len(values))
+
+
+class LocalChunkStore(ChunkStore):
+    """
+    Chunk store backed by SQLite and a memory-mapped embedding file.
+
+    Args:
+        root (Union[str, Path]): Directory holding the collection files.
+        collection_name (str, optional): Collection to open. Defaults to "ece20875".
+    """
+
+    def __init__(self, root: Union[str, Path], collection_name: str = "ece20875") -> None:
+        self.name = collection_name
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self.db_path = self.root / f"{collection_name}.sqlite3"
+        self.embeddings_path = self.root / f"{collection_name}.embeddings"
+        self.embeddings_path.touch(exist_ok=True)
+
+        self._local = threading.local()
+        self._map: Optional[mmap.mmap] = None
+        self._map_lock = threading.Lock()
+
+        self.ensure_indexes()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def ensure_indexes(self) -> None:
+        self._connection().executescript(SCHEMA)
+
+    def _embedding(self, byte_offset: int, byte_length: int, shape: str) -> torch.Tensor:
+        end = byte_offset + byte_length
+
+        with self._map_lock:
+            # Remap once the file has grown past the mapped region. Earlier maps stay
+            # alive for as long as tensors still view them.
+            if self._map is None or len(self._map) < end:
+                with open(self.embeddings_path, "rb") as f:
+                    # ACCESS_COPY gives torch a writable buffer without touching the file
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            mapped = self._map
+
+        embedding = torch.frombuffer(mapped, dtype=torch.int16, offset=byte_offset, count=byte_length // 2)
+        return embedding.view(torch.bfloat16).reshape(json.loads(shape))
+
+    def _log_changes(self, connection: sqlite3.Connection, chunk_ids: Iterable[str]) -> None:
+        connection.executemany("INSERT INTO changes (chunk_id) VALUES (?)", [(chunk_id,) for chunk_id in chunk_ids])
+
+    def insert_document(self, document: Dict, chunks: List[Dict]) -> None:
+        connection = self._connection()
+        # Taking the write lock first keeps concurrent writers from interleaving their appends
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = []
+            with open(self.embeddings_path, "ab") as f:
+                byte_offset = f.seek(0, os.SEEK_END)
+                for chunk in chunks:
+                    data, shape = encode_embedding(chunk["embedding"])
+                    f.write(data)
+                    rows.append((
+                        chunk["chunk_id"], document["_id"], document["file_type"], chunk.get("kind", TEXT_CHUNK),
+                        chunk["chunk_text"], content_hash(chunk["chunk_text"]), byte_offset, len(data), json.dumps(shape)
+                    ))
+                    byte_offset += len(data)
+
+            connection.execute(
+                "INSERT INTO documents (id, body) VALUES (?, ?)",
+                (document["_id"], json.dumps(document, ensure_ascii=False, default=str))
+            )
+            connection.executemany(
+                "INSERT INTO document_bands (band, doc_id) VALUES (?, ?)",
+                [(band, document["_id"]) for band in document.get("lsh_bands", [])]
+            )
+            connection.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            connection.executemany(
+                "INSERT OR IGNORE INTO chunk_folders (folder, chunk_id) VALUES (?, ?)",
+                [(folder, chunk["chunk_id"]) for chunk in chunks for folder in document["folders"]]
+            )
+            self._log_changes(connection, (chunk["chunk_id"] for chunk in chunks))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def add_aliases(self, doc_id: str, aliases: List[Dict], folders: List[str]) -> None:
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT body FROM documents WHERE id = ?", (doc_id,)).fetchone()
+            if row is None:
+                connection.execute("ROLLBACK")
+                return
+
+            document = json.loads(row[0])
+            document.setdefault("aliases", []).extend(aliases)
+            document["folders"] = document["folders"] + [f for f in dict.fromkeys(folders) if f not in document["folders"]]
+            connection.execute(
+                "UPDATE documents SET body = ? WHERE id = ?",
+                (json.dumps(document, ensure_ascii=False, default=str), doc_id)
+            )
+
+            chunk_ids = [r[0] for r in connection.execute("SELECT id FROM chunks WHERE doc_id = ?", (doc_id,))]
+            connection.executemany(
+                "INSERT OR IGNORE INTO chunk_folders (folder, chunk_id) VALUES (?, ?)",
+                [(folder, chunk_id) for chunk_id in chunk_ids for folder in folders]
+            )
+            self._log_changes(connection, chunk_ids)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def lsh_candidates(self, keys: List[str]) -> Iterator[Dict]:
+        connection = self._connection()
+        seen = set()
+
+        for batch in _batches(list(keys)):
+            cursor = connection.execute(
+                "SELECT DISTINCT d.id, d.body FROM document_bands b JOIN documents d ON d.id = b.doc_id "
+                f"WHERE b.band IN ({_placeholders(batch)})",
+                batch
+            )
+            for doc_id, body in cursor:
+                if doc_id not in seen:
+                    seen.add(doc_id)
+                    document = json.loads(body)
+                    yield {"_id": doc_id, "minhash": document["minhash"], "lsh_bands": document["lsh_bands"]}
+
+    def stored_hashes(self, hashes: Iterable[str]) -> Set[str]:
+        connection = self._connection()
+        stored = set()
+
+        for batch in _batches(list(set(hashes))):
+            cursor = connection.execute(
+                f"SELECT DISTINCT content_hash FROM chunks WHERE content_hash IN ({_placeholders(batch)})", batch
+            )
+            stored.update(row[0] for row in cursor)
+
+        return stored
+
+    def scan(self, folder: str, shard: Optional[Tuple[int, int]] = None) -> Iterator[Tuple[str, torch.Tensor]]:
+        cursor = self._connection().execute(
+            "SELECT c.id, c.byte_offset, c.byte_length, c.shape FROM chunk_folders f "
+            "JOIN chunks c ON c.id = f.chunk_id WHERE f.folder = ?",
+            (folder,)
+        )
+        cursor.arraysize = SCAN_BATCH_SIZE
+
+        for chunk_id, byte_offset, byte_length, shape in cursor:
+            # Other shards' embeddings are never mapped
+            if in_shard(chunk_id, shard):
+                yield chunk_id, self._embedding(byte_offset, byte_length, shape)
+
+    def lookup(self, chunk_ids: List[str]) -> Dict[str, Dict]:
+        connection = self._connection()
+        chunks = {}
+        for batch in _batches(list(chunk_ids)):
+            cursor = connection.execute(
+                f"SELECT id, doc_id, chunk_text FROM chunks WHERE id IN ({_placeholders(batch)})", batch
+            )
+            chunks.update({chunk_id: (doc_id, chunk_text) for chunk_id, doc_id, chunk_text in cursor})
+
+        doc_ids = list({doc_id for doc_id, _ in chunks.values()})
+        documents = {}
+        for batch in _batches(doc_ids):
+            cursor = connection.execute(f"SELECT id, body FROM documents WHERE id IN ({_placeholders(batch)})", batch)
+            for doc_id, body in cursor:
+                document = json.loads(body)
+                documents[doc_id] = {"_id": doc_id, **{k: document[k] for k in HIT_DOCUMENT_FIELDS if k in document}}
+
+        hits = {}
+        for chunk_id, (doc_id, chunk_text) in chunks.items():
+            document = documents.get(doc_id)
+            if document is not None:
+                hits[chunk_id] = {**document, "chunk_text": chunk_text}
+
+        return hits
+
+    def _folders_of(self, chunk_ids: Sequence[str]) -> Dict[str, List[str]]:
+        folders: Dict[str, List[str]] = {}
+        for batch in _batches(list(chunk_ids)):
+            cursor = self._connection().execute(
+                f"SELECT chunk_id, folder FROM chunk_folders WHERE chunk_id IN ({_placeholders(batch)})", batch
+            )
+            for chunk_id, folder in cursor:
+                folders.setdefault(chunk_id, []).append(folder)
+        return folders
+
+    def embeddings(self, chunk_ids: List[str]) -> Iterator[Tuple[str, List[str], torch.Tensor]]:
+        folders = self._folders_of(chunk_ids)
+
+        for batch in _batches(list(chunk_ids)):
+            cursor = self._connection().execute(
+                f"SELECT id, byte_offset, byte_length, shape FROM chunks WHERE id IN ({_placeholders(batch)})", batch
+            )
+            for chunk_id, byte_offset, byte_length, shape in cursor.fetchall():
+                yield chunk_id, folders.get(chunk_id, []), self._embedding(byte_offset, byte_length, shape)
+
+    def memberships(self, folders: List[str]) -> Dict[str, List[str]]:
+        cursor = self._connection().execute(
+            "SELECT chunk_id FROM chunk_folders "
+            f"WHERE folder IN ({_placeholders(folders)})",
+            folders
+        )
+        return self._folders_of(list({row[0] for row in cursor}))
+
+    def changes(self, resume_after: Optional[Dict] = None) -> Iterator[Optional[ChunkChange]]:
+        """Follow the change log, starting after resume_after or at its end."""
+        connection = self._connection()
+
+        if resume_after is None:
+            last_seq = connection.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        else:
+            last_seq = resume_after["seq"]
+
+        while True:
+            rows = connection.execute(
+                "SELECT seq, chunk_id FROM changes WHERE seq > ? ORDER BY seq LIMIT ?", (last_seq, SCAN_BATCH_SIZE)
+            ).fetchall()
+
+            if not rows:
+                time.sleep(CHANGE_WAIT_MS / 1000)
+                yield None
+                continue
+
+            current = {chunk_id: (folders, embedding) for chunk_id, folders, embedding in self.embeddings(
+                list({chunk_id for _, chunk_id in rows})
+            )}
+
+            for seq, chunk_id in rows:
+                last_seq = seq
+                if chunk_id in current:
+                    folders, embedding = current[chunk_id]
+                    yield ChunkChange(UPSERT, chunk_id, folders, embedding, {"seq": seq})
+                else:
+                    yield ChunkChange(DELETE, chunk_id, [], None, {"seq": seq})
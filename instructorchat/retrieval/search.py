@@ -1,15 +1,20 @@
-from pymongo import MongoClient
 # from urllib.parse import quote_plus
+from functools import partial
 from typing import List, Dict, Final, Optional
 from dotenv import load_dotenv
 import argparse
 import time
-import openai
 import logging
 import torch
 import os
-
-from instructorchat.retrieval.colpali import ColPali
+import threading
+import trio
+
+from instructorchat.model.clients import get_async_client
+from instructorchat.retrieval.colpali import get_colpali
+from instructorchat.retrieval.index import IndexManager
+from instructorchat.retrieval.shards import BY_HASH, ShardedRetriever
+from instructorchat.metrics import metrics
 import traceback
 
 # Set up logging
@@ -23,24 +28,40 @@ logger = logging.getLogger(__name__)
 # Define available folders for classification
 AVAILABLE_FOLDERS: Final[List[str]] = ['project', 'logistics', 'course_content', 'exam', 'hw1', 'hw2', 'hw3', 'hw4',
                                        'hw5', 'hw6', 'hw7', 'hw8', 'hw9', 'hw10', 'other']
-INCLUDE: Final[int] = 1
+
+DEFAULT_COLLECTION: Final[str] = "ece20875"
+COLPALI_DEVICE: Final[str] = "cuda:0"
 
 load_dotenv()
-# Connect to MongoDB Atlas
-# username = quote_plus("voquangtri2021")
-# password = quote_plus("Voquangtri123@")
-mongo = MongoClient(os.environ["MONGO_URL"])
-db = mongo["rag_database"]
-collection = db["ece20875"]
+# Searched folders of every course stay in memory, within RAG_INDEX_BUDGET_MB, and follow
+# new, changed and deleted chunks. Stores are MongoDB Atlas, or local if RAG_STORE_BACKEND=local
+indexes = IndexManager()
+
+# With RAG_RETRIEVAL_SHARDS > 0 the indices live in that many worker processes instead,
+# partitioned by RAG_SHARD_BY ("hash" or "course")
+NUM_SHARDS: Final[int] = int(os.environ.get("RAG_RETRIEVAL_SHARDS", 0))
+_shards: Optional[ShardedRetriever] = None
+_shards_lock = threading.Lock()
+
 
-# Set up ColPali class
-colpali = ColPali(device="cuda:0", quantized=True)
+def get_shards() -> Optional[ShardedRetriever]:
+    """Start the shard workers on first use, or return None when retrieval is not sharded."""
+    global _shards
+
+    if NUM_SHARDS <= 0:
+        return None
+
+    with _shards_lock:
+        if _shards is None:
+            _shards = ShardedRetriever(NUM_SHARDS, os.environ.get("RAG_SHARD_BY", BY_HASH))
+
+    return _shards
 
 
 async def classify_query(query: str, api_key: str) -> str:
     """Classify the query into one of the available folders using GPT-4-mini."""
     try:
-        client = openai.AsyncOpenAI(api_key=api_key)
+        client = get_async_client(api_key)
 
         # Create a prompt for classification
         system_prompt = f"""You are a query classifier. Your task is to classify the user's query into one of these folders: {', '.join(AVAILABLE_FOLDERS)}.
@@ -71,16 +92,26 @@ async def classify_query(query: str, api_key: str) -> str:
         return 'other'
 
 
-async def retrieve_relevant_context(query: str, api_key: str, folder: Optional[str]) -> List[Dict]:
-    """Retrieve relevant context for the query using classification and vector search."""
+async def retrieve_relevant_context(
+    query: str,
+    api_key: str,
+    folder: Optional[str],
+    collection_name: str = DEFAULT_COLLECTION
+) -> List[Dict]:
+    """Retrieve relevant context for the query from a course collection using classification and vector search."""
     try:
         if folder is None:
             # First classify the query
-            folder = await classify_query(query, api_key)
+            with metrics.span("retrieval.classify"):
+                folder = await classify_query(query, api_key)
             logger.info(f"Query classified into folder: {folder}")
 
         # Then use vector search to get relevant content
-        results = vector_search(folder, query, top_k=5)
+        # Scoring runs in a worker thread so that other requests keep being served meanwhile
+        with metrics.span("retrieval.search"):
+            results = await trio.to_thread.run_sync(
+                partial(vector_search, folder, query, top_k=5, collection_name=collection_name)
+            )
 
         # Format the results for context
         context = []
@@ -89,7 +120,9 @@ async def retrieve_relevant_context(query: str, api_key: str, folder: Optional[s
                 "title": doc["filename"],
                 "text": doc["chunk"]["chunk_text"],
                 "image_dir": doc["image_dir"],
-                "metadata": doc["metadata"]
+                "image_hash": doc["image_hash"],
+                "metadata": doc["metadata"],
+                "score": doc["score"]
             })
 
         return context
@@ -99,42 +132,52 @@ async def retrieve_relevant_context(query: str, api_key: str, folder: Optional[s
         return []
 
 
-def vector_search(folder, query, top_k=3):
+def vector_search(folder, query, top_k=3, collection_name=DEFAULT_COLLECTION):
 
-    # explain, add pdf later
-    filtered_docs = collection.find({"folders": folder})
+    # Loaded on the first search rather than at import, so that worker processes
+    # spawned from the server (ingestion, shards) do not load a copy each
+    colpali = get_colpali(device=COLPALI_DEVICE, quantized=True)
 
-    docs_for_chroma = []
-    for doc in filtered_docs:
-        for chunk in doc['chunks']:
-            docs_for_chroma.append({
-                "id": chunk['chunk_id'],
-                "title": doc['filename'],
-                "embedding": chunk['embedding'] if doc['file_type'] == "txt" else doc['embedding']
-            })
+    # Posts, PDF text chunks and PDF page images are all chunks of their parent document.
+    # Only ids and embeddings are resident, text and metadata are fetched for the top-k
+    with metrics.span("retrieval.embed_query"):
+        query_embeddings = colpali.embed_queries([query])
+
+    shards = get_shards()
+    if shards is not None:
+        with metrics.span("retrieval.scan"):
+            matches = shards.search(collection_name, folder, query_embeddings[0], top_k=top_k)
+    else:
+        # Scans the folder from the store on its first search, or after it was evicted
+        with metrics.span("retrieval.load_folder"):
+            ids, embeddings = indexes.folder(collection_name, folder)
+
+        if not embeddings:
+            return []
+
+        with metrics.span("retrieval.scan"):
+            scores = colpali.score_embedded(query_embeddings, embeddings)
+            top = torch.topk(scores, min(top_k, len(embeddings)))
+        matches = [(ids[int(i)], float(s)) for s, i in zip(top.values[0], top.indices[0])]
 
-    ids = [d["id"] for d in docs_for_chroma]
-    embeddings = [torch.tensor(d["embedding"]).to(dtype=torch.bfloat16) for d in docs_for_chroma]
-    top_k = colpali.search([query], embeddings, top_k=3)
-    scores, indices = top_k.values, top_k.indices
-    matching_ids = [ids[int(i)] for i in indices[0]]
-    matching_scores = [float(s) for s in scores[0]]
+    with metrics.span("retrieval.fetch_hits"):
+        hits = indexes.store(collection_name).lookup([chunk_id for chunk_id, _ in matches])
 
     found_chunks = []
-    for chunk_id, score in zip(matching_ids, matching_scores):
-        doc = collection.find_one(
-            {"chunks.chunk_id": chunk_id},
-            {"chunks.$": INCLUDE, "filename": INCLUDE, "metadata": INCLUDE, "file_type": INCLUDE, "image_path": INCLUDE}
-        )
-        if doc and "chunks" in doc:
-            found_chunks.append({
-                "chunk_id": chunk_id,
-                "score": score,
-                "filename": doc["filename"],
-                "metadata": doc["metadata"],
-                "chunk": doc["chunks"][0],
-                "image_dir": doc["image_path"] if doc['file_type'] == "pdf" else None
-            })
+    for chunk_id, score in matches:
+        hit = hits.get(chunk_id)
+        if hit is None:
+            continue
+
+        found_chunks.append({
+            "chunk_id": chunk_id,
+            "score": score,
+            "filename": hit["filename"],
+            "metadata": hit["metadata"],
+            "chunk": {"chunk_id": chunk_id, "chunk_text": hit["chunk_text"]},
+            "image_dir": hit["image_path"] if hit['file_type'] == "pdf" else None,
+            "image_hash": hit.get("image_hash")
+        })
 
     return found_chunks
 
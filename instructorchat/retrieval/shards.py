@@ -0,0 +1,240 @@
+"""
+Sharded retrieval: the resident indices split across local worker processes.
+
+The server embeds the query once on its GPU and sends the query embedding to the
+shards over multiprocessing queues. Each shard scores its part of the folder on the
+CPU with MaxSim and returns its top-k, and the lists are merged into the overall
+top-k. Shards never load the ColPali model.
+
+The corpus is partitioned either by course (every collection lives on one shard,
+so queries for different courses run in parallel) or by chunk id hash (every shard
+holds a slice of every folder, so a single large folder is scored in parallel).
+"""
+from concurrent.futures import Future
+from itertools import chain
+from typing import Callable, Dict, List, Optional, Tuple
+import heapq
+import multiprocessing as mp
+import os
+import threading
+import uuid
+
+import torch
+
+from instructorchat.retrieval.chunk_store import ChunkStore, open_chunk_store, shard_hash
+
+BY_COURSE = "course"
+BY_HASH = "hash"
+
+# Kinds of shard requests
+SEARCH = "search"
+STATS = "stats"
+
+# Documents scored per padded batch
+SCORE_BATCH_SIZE = 256
+SHARD_TIMEOUT = 60.0
+
+
+def shard_of(key: str, num_shards: int) -> int:
+    return shard_hash(key) % num_shards
+
+
+def maxsim(query: torch.Tensor, embeddings: List[torch.Tensor], batch_size: int = SCORE_BATCH_SIZE) -> torch.Tensor:
+    """
+    Late-interaction scores of one query against each embedding: the sum over query tokens of
+    their best dot product with any of the document's tokens. Same scores as ColPali.score.
+    """
+    query = query.float()
+    scores = []
+
+    for i in range(0, len(embeddings), batch_size):
+        batch = torch.nn.utils.rnn.pad_sequence(
+            [embedding.float() for embedding in embeddings[i:i + batch_size]], batch_first=True
+        )
+        scores.append(torch.einsum("qd,bnd->bqn", query, batch).max(dim=2).values.sum(dim=1))
+
+    return torch.cat(scores)
+
+
+def _shard_main(
+    shard: int,
+    num_shards: int,
+    partition: str,
+    budget_bytes: int,
+    open_store: Callable[[str], ChunkStore],
+    requests: mp.Queue,
+    results: mp.Queue
+) -> None:
+    """Serve search requests against this shard's part of the resident indices."""
+    # Imported here so that the shard only loads what scoring needs
+    from instructorchat.retrieval.index import IndexManager
+
+    # Leave the other cores to the other shards
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_shards))
+
+    # A hash shard only scans its own chunks of each folder from the store
+    indexes = IndexManager(
+        budget_bytes=budget_bytes, open_store=open_store, shard=(shard, num_shards) if partition == BY_HASH else None
+    )
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        request_id, kind, args = request
+        try:
+            if kind == STATS:
+                results.put((request_id, indexes.stats(), None))
+                continue
+
+            collection_name, folder, query, top_k = args
+            ids, embeddings = indexes.folder(collection_name, folder)
+            hits = []
+            if ids:
+                top = torch.topk(maxsim(query, embeddings), min(top_k, len(ids)))
+                hits = [(ids[i], score) for score, i in zip(top.values.tolist(), top.indices.tolist())]
+            results.put((request_id, hits, None))
+        except Exception as e:
+            results.put((request_id, None, f"Shard {shard}: {type(e).__name__}: {e}"))
+
+
+def merge_stats(shard_stats: List[Dict]) -> Dict:
+    """
+    IndexManager.stats() of all shards as one. Counts, bytes and load times are summed, also for a folder
+    split between shards, and the last load is the slowest shard's, which a hash-partitioned search waits for.
+    """
+    resident: Dict[str, int] = {}
+    for stats in shard_stats:
+        for folder, size in stats["resident"].items():
+            resident[folder] = resident.get(folder, 0) + size
+
+    last_loads = [stats["load_seconds_last"] for stats in shard_stats if stats["load_seconds_last"] is not None]
+
+    return {
+        **{
+            key: sum(stats[key] for stats in shard_stats)
+            for key in ("budget_bytes", "resident_bytes", "loads", "hits", "evictions", "load_seconds_total")
+        },
+        "load_seconds_last": max(last_loads, default=None),
+        "resident": resident,
+        "shards": shard_stats,
+    }
+
+
+class ShardedRetriever:
+    """
+    Scatter-gather search over shard worker processes.
+
+    Args:
+        num_shards (int): Number of worker processes.
+        partition (str, optional): "course" or "hash". Defaults to "hash".
+        budget_bytes (int, optional): Memory budget of all shards together, split evenly between them.
+            Defaults to default_budget_bytes().
+        open_store (Callable[[str], ChunkStore], optional): Opens the store of a collection in each shard,
+            so it must be picklable. Defaults to open_chunk_store.
+    """
+
+    def __init__(
+        self,
+        num_shards: int,
+        partition: str = BY_HASH,
+        budget_bytes: Optional[int] = None,
+        open_store: Callable[[str], ChunkStore] = open_chunk_store
+    ) -> None:
+        if partition not in (BY_COURSE, BY_HASH):
+            raise ValueError(f"Unknown shard partition '{partition}'")
+
+        if budget_bytes is None:
+            from instructorchat.retrieval.index import default_budget_bytes
+            budget_bytes = default_budget_bytes()
+
+        self.num_shards = num_shards
+        self.partition = partition
+
+        ctx = mp.get_context("spawn")
+        self._requests = [ctx.Queue() for _ in range(num_shards)]
+        self._results = ctx.Queue()
+        self._workers = [
+            ctx.Process(
+                target=_shard_main,
+                args=(
+                    shard, num_shards, partition, budget_bytes // num_shards, open_store, self._requests[shard], self._results
+                ),
+                daemon=True
+            )
+            for shard in range(num_shards)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+        # request id -> [shards still to answer, their answers, future of all answers]
+        self._pending: Dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._router = threading.Thread(target=self._route, name="shard-results", daemon=True)
+        self._router.start()
+
+    def _route(self) -> None:
+        while True:
+            result = self._results.get()
+            if result is None:
+                return
+
+            request_id, answer, error = result
+            with self._lock:
+                pending = self._pending.get(request_id)
+                if pending is None:
+                    continue
+                if error is not None:
+                    del self._pending[request_id]
+                else:
+                    pending[0] -= 1
+                    pending[1].append(answer)
+                    if pending[0] == 0:
+                        del self._pending[request_id]
+
+            if error is not None:
+                pending[2].set_exception(RuntimeError(error))
+            elif pending[0] == 0:
+                pending[2].set_result(pending[1])
+
+    def search(self, collection_name: str, folder: str, query: torch.Tensor, top_k: int = 3) -> List[Tuple[str, float]]:
+        """
+        Top-k (chunk id, score) of the folder for a query embedding shaped (tokens, dim), best first.
+        """
+        if self.partition == BY_COURSE:
+            shards = [shard_of(collection_name, self.num_shards)]
+        else:
+            shards = list(range(self.num_shards))
+
+        query = query.detach().to("cpu", dtype=torch.bfloat16)
+        shard_hits = self._gather(shards, SEARCH, (collection_name, folder, query, top_k))
+
+        return heapq.nlargest(top_k, chain.from_iterable(shard_hits), key=lambda hit: hit[1])
+
+    def stats(self) -> Dict:
+        """IndexManager.stats() of every shard, summed by merge_stats."""
+        return merge_stats(self._gather(list(range(self.num_shards)), STATS, None))
+
+    def _gather(self, shards: List[int], kind: str, args) -> List:
+        """Send a request to the shards and wait for all their answers, in no particular order."""
+        request_id = str(uuid.uuid4())
+        future: Future = Future()
+        with self._lock:
+            self._pending[request_id] = [len(shards), [], future]
+
+        for shard in shards:
+            self._requests[shard].put((request_id, kind, args))
+
+        try:
+            return future.result(timeout=SHARD_TIMEOUT)
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+
+    def close(self) -> None:
+        for requests in self._requests:
+            requests.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+        self._results.put(None)
@@ -1,9 +1,8 @@
-from pymongo import MongoClient
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import Callable, List, Optional, Tuple
 from dotenv import load_dotenv
 import traceback
-import certifi
 import pymupdf4llm
 import re
 import uuid
@@ -12,7 +11,16 @@ import importlib
 import logging
 import os
 
-from instructorchat.retrieval.colpali import ColPali
+from instructorchat.retrieval.colpali import get_colpali
+from instructorchat.retrieval.knowledge_base import iter_records
+from instructorchat.retrieval.image_store import PageImageStore
+from instructorchat.retrieval.chunk_store import ChunkStore, PAGE_CHUNK, content_hash, open_chunk_store, page_chunk_id
+from instructorchat.retrieval.dedup import (
+    SIMILARITY_THRESHOLD, band_keys, cluster, merge_folders, minhash, numbers_key, similarity
+)
+from instructorchat.retrieval.versions import bump_collection_version
+
+KNOWLEDGE_BASE_DIR = Path(__file__).parent / "KnowledgeBase"
 
 
 def format_meta(text: str, meta: dict) -> str:
@@ -20,21 +28,28 @@ def format_meta(text: str, meta: dict) -> str:
     return f"{meta_text} {text}"
 
 
+# Chunk boundaries: blank lines, markdown headers, and bold lines used as headers
+DELIMITER_PATTERN = re.compile(r'(?:\n{2,}|#+\s|(?<=\n)\*\*[^\n]+\*\*(?=\n))')
+SENTENCE_END_PATTERN = re.compile(r'(?<=[.?!])\s+')
+LINE_ENDS_WITH_LETTER = re.compile(r'[a-zA-Z]$')
+LINE_STARTS_LOWERCASE = re.compile(r'^[a-z]')
+
+
 def clean_text(md_text):
-    lines = md_text.splitlines()
+    lines = [line.strip() for line in md_text.splitlines()]
     fixed_lines = []
     i = 0
 
     while i < len(lines):
-        current = lines[i].strip()
+        current = lines[i]
 
         # Look for break between blocks
         if current == "" and i > 0 and i < len(lines) - 1:
-            prev = lines[i - 1].strip()
-            next_ = lines[i + 1].strip()
+            prev = lines[i - 1]
+            next_ = lines[i + 1]
 
             # Look for mid-sentence break
-            if re.search(r'[a-zA-Z]$', prev) and re.match(r'^[a-z]', next_):
+            if LINE_ENDS_WITH_LETTER.search(prev) and LINE_STARTS_LOWERCASE.match(next_):
                 # Merge prev + next
                 combined = prev + " " + next_
                 fixed_lines[-1] = combined
@@ -47,68 +62,143 @@ def clean_text(md_text):
     return "\n".join(fixed_lines)
 
 
-def chunk_text(text, min_length=300, max_length=1000):
+def split_text(text):
+    """Yield the pieces of text between delimiters, each piece starting with the delimiter before it."""
+    start = 0
+    for match in DELIMITER_PATTERN.finditer(text):
+        yield text[start:match.start()]
+        start = match.start()
+    yield text[start:]
 
-    delimiter_pattern = r'(?:\n{2,}|#+\s|(?<=\n)\*\*[^\n]+\*\*(?=\n))'
-    raw_chunks = re.split(delimiter_pattern, text)
-
-    matches = list(re.finditer(delimiter_pattern, text))
-    for i in range(len(matches)):
-        delimiter = text[matches[i].start():matches[i].end()]
-        raw_chunks[i+1] = delimiter + raw_chunks[i+1] if i+1 < len(raw_chunks) else raw_chunks[i+1]
-
-    final_chunks = []
-    buffer = ""
-
-    def split_long_chunk(chunk):
-        # Try to split by sentence ends if possible
-        sentences = re.split(r'(?<=[.?!])\s+', chunk)
-        chunks = []
-        temp = ""
-        for sentence in sentences:
-            if len(temp) + len(sentence) < max_length:
-                temp += sentence + " "
-            else:
-                if temp.strip():
-                    chunks.append(temp.strip())
-                temp = sentence + " "
-        if temp.strip():
-            chunks.append(temp.strip())
-        return chunks
-
-    for part in raw_chunks:
+
+def split_long_chunk(chunk, max_length=1000):
+    """Yield pieces of chunk shorter than max_length, split at sentence ends where possible."""
+    temp = []
+    temp_length = 0
+    for sentence in SENTENCE_END_PATTERN.split(chunk):
+        if temp_length + len(sentence) < max_length:
+            temp.append(sentence)
+            temp_length += len(sentence) + 1
+        else:
+            piece = " ".join(temp).strip()
+            if piece:
+                yield piece
+            temp = [sentence]
+            temp_length = len(sentence) + 1
+    piece = " ".join(temp).strip()
+    if piece:
+        yield piece
+
+
+def iter_chunks(text, min_length=300, max_length=1000):
+    """
+    Yield chunks of text in a single pass over its delimiters.
+    Pieces shorter than min_length are merged with the following ones and chunks
+    longer than max_length are split at sentence ends.
+    """
+    buffer = []
+    buffer_length = 0
+
+    def flush():
+        chunk = "".join(buffer).strip()
+        if len(chunk) > max_length:
+            yield from split_long_chunk(chunk, max_length)
+        elif chunk:
+            yield chunk
+
+    for part in split_text(text):
         part = part.strip()
         if not part:
             continue
-        if len(buffer) + len(part) < min_length:
-            buffer += " " + part
+        if buffer_length + len(part) < min_length:
+            buffer.append(" ")
+            buffer.append(part)
+            buffer_length += len(part) + 1
         else:
-            if buffer:
-                chunk = buffer.strip()
-                if len(chunk) > max_length:
-                    final_chunks.extend(split_long_chunk(chunk))
-                else:
-                    final_chunks.append(chunk)
-                buffer = ""
+            if buffer_length:
+                yield from flush()
+                buffer = []
+                buffer_length = 0
             if len(part) > max_length:
-                final_chunks.extend(split_long_chunk(part))
+                yield from split_long_chunk(part, max_length)
             else:
-                buffer = part
+                buffer = [part]
+                buffer_length = len(part)
 
-    if buffer.strip():
-        chunk = buffer.strip()
-        final_chunks.extend(split_long_chunk(chunk) if len(chunk) > max_length else [chunk])
+    yield from flush()
 
-    return final_chunks
 
+def chunk_text(text, min_length=300, max_length=1000):
+    return list(iter_chunks(text, min_length, max_length))
+
+
+def alias_entry(doc, file_path: str) -> dict:
+    """Record kept for a post that was folded into a near-duplicate instead of being stored."""
+    return {"title": doc.meta['title'], "file_path": f"KnowledgeBase/{file_path}", "metadata": doc.meta}
+
+
+def group_duplicates(docs, chunk_store: ChunkStore) -> List[Tuple[int, List[int], Optional[str]]]:
+    """
+    Cluster near-identical posts within docs and against posts already in the collection.
 
-def store_documents(file_path: str, collection_name: str = "ece20875") -> tuple[bool, str]:
+    Returns:
+        List of (canonical index, alias indices, existing document id). The canonical post of a
+        cluster is its longest one. existing document id is set when the cluster duplicates a
+        post that is already stored.
+    """
+    signatures = [minhash(doc.content) for doc in docs]
+    numbers = [numbers_key(doc.content) for doc in docs]
+
+    clusters = []
+    for members in cluster(signatures, numbers):
+        canonical = max(members, key=lambda i: len(docs[i].content))
+        clusters.append((canonical, [i for i in members if i != canonical], band_keys(signatures[canonical], numbers[canonical])))
+
+    # One query for the stored posts sharing an LSH band with any new cluster
+    all_keys = list({key for _, _, keys in clusters for key in keys})
+    stored_by_key = {}
+    for existing in chunk_store.lsh_candidates(all_keys):
+        for key in existing["lsh_bands"]:
+            stored_by_key.setdefault(key, []).append(existing)
+
+    groups = []
+    for canonical, aliases, keys in clusters:
+        existing_id = None
+        for existing in (existing for key in keys for existing in stored_by_key.get(key, [])):
+            if similarity(signatures[canonical], existing["minhash"]) >= SIMILARITY_THRESHOLD:
+                existing_id = existing["_id"]
+                break
+
+        groups.append((canonical, aliases, existing_id))
+
+    return groups
+
+
+def store_documents(
+    file_path: str,
+    collection_name: str = "ece20875",
+    folders: Optional[List[str]] = None,
+    progress: Optional[Callable[[str, int, int], None]] = None,
+    dedup: bool = True,
+    answer_cache_url: Optional[str] = None,
+    device: str = "cuda:0"
+) -> tuple[bool, str]:
     """
-    Store documents from a file into MongoDB.
+    Store documents from a file into the chunk store (MongoDB, or the local store if RAG_STORE_BACKEND=local).
 
     Args:
-        file_path (str): Path to the file to store (must be in KnowledgeBase directory)
-        collection_name (str): Name of the MongoDB collection to store in (default: "ece20875")
+        file_path (str): Path to the file to store (must be in KnowledgeBase directory). Either a
+            Python module with a 'docs' list, a .jsonl/.parquet knowledge base, or a PDF
+        collection_name (str): Name of the collection to store in (default: "ece20875")
+        folders (List[str], optional): Folders to file PDF pages under
+        progress (Callable[[str, int, int], None], optional): Called with (stage, done, total)
+            as the file is embedded and stored
+        dedup (bool): Store one embedding per cluster of near-identical posts, within the file
+            and against posts already in the collection, and link the others as aliases (default: True)
+        answer_cache_url (str, optional): Valkey URL of the answer cache, whose answers for the
+            collection are invalidated once documents may have been stored (default: REDIS_URL, none if unset)
+        device (str): Device of the embedding model, loaded in 4-bit on CUDA devices (default: "cuda:0",
+            the search model's, so that both share one copy when run in the same process)
 
     Returns:
         tuple[bool, str]: (success status, message)
@@ -124,26 +214,20 @@ def store_documents(file_path: str, collection_name: str = "ece20875") -> tuple[
     )
     logger = logging.getLogger(__name__)
 
+    def report(stage: str, done: int, total: int) -> None:
+        if progress is not None:
+            progress(stage, done, total)
+
     try:
         load_dotenv()
 
-        # Connect to MongoDB
-        # username = quote_plus("voquangtri2021")
-        # password = quote_plus("Voquangtri123@")
-        mongo = MongoClient(
-            os.environ["MONGO_URL"],
-            tls=True,
-            tlsCAFile=certifi.where(),
-            serverSelectionTimeoutMS=5000
-        )
-        # Test the connection
-        mongo.admin.command('ping')
-        db = mongo["rag_database"]
+        # MongoDB Atlas, or the local store if RAG_STORE_BACKEND=local
+        chunk_store = open_chunk_store(collection_name)
+        chunk_store.ensure_indexes()
+        logger.info(f"Opened chunk store for collection '{collection_name}'")
 
-        collection = db[collection_name]
-        logger.info("Successfully connected to MongoDB Atlas")
-
-        colpali = ColPali(device="cuda:0", quantized=True)
+        # Shared with search.py when both run in the same process on its device
+        colpali = get_colpali(device=device, quantized=device.startswith("cuda"))
 
         # Process file
         file = file_path.split(".")
@@ -153,104 +237,165 @@ def store_documents(file_path: str, collection_name: str = "ece20875") -> tuple[
         module_name = file[0]
         ext = file[-1]
 
-        if ext == 'py':
-            # Import the module
-            try:
-                # Add retrieval directory to path if needed
-                retrieval_path = Path(__file__).parent
-                if str(retrieval_path) not in sys.path:
-                    sys.path.append(str(retrieval_path))
-                module = importlib.import_module(f"KnowledgeBase.{module_name}")
-            except ImportError as e:
-                return False, f"Failed to import module: {str(e)}"
+        if ext in ('py', 'jsonl', 'parquet'):
+            if ext == 'py':
+                # Import the module
+                try:
+                    # Add retrieval directory to path if needed
+                    retrieval_path = Path(__file__).parent
+                    if str(retrieval_path) not in sys.path:
+                        sys.path.append(str(retrieval_path))
+                    module = importlib.import_module(f"KnowledgeBase.{module_name}")
+                except ImportError as e:
+                    return False, f"Failed to import module: {str(e)}"
+
+                if not hasattr(module, 'docs'):
+                    return False, "Module must contain a 'docs' variable with Haystack Documents"
+
+                docs = module.docs
+            else:
+                # Sequential read of a converted knowledge base, see knowledge_base.py
+                docs = list(iter_records(KNOWLEDGE_BASE_DIR / file_path))
 
             logger.info(f"Beginning the storing of {module_name}...")
-
-            if not hasattr(module, 'docs'):
-                return False, "Module must contain a 'docs' variable with Haystack Documents"
-
-            all_texts = [format_meta(doc.content, doc.meta) for doc in module.docs]
-            colpali.pool_factor = 5
-            all_embeddings = colpali.embed_texts(all_texts, batch_size=8)
-
-            for i, doc in enumerate(module.docs):
+            posts = len(docs)
+
+            # Posts whose exact text is already stored (e.g. the same file stored twice) are skipped
+            # before looking for near-duplicates, which would link them to themselves as aliases
+            hashes = [content_hash(format_meta(doc.content, doc.meta)) for doc in docs]
+            stored = chunk_store.stored_hashes(hashes)
+            docs = [doc for doc, digest in zip(docs, hashes) if digest not in stored]
+            already_stored = posts - len(docs)
+            if already_stored:
+                logger.info(f"Skipping {already_stored} post(s) that are already stored")
+
+            groups = group_duplicates(docs, chunk_store) if dedup else [(i, [], None) for i in range(len(docs))]
+
+            # Near-duplicates of posts already in the collection only add aliases to them
+            for canonical, aliases, existing_id in groups:
+                if existing_id is None:
+                    continue
+
+                members = [canonical] + aliases
+                chunk_store.add_aliases(
+                    existing_id,
+                    [alias_entry(docs[i], file_path) for i in members],
+                    merge_folders(docs[i].meta['folders'] for i in members)
+                )
+                logger.info(f"Linked {len(members)} near-duplicate(s) of '{docs[canonical].meta['title']}' to existing document {existing_id}")
+
+            new_groups = [(canonical, aliases) for canonical, aliases, existing_id in groups if existing_id is None]
+            unique = len(new_groups)
+            duplicates = len(docs) - unique
+
+            # Only one embedding per cluster of near-duplicates, none at all if every post is already stored
+            all_texts = [format_meta(docs[canonical].content, docs[canonical].meta) for canonical, _ in new_groups]
+            all_embeddings = colpali.embed_texts(
+                all_texts, batch_size=16, length_bucketing=True, max_batch_tokens=4096, truncate_on_oom=True,
+                pool_factor=5, progress=lambda done, total: report("embedding", done, total)
+            ) if all_texts else []
+
+            for i, (canonical, aliases) in enumerate(new_groups):
+                doc = docs[canonical]
                 logger.info(f"Processing document: {doc.meta['title']}")
-                chunks = [doc.content]  # chunking not necessary for QA posts
-                mongo_chunk_list = []
 
                 mongo_chunk_list = [{
                     "chunk_id": str(uuid.uuid4()),
                     "chunk_text": all_texts[i],
-                    "embedding": all_embeddings[i].tolist(),
+                    "embedding": all_embeddings[i],
                 }]
 
                 mongo_doc = {
                     "_id": str(uuid.uuid4()),
                     "filename": doc.meta['title'],
                     "file_type": "txt",
-                    "file_path": f"KnowledgeBase/{sys.argv[1]}",
-                    "folders": doc.meta['folders'],
-                    "chunks": mongo_chunk_list,
+                    "file_path": f"KnowledgeBase/{file_path}",
+                    "folders": merge_folders(docs[j].meta['folders'] for j in [canonical] + aliases),
                     "created_at": datetime.now(timezone.utc),
-                    "metadata": doc.meta
+                    "metadata": doc.meta,
+                    "aliases": [alias_entry(docs[j], file_path) for j in aliases]
                 }
-                collection.insert_one(mongo_doc)
-                logger.info(f"Storing document with ID: {mongo_doc['_id']} and {len(mongo_chunk_list)} chunk(s) in collection '{collection.name}'")
+                if dedup:
+                    mongo_doc["minhash"] = minhash(doc.content)
+                    mongo_doc["lsh_bands"] = band_keys(mongo_doc["minhash"], numbers_key(doc.content))
+
+                chunk_store.insert_document(mongo_doc, mongo_chunk_list)
+                logger.info(f"Storing document with ID: {mongo_doc['_id']} and {len(mongo_chunk_list)} chunk(s) in collection '{chunk_store.name}'")
+                report("storing", i + 1, len(new_groups))
+
+            if dedup:
+                reduction = (posts - unique) / posts * 100 if posts else 0.0
+                logger.info(f"Deduplication: {posts} posts -> {unique} unique, {duplicates} near-duplicate(s) linked as aliases, {already_stored} already stored ({reduction:.1f}% fewer embeddings)")
+                return True, f"Successfully stored all documents ({unique} unique, {duplicates} near-duplicate(s) linked as aliases, {already_stored} already stored, {reduction:.1f}% reduction)"
 
         elif ext == 'pdf':
-            img_save_dir = Path(f"KnowledgeBase/pdf2img/{module_name}")
-            img_save_dir.mkdir(parents=True, exist_ok=True)
+            image_store = PageImageStore()
 
-            md_pages = pymupdf4llm.to_markdown(f"KnowledgeBase/{module_name}.pdf", page_chunks=True)
-            docs_dir = "./KnowledgeBase"
-            path = Path(docs_dir) / f"{module_name}.pdf"
-            images, embeddings = colpali.embed_pdf(path)
+            path = KNOWLEDGE_BASE_DIR / f"{module_name}.pdf"
+            md_pages = pymupdf4llm.to_markdown(str(path), page_chunks=True)
+            images, embeddings = colpali.embed_pdf(path, progress=lambda done, total: report("embedding pages", done, total))
             infos = [{'text': p1['text'], 'image': p2, 'embed': p3} for p1, p2, p3 in zip(md_pages, images, embeddings)]
 
+            pages = []
             for page_num, info in enumerate(infos, start=1):
 
                 meta = {
                     "title": f"{module_name}_{page_num}",
-                    "folders": ['FOO', 'BAR'],
+                    "folders": folders if folders is not None else ['FOO', 'BAR'],
                     "timestamp": datetime.now(timezone.utc),
                     "tags": ['FOO', 'BAR']
                 }  # TODO: Make user give meta
 
-                image_path = img_save_dir / f"{meta['title']}.png"
-                info['image'].save(image_path)
+                doc = clean_text(info['text'])
+                pages.append((info, meta, chunk_text(doc)))
+
+            # Embed every chunk of the document in one bucketed pass instead of once per chunk.
+            # A scanned PDF without extractable text has none, its page images are still stored
+            all_texts = [format_meta(ch, meta) for _, meta, chunks in pages for ch in chunks]
+            all_embeddings = iter(colpali.embed_texts(
+                all_texts, batch_size=16, length_bucketing=True, max_batch_tokens=4096, truncate_on_oom=True,
+                progress=lambda done, total: report("embedding chunks", done, total)
+            ) if all_texts else [])
+
+            for page_num, (info, meta, chunks) in enumerate(pages, start=1):
+                image_hash = image_store.put(info['image'])
 
                 logger.info(f"Processing document: {meta['title']}")
 
-                doc = clean_text(info['text'])
-                chunks = chunk_text(doc)
+                doc_id = str(uuid.uuid4())
                 mongo_chunk_list = []
 
                 for ch in chunks:
-                    # embedding = embed_text(ch, meta)
-                    embedding = None
-
                     mongo_chunk = {
                         "chunk_id": str(uuid.uuid4()),
                         "chunk_text": ch,
-                        "embedding": embedding,
+                        "embedding": next(all_embeddings),
                     }
                     mongo_chunk_list.append(mongo_chunk)
 
+                # The page image is searchable as a chunk holding the whole page text
+                mongo_chunk_list.append({
+                    "chunk_id": page_chunk_id(doc_id),
+                    "kind": PAGE_CHUNK,
+                    "chunk_text": "\n\n".join(chunks),
+                    "embedding": info['embed'],
+                })
+
                 mongo_doc = {
-                    "_id": str(uuid.uuid4()),
+                    "_id": doc_id,
                     "filename": f"{module_name}",
                     "file_type": "pdf",
                     "file_path": f"KnowledgeBase/{module_name}.pdf",
                     "image_name": meta['title'],
-                    "image_path": str(image_path),
-                    "embedding": info['embed'].tolist(),
+                    "image_path": str(image_store.path(image_hash)),
+                    "image_hash": image_hash,
                     "folders": meta['folders'],
-                    "chunks": mongo_chunk_list,
                     "created_at": datetime.now(timezone.utc),
                     "metadata": meta
                 }
-                collection.insert_one(mongo_doc)
-                logger.info(f"Storing document with ID: {mongo_doc['_id']} and {len(mongo_chunk_list)} chunk(s) in collection '{collection.name}'")
+                chunk_store.insert_document(mongo_doc, mongo_chunk_list)
+                logger.info(f"Storing document with ID: {mongo_doc['_id']} and {len(mongo_chunk_list)} chunk(s) in collection '{chunk_store.name}'")
+                report("storing", page_num, len(pages))
 
         else:
             return False, f"Unsupported file type '.{ext}'"
@@ -262,6 +407,10 @@ def store_documents(file_path: str, collection_name: str = "ece20875") -> tuple[
         error_msg = f"Error during document storage: {str(e)}"
         return False, error_msg
 
+    finally:
+        # Answers cached before may miss what was stored, even if storing failed halfway
+        bump_collection_version(collection_name, answer_cache_url)
+
 
 if __name__ == '__main__':
     if len(sys.argv) != 2:
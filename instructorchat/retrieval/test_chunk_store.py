@@ -0,0 +1,110 @@
+from datetime import datetime, timezone
+
+import torch
+
+from instructorchat.retrieval.chunk_store import (
+    DELETE, RESET, UPSERT, MongoChunkStore, encode_embedding, in_shard
+)
+from instructorchat.retrieval.local_store import LocalChunkStore
+
+
+class FakeChangeStream:
+    """Replays change events shaped as MongoDB sends them through the store's $project stage."""
+
+    def __init__(self, events):
+        self.events = list(events)
+        self.alive = True
+
+    def try_next(self):
+        if not self.events:
+            self.alive = False
+            return None
+        return self.events.pop(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class FakeCursor(list):
+    def batch_size(self, size):
+        return self
+
+
+class FakeCollection:
+    """Answers watch() with the given change events and find() with the given documents, whatever the query."""
+
+    def __init__(self, events=(), documents=()):
+        self.events = events
+        self.documents = documents
+        self.pipeline = None
+        self.query = None
+
+    def watch(self, pipeline, **kwargs):
+        self.pipeline = pipeline
+        return FakeChangeStream(self.events)
+
+    def find(self, query, projection=None):
+        self.query = query
+        return FakeCursor(self.documents)
+
+
+def store_with_chunks(events=(), documents=()):
+    collections = {"ece20875": FakeCollection(), "ece20875_chunks": FakeCollection(events, documents)}
+    return MongoChunkStore(collections, "ece20875")
+
+
+def test_changes_read_chunk_id_from_document_key():
+    embedding = torch.randn(3, 4).to(torch.bfloat16)
+    data, shape = encode_embedding(embedding)
+
+    # fullDocument carries only the projected fields, without its _id
+    events = [
+        {"_id": {"_data": "token-1"}, "operationType": "insert", "documentKey": {"_id": "doc1:0"},
+         "fullDocument": {"folders": ["hw1"], "embedding": data, "embedding_shape": shape}},
+        {"_id": {"_data": "token-2"}, "operationType": "update", "documentKey": {"_id": "doc1:1"},
+         "fullDocument": None},
+        {"_id": {"_data": "token-3"}, "operationType": "delete", "documentKey": {"_id": "doc2:0"}},
+        {"_id": {"_data": "token-4"}, "operationType": "drop"},
+    ]
+    store = store_with_chunks(events)
+
+    changes = [change for change in store.changes() if change is not None]
+
+    assert "fullDocument._id" not in store.chunks.pipeline[0]["$project"]
+    assert [(c.kind, c.chunk_id) for c in changes] == [
+        (UPSERT, "doc1:0"), (DELETE, "doc1:1"), (DELETE, "doc2:0"), (RESET, None)
+    ]
+    assert changes[0].folders == ["hw1"]
+    assert changes[0].token == {"_data": "token-1"}
+    assert torch.equal(changes[0].embedding, embedding)
+
+
+def test_mongo_scan_of_a_shard_asks_the_server_for_its_chunks():
+    data, shape = encode_embedding(torch.randn(2, 4))
+    # Chunks stored without a shard hash are returned to every shard and filtered by the store
+    legacy = [f"doc1:{i}" for i in range(10)]
+    store = store_with_chunks(documents=[
+        {"_id": chunk_id, "embedding": data, "embedding_shape": shape} for chunk_id in legacy
+    ])
+
+    chunk_ids = [chunk_id for chunk_id, _ in store.scan("hw1", (1, 3))]
+
+    assert store.chunks.query["folders"] == "hw1"
+    assert {"shard_hash": {"$mod": [3, 1]}} in store.chunks.query["$or"]
+    assert chunk_ids == [chunk_id for chunk_id in legacy if in_shard(chunk_id, (1, 3))]
+
+
+def test_local_scan_of_a_shard_returns_only_its_chunks(tmp_path):
+    store = LocalChunkStore(tmp_path, "ece20875")
+    document = {"_id": "doc1", "folders": ["hw1"], "file_type": "txt", "created_at": datetime.now(timezone.utc)}
+    chunks = [{"chunk_id": f"doc1:{i}", "chunk_text": f"chunk {i}", "embedding": torch.randn(2, 4)} for i in range(30)]
+    store.insert_document(document, chunks)
+
+    scanned = [[chunk_id for chunk_id, _ in store.scan("hw1", (shard, 3))] for shard in range(3)]
+
+    assert sorted(sum(scanned, [])) == sorted(chunk["chunk_id"] for chunk in chunks)
+    for shard, chunk_ids in enumerate(scanned):
+        assert chunk_ids and all(in_shard(chunk_id, (shard, 3)) for chunk_id in chunk_ids)
@@ -0,0 +1,83 @@
+from datetime import datetime, timezone
+from functools import partial
+
+import torch
+
+from colpali_engine.models import ColQwen2_5_Processor
+
+from instructorchat.retrieval.colpali import ColPali
+from instructorchat.retrieval.index import IndexManager
+from instructorchat.retrieval.local_store import LocalChunkStore
+from instructorchat.retrieval.shards import BY_HASH, ShardedRetriever, maxsim, merge_stats
+
+
+def shard_stats(resident, loads, last_load):
+    return {
+        "budget_bytes": 1024,
+        "resident_bytes": sum(resident.values()),
+        "loads": loads,
+        "hits": 2,
+        "evictions": 0,
+        "load_seconds_total": 0.5 * loads,
+        "load_seconds_last": last_load,
+        "resident": resident,
+    }
+
+
+def test_merge_stats_sums_the_shards():
+    shards = [
+        shard_stats({"ece20875/hw1": 100, "ece20875/hw2": 50}, 2, 0.25),
+        shard_stats({"ece20875/hw1": 120}, 1, 0.75),
+        shard_stats({}, 0, None),
+    ]
+
+    stats = merge_stats(shards)
+
+    assert stats["budget_bytes"] == 3072
+    assert stats["resident_bytes"] == 270
+    assert stats["loads"] == 3
+    assert stats["hits"] == 6
+    assert stats["load_seconds_total"] == 1.5
+    assert stats["load_seconds_last"] == 0.75
+    assert stats["resident"] == {"ece20875/hw1": 220, "ece20875/hw2": 50}
+    assert stats["shards"] == shards
+
+
+def test_maxsim_matches_colpali_scores():
+    torch.manual_seed(0)
+    query = torch.randn(5, 8)
+    embeddings = [torch.randn(n, 8) for n in (3, 7, 1, 12)]
+
+    # Scoring only needs the processor, not the model
+    colpali = ColPali.__new__(ColPali)
+    colpali.processor = ColQwen2_5_Processor
+    colpali.device = torch.device("cpu")
+
+    expected = colpali.score_embedded(query.unsqueeze(0), embeddings)[0]
+
+    assert torch.allclose(maxsim(query, embeddings, batch_size=3), expected, atol=1e-4)
+
+
+def test_hash_shards_return_the_unsharded_top_k(tmp_path):
+    torch.manual_seed(0)
+    store = LocalChunkStore(tmp_path, "ece20875")
+    document = {"_id": "doc1", "folders": ["hw1"], "file_type": "txt", "created_at": datetime.now(timezone.utc)}
+    chunks = [
+        {"chunk_id": f"doc1:{i}", "chunk_text": f"chunk {i}", "embedding": torch.randn(3, 8).to(torch.bfloat16)}
+        for i in range(40)
+    ]
+    store.insert_document(document, chunks)
+    query = torch.randn(4, 8)
+
+    open_store = partial(LocalChunkStore, str(tmp_path))
+    ids, embeddings = IndexManager(budget_bytes=0, open_store=open_store).folder("ece20875", "hw1")
+    top = torch.topk(maxsim(query.to(torch.bfloat16), embeddings), 5)
+    expected = [ids[i] for i in top.indices.tolist()]
+
+    retriever = ShardedRetriever(2, BY_HASH, budget_bytes=0, open_store=open_store)
+    try:
+        hits = retriever.search("ece20875", "hw1", query, top_k=5)
+    finally:
+        retriever.close()
+
+    assert [chunk_id for chunk_id, _ in hits] == expected
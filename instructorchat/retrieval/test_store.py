@@ -0,0 +1,48 @@
+import json
+
+import torch
+
+from instructorchat.retrieval import store
+from instructorchat.retrieval.chunk_store import open_chunk_store
+
+
+class FakeColPali:
+    """Embeds each text as a small random tensor and, like the token pooler, fails on an empty list."""
+
+    def __init__(self):
+        self.calls = []
+
+    def embed_texts(self, texts, **kwargs):
+        if not texts:
+            raise ValueError("Nothing to pool")
+        self.calls.append(len(texts))
+        return [torch.randn(2, 4) for _ in texts]
+
+
+POSTS = [
+    {"content": "Question: How do I read a CSV file? Answer: Use pandas.read_csv with the file path.",
+     "meta": {"folders": ["hw1"], "title": "Reading CSV", "tags": ["hw1"], "timestamp": "2025-01-10T10:00:00Z"}},
+    {"content": "Question: What does git rebase do? Answer: It replays your commits on top of another branch.",
+     "meta": {"folders": ["hw2"], "title": "Rebase", "tags": ["hw2"], "timestamp": "2025-02-03T12:00:00Z"}},
+]
+
+
+def test_storing_the_same_file_twice_skips_every_post(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("RAG_STORE_BACKEND", "local")
+    monkeypatch.setenv("RAG_LOCAL_STORE_DIR", str(tmp_path / "store"))
+    monkeypatch.delenv("REDIS_URL", raising=False)
+    monkeypatch.setattr(store, "KNOWLEDGE_BASE_DIR", tmp_path)
+    colpali = FakeColPali()
+    monkeypatch.setattr(store, "get_colpali", lambda **kwargs: colpali)
+
+    with open(tmp_path / "posts.jsonl", "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(post) + "\n" for post in POSTS)
+
+    first = store.store_documents("posts.jsonl", "ece20875")
+    second = store.store_documents("posts.jsonl", "ece20875")
+
+    assert first == (True, "Successfully stored all documents (2 unique, 0 near-duplicate(s) linked as aliases, 0 already stored, 0.0% reduction)")
+    assert second == (True, "Successfully stored all documents (0 unique, 0 near-duplicate(s) linked as aliases, 2 already stored, 100.0% reduction)")
+    assert colpali.calls == [2]
+    assert len(dict(open_chunk_store("ece20875").scan("hw1"))) == 1
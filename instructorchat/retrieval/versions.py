@@ -0,0 +1,34 @@
+"""
+Versions of collections in Valkey, bumped whenever documents are stored into one, so that
+what was derived from a collection earlier (the server's cached answers) can tell it is stale.
+"""
+from typing import Optional
+import logging
+import os
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# Under the answer cache's prefix, its only reader
+VERSION_KEY_PREFIX = "answer_cache:version"
+
+
+def version_key(collection_name: str) -> str:
+    return f"{VERSION_KEY_PREFIX}:{collection_name}"
+
+
+def bump_collection_version(collection_name: str, url: Optional[str] = None) -> None:
+    """
+    Bump the version of the collection in the Valkey at url, or at REDIS_URL if not given.
+    Does nothing when neither is set, and only logs Valkey errors, so that writers never fail on it.
+    """
+    url = url or os.environ.get("REDIS_URL")
+    if not url:
+        return
+
+    try:
+        version = redis.Redis.from_url(url, decode_responses=True).incr(version_key(collection_name))
+        logger.info(f"Collection {collection_name} is now at version {version}")
+    except redis.RedisError as e:
+        logger.warning(f"Version bump of collection {collection_name} failed: {e}")
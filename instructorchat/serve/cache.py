@@ -0,0 +1,113 @@
+"""
+Exact-match cache of generated answers in Valkey, for verbatim repeats of a question.
+
+Usage (drop the cached answers of a collection changed outside the server):
+python3 -m instructorchat.serve.cache invalidate ece20875
+"""
+from functools import partial
+from typing import Dict, List, Optional
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import unicodedata
+
+import redis
+import trio
+
+from instructorchat.retrieval.versions import version_key
+
+logger = logging.getLogger(__name__)
+
+# Defaults of the server's --answer-cache-ttl
+DEFAULT_TTL = 3600
+KEY_PREFIX = "answer_cache"
+
+# Characters of each stream_chunk frame a cached answer is replayed in
+REPLAY_CHUNK_CHARS = 256
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """The question as compared between requests: case, spacing and closing punctuation do not matter."""
+    question = unicodedata.normalize("NFKC", question).casefold()
+    return WHITESPACE_PATTERN.sub(" ", question).strip(" ?!.")
+
+
+def replay_chunks(answer: str, size: int = REPLAY_CHUNK_CHARS) -> List[str]:
+    return [answer[i:i + size] for i in range(0, len(answer), size)] or [""]
+
+
+class AnswerCache:
+    """
+    Answers to questions asked without history, keyed by the normalized question, the folder,
+    the model that answered and the version of the collection. Storing documents into a
+    collection bumps its version, so answers generated before are no longer found and expire
+    after their TTL. Valkey errors are logged and count as misses, so the cache never fails a request.
+
+    Args:
+        url (str): Valkey URL, e.g. redis://localhost:6379 or rediss:// for TLS.
+        ttl (int, optional): Seconds an answer is kept. Defaults to 3600.
+    """
+
+    def __init__(self, url: str, ttl: int = DEFAULT_TTL) -> None:
+        self.db = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+
+    def _version_key(self, collection_name: str) -> str:
+        # Also bumped by store_documents, see retrieval/versions.py
+        return version_key(collection_name)
+
+    def _answer_key(self, collection_name: str, version: str, folder: Optional[str], model: str, question: str) -> str:
+        digest = hashlib.sha256(
+            json.dumps([folder, model, normalize_question(question)]).encode("utf-8")
+        ).hexdigest()
+        return f"{KEY_PREFIX}:{collection_name}:v{version}:{digest}"
+
+    def _get(self, collection_name: str, folder: Optional[str], model: str, question: str) -> Optional[Dict]:
+        version = self.db.get(self._version_key(collection_name)) or "0"
+        entry = self.db.get(self._answer_key(collection_name, version, folder, model, question))
+        return json.loads(entry) if entry is not None else None
+
+    def _put(self, collection_name: str, folder: Optional[str], model: str, question: str, entry: Dict) -> None:
+        version = self.db.get(self._version_key(collection_name)) or "0"
+        self.db.setex(self._answer_key(collection_name, version, folder, model, question), self.ttl, json.dumps(entry))
+
+    def _invalidate(self, collection_name: str) -> int:
+        return self.db.incr(self._version_key(collection_name))
+
+    async def lookup(self, collection_name: str, folder: Optional[str], model: str, question: str) -> Optional[Dict]:
+        """The cached answer, contexts and backend of a question, or None."""
+        try:
+            return await trio.to_thread.run_sync(partial(self._get, collection_name, folder, model, question))
+        except redis.RedisError as e:
+            logger.warning(f"Answer cache lookup failed: {e}")
+            return None
+
+    async def store(self, collection_name: str, folder: Optional[str], model: str, question: str, entry: Dict) -> None:
+        try:
+            await trio.to_thread.run_sync(partial(self._put, collection_name, folder, model, question, entry))
+        except redis.RedisError as e:
+            logger.warning(f"Answer cache store failed: {e}")
+
+    async def invalidate(self, collection_name: str) -> None:
+        """Stop answering from the answers cached for the collection so far."""
+        try:
+            version = await trio.to_thread.run_sync(self._invalidate, collection_name)
+            logger.info(f"Answer cache of {collection_name} is now at version {version}")
+        except redis.RedisError as e:
+            logger.warning(f"Answer cache invalidation of {collection_name} failed: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["invalidate"])
+    parser.add_argument("collection", type=str)
+    parser.add_argument("--url", type=str, default=os.environ.get("REDIS_URL", "redis://localhost:6379"))
+    args = parser.parse_args()
+
+    version = AnswerCache(args.url)._invalidate(args.collection)
+    print(f"Answer cache of {args.collection} is now at version {version}")
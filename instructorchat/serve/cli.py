@@ -12,7 +12,9 @@ from openai.types.chat import ChatCompletionChunk
 from dotenv import load_dotenv
 import trio
 
+from instructorchat.model.clients import close_async_clients
 from instructorchat.serve.inference import ChatIO, chat_loop
+from instructorchat.serve.metrics import record_usage
 
 
 class SimpleChatIO(ChatIO):
@@ -43,6 +45,11 @@ class SimpleChatIO(ChatIO):
     async def stream_output(self, output_stream: AsyncStream[ChatCompletionChunk]) -> str:
         output = ""
         async for chunk in output_stream:
+            # The usage chunk that ends the stream has no choices
+            if not chunk.choices:
+                record_usage(chunk.usage)
+                continue
+
             delta = chunk.choices[0].delta.content
             if delta:
                 output += delta
@@ -60,6 +67,7 @@ async def main():
     parser.add_argument("--folder", type=str, default=None)
     parser.add_argument("--model", type=str, default="gpt-4o-mini")
     parser.add_argument("--base-url", type=str, default=None)
+    parser.add_argument("--backend", type=str, default=None, help="Named model backend, e.g. openai or fake")
     args = parser.parse_args()
 
     # Use API key from environment variable if not provided
@@ -73,6 +81,7 @@ async def main():
         async for _ in chat_loop(
             model_path=args.model,
             base_url=args.base_url,
+            backend=args.backend,
             temperature=args.temperature,
             chatio=chatio,
             api_key=api_key,
@@ -83,6 +92,10 @@ async def main():
         return None
     except KeyboardInterrupt:
         print("exit...")
+    finally:
+        # Shielded so that the connections are closed even when the loop is being cancelled
+        with trio.CancelScope(shield=True):
+            await close_async_clients()
 
 if __name__ == "__main__":
     try:
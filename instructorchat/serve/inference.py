@@ -2,22 +2,77 @@
 from openai import AsyncStream
 from openai.types.chat import ChatCompletionChunk
 from typing import Dict, Optional, List, Any
+from pathlib import Path
 from PIL import Image
 import traceback
+import base64
 import abc
 import openai
 import logging
 import json
-
-from instructorchat.model.model_adapter import load_model, get_model_adapter
-from instructorchat.retrieval.search import retrieve_relevant_context
+import re
+import time
+import trio
+
+from instructorchat.model.model_adapter import OPENAI_BACKEND, load_model, get_model_adapter, open_stream, select_backends
+from instructorchat.retrieval.search import get_shards, indexes, retrieve_relevant_context
+from instructorchat.retrieval.store import KNOWLEDGE_BASE_DIR
+from instructorchat.retrieval.image_store import PageImageStore
 from instructorchat.conversation import Conversation, Message, Role
+from instructorchat.serve.jobs import IngestionJobs, Job, FAILED, FINISHED_STATES
+from instructorchat.serve.cache import AnswerCache, replay_chunks
+from instructorchat.serve.streaming import FLUSH_BYTES, FLUSH_INTERVAL, coalesced
+from instructorchat.serve.packing import CACHE_LAYOUT, PROMPT_TOKEN_BUDGET, format_context, pack_prompt, stable_order
+from instructorchat.metrics import metrics
+from instructorchat.serve.metrics import record_usage
 
 # Global conversation object for action-based dispatch
 global_conv = None
 global_api_key = None
 global_temperature = 0.7
 
+# Tokens of question, history and contexts in a generate_answer prompt
+prompt_token_budget = PROMPT_TOKEN_BUDGET
+# "cache" puts the question after the contexts so that follow-ups share a prompt prefix, "legacy" before them
+prompt_layout = CACHE_LAYOUT
+
+# Seconds given to closing the OpenAI stream of a cancelled answer
+STREAM_CLOSE_TIMEOUT = 2.0
+
+# Backend of requests that do not name one, and the backends tried in turn when it fails
+# or has not started answering after first_token_timeout seconds
+llm_backend = OPENAI_BACKEND
+fallback_backends: List[str] = []
+first_token_timeout = 10.0
+
+# Answer deltas are sent in stream_chunk frames of up to this many bytes, held back at most this long
+stream_flush_bytes = FLUSH_BYTES
+stream_flush_interval = FLUSH_INTERVAL
+
+STORABLE_EXTENSIONS = (".py", ".jsonl", ".parquet", ".pdf")
+
+# Finds the contexts of a question, replaced by an in-memory retriever in offline load tests
+retrieve_contexts = retrieve_relevant_context
+
+# Answers to questions without history, set up by the server when Valkey is configured
+answer_cache: Optional[AnswerCache] = None
+
+
+async def invalidate_cached_answers(job: Job) -> None:
+    """
+    Drop the cached answers of a collection once a job has stored into it, even partially.
+    store_documents invalidates REDIS_URL itself, this also covers --answer-cache-url and a worker that died mid-job.
+    """
+    if answer_cache is not None:
+        await answer_cache.invalidate(job.collection_name)
+
+
+# Store requests are executed by a background worker process
+ingestion_jobs = IngestionJobs(on_finished=invalidate_cached_answers)
+
+# Ready-to-send data URLs of retrieved PDF pages
+image_store = PageImageStore()
+
 
 class ChatIO(abc.ABC):
     @abc.abstractmethod
@@ -44,6 +99,19 @@ async def ping(data = None, websocket = None):
         return {"result": "pong", "status": "success"}
 
 
+async def metrics_action(data = None, websocket = None):
+    """Action: Return request counters, per-stage latency percentiles and resident index statistics."""
+    # With sharded retrieval the resident indices live in the shard processes
+    shards = get_shards()
+    index_stats = await trio.to_thread.run_sync(shards.stats) if shards is not None else indexes.stats()
+
+    result = {**metrics.snapshot(), "index": index_stats, "status": "success"}
+    if websocket:
+        await websocket.send_message(json.dumps(result))
+    else:
+        return result
+
+
 async def initialize_model(model_path: str, api_key: str, temperature: float):
     """Initialize the global model and conversation."""
     global global_conv, global_api_key, global_temperature
@@ -82,7 +150,7 @@ async def return_conversation(data: Dict, websocket = None) -> Dict:
 
 
 async def store_documents_action(data: Dict, websocket = None) -> Dict:
-    """Action: Store documents from file path."""
+    """Action: Queue a file from the KnowledgeBase directory for ingestion."""
     global global_api_key
 
     if global_api_key is None:
@@ -90,45 +158,85 @@ async def store_documents_action(data: Dict, websocket = None) -> Dict:
             await websocket.send_message(json.dumps({"error": "Model not initialized", "status": "error"}))
         return {"error": "Model not initialized"}
 
-    try:
-        file_path = data.get("file_path", "")
-        if not file_path.endswith('.py'):
-            if websocket:
-                await websocket.send_message(json.dumps({"error": "Only .py files are supported", "status": "error"}))
-            return {"error": "Only .py files are supported"}
-
-        from instructorchat.retrieval.store import store_documents
+    file_path = data.get("file_path", "")
+    if not file_path.endswith(STORABLE_EXTENSIONS):
+        if websocket:
+            await websocket.send_message(json.dumps({"error": f"Only {', '.join(STORABLE_EXTENSIONS)} files are supported", "status": "error"}))
+        return {"error": f"Only {', '.join(STORABLE_EXTENSIONS)} files are supported"}
 
-        success, message = store_documents(file_path)
+    try:
+        job = ingestion_jobs.submit(file_path, data.get("collection", "ece20875"), folders=data.get("folders"))
 
         if websocket:
-            if success:
-                await websocket.send_message(json.dumps({"message": message, "status": "success"}))
-            else:
-                await websocket.send_message(json.dumps({"error": message, "status": "error"}))
+            await websocket.send_message(json.dumps({"job_id": job.job_id, "message": "Job queued", "status": "success"}))
             return None  # Don't send twice
 
-        if success:
-            return {"message": message, "status": "success"}
-        else:
-            return {"error": message, "status": "error"}
+        return {"job_id": job.job_id, "message": "Job queued", "status": "success"}
 
-    except ImportError as e:
-        error_msg = f"Error importing store module: {str(e)}"
+    except Exception as e:
+        error_msg = f"Error queueing file: {str(e)}"
         if websocket:
             await websocket.send_message(json.dumps({"error": error_msg, "status": "error"}))
         return {"error": error_msg, "status": "error"}
+
+
+async def upload_context_action(data: Dict, websocket = None) -> Dict:
+    """Action: Save an uploaded PDF into the KnowledgeBase directory and queue it for ingestion."""
+    try:
+        file_name = data.get("file_name", "")
+        pdf_text = data.get("text", "")
+        if not file_name or not pdf_text:
+            if websocket:
+                await websocket.send_message(json.dumps({"error": "file_name and text are required", "status": "error"}))
+            return {"error": "file_name and text are required", "status": "error"}
+
+        # store_documents expects a single '.' in the file name
+        stem = re.sub(r"[^A-Za-z0-9_-]", "_", Path(file_name).stem)
+        KNOWLEDGE_BASE_DIR.mkdir(parents=True, exist_ok=True)
+        (KNOWLEDGE_BASE_DIR / f"{stem}.pdf").write_bytes(base64.b64decode(pdf_text))
+
+        folder = data.get("folder")
+        job = ingestion_jobs.submit(f"{stem}.pdf", data.get("collection", "ece20875"), folders=[folder] if folder else None)
+
+        if websocket:
+            await websocket.send_message(json.dumps({"job_id": job.job_id, "message": "Job queued", "status": "success"}))
+            return None  # Don't send twice
+
+        return {"job_id": job.job_id, "message": "Job queued", "status": "success"}
+
     except Exception as e:
-        error_msg = f"Error storing file: {str(e)}"
+        error_msg = f"Error uploading file: {str(e)}"
         if websocket:
             await websocket.send_message(json.dumps({"error": error_msg, "status": "error"}))
         return {"error": error_msg, "status": "error"}
 
 
+async def job_status_action(data: Dict, websocket = None):
+    """Action: Stream the progress of an ingestion job until it finishes."""
+    job = ingestion_jobs.get(data.get("job_id", ""))
+    if job is None:
+        if websocket:
+            await websocket.send_message(json.dumps({"error": "Unknown job id", "status": "error"}))
+        return {"error": "Unknown job id", "status": "error"}
+
+    if not websocket:
+        return {**job.to_dict(), "status": "success"}
+
+    async for job in ingestion_jobs.watch(job.job_id):
+        if job.state == FAILED:
+            await websocket.send_message(json.dumps({"type": "job_complete", **job.to_dict(), "error": job.message, "status": "error"}))
+        elif job.state in FINISHED_STATES:
+            await websocket.send_message(json.dumps({"type": "job_complete", **job.to_dict(), "status": "success"}))
+        else:
+            await websocket.send_message(json.dumps({"type": "job_progress", **job.to_dict(), "status": "streaming"}))
+
+
 async def generate_answer_action(data: Dict, websocket=None):
     """Action: Generate answer for a question with streaming output."""
     global global_api_key, global_temperature
     conv = Conversation()
+    started = time.perf_counter()
+    metrics.incr("generate_answer.requests")
 
     if global_api_key is None:
         if websocket:
@@ -143,17 +251,48 @@ async def generate_answer_action(data: Dict, websocket=None):
                 await websocket.send_message(json.dumps({"error": "Question is required", "status": "error"}))
             return {"error": "Question is required", "status": "error"}
 
+        # Verbatim repeats of a question asked without history are answered from the cache
+        collection_name = data.get("collection", "ece20875")
+        cache_args = (
+            collection_name,
+            data.get("folder"),
+            f"{data.get('base_url') or data.get('backend') or llm_backend}/{data.get('model', 'gpt-4o-mini')}",
+            question
+        )
+        use_cache = answer_cache is not None and not history
+        if use_cache:
+            with metrics.span("answer_cache.lookup"):
+                cached = await answer_cache.lookup(*cache_args)
+
+            if cached is not None:
+                metrics.incr("answer_cache.hits")
+                return await replay_cached_answer(cached, websocket, started)
+            metrics.incr("answer_cache.misses")
+
         # Get relevant context for the query
-        contexts = await retrieve_relevant_context(question, global_api_key, folder=data.get("folder", None))
+        contexts = await retrieve_contexts(
+            question, global_api_key, folder=data.get("folder", None), collection_name=collection_name
+        )
+
+        # Keep the best contexts and the most recent history within the token budget
+        with metrics.span("generate.pack_prompt"):
+            history, contexts = pack_prompt(question, history or [], contexts, prompt_token_budget)
+
+        if prompt_layout == CACHE_LAYOUT:
+            contexts = stable_order(contexts)
 
         # Prepare the prompt with context
-        context_text = "\n\n".join([
-            f"Title: {ctx['title']}\n{ctx['text']}"
-            for ctx in contexts
-        ])
+        context_text = "\n\n".join([format_context(ctx) for ctx in contexts])
 
         # Format the message with context and question
-        formatted_message = f"""
+        if prompt_layout == CACHE_LAYOUT:
+            # The question varies the most, so it goes last
+            formatted_message = (
+                f"The following are the contexts:\n<CONTEXT>\n{context_text}\n</CONTEXT>\n\n"
+                f"Here is the question: <QUESTION> {question} </QUESTION>"
+            )
+        else:
+            formatted_message = f"""
             Here is the question: <QUESTION> {question} </QUESTION>
 
             The following are the contexts:
@@ -176,39 +315,74 @@ async def generate_answer_action(data: Dict, websocket=None):
         }
 
         # Generate streaming response
-        stream = await LLM_generate_stream(gen_params, model=data.get("model", "gpt-4o-mini"), base_url=data.get("base_url"))
+        llm_started = time.perf_counter()
+        with metrics.span("llm.open_stream"):
+            stream = await LLM_generate_stream(
+                gen_params, model=data.get("model", "gpt-4o-mini"), base_url=data.get("base_url"), backend=data.get("backend")
+            )
 
         if stream is None:
             if websocket:
                 await websocket.send_message(json.dumps({"error": "Failed to generate stream", "status": "error"}))
             return {"error": "Failed to generate stream", "status": "error"}
 
-        # Stream the response
-        full_response = ""
-        async for chunk in stream:
-            delta = chunk.choices[0].delta.content
-            if delta:
-                full_response += delta
-                if websocket:
-                    # Send streaming chunk
-                    await websocket.send_message(json.dumps({
-                        "type": "stream_chunk",
-                        "content": delta,
-                        "status": "streaming"
-                    }))
+        async def send_chunk(content: str) -> None:
+            if websocket:
+                await websocket.send_message(json.dumps({
+                    "type": "stream_chunk",
+                    "content": content,
+                    "status": "streaming"
+                }))
+
+        # Stream the response, coalescing deltas into fewer frames
+        parts = []
+        try:
+            async with coalesced(send_chunk, stream_flush_interval, stream_flush_bytes) as chunks:
+                async for chunk in stream:
+                    # The usage chunk that ends the stream has no choices
+                    if not chunk.choices:
+                        record_usage(chunk.usage)
+                        continue
+
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not parts:
+                            # Time to first token of the model alone, and as seen by the client
+                            now = time.perf_counter()
+                            metrics.observe("llm.ttft", now - llm_started)
+                            metrics.observe("generate.first_token", now - started)
+                        parts.append(delta)
+                        await chunks.add(delta)
+            metrics.observe("llm.stream", time.perf_counter() - llm_started)
+        finally:
+            # If the request was cancelled, closing the response stops the generation upstream
+            with trio.move_on_after(STREAM_CLOSE_TIMEOUT) as close_scope:
+                close_scope.shield = True
+                await stream.close()
+        full_response = "".join(parts)
+        metrics.observe("generate.total", time.perf_counter() - started)
+
+        if use_cache:
+            await answer_cache.store(*cache_args, {
+                "answer": full_response,
+                "contexts": [format_context(ctx) for ctx in contexts],
+                "backend": stream.backend.name
+            })
 
         # Send completion signal
         if websocket:
             await websocket.send_message(json.dumps({
                 "type": "stream_complete",
                 "answer": full_response,
-                "contexts": [f"Title: {ctx['title']}\n{ctx['text']}" for ctx in contexts],
+                "contexts": [format_context(ctx) for ctx in contexts],
+                "backend": stream.backend.name,
                 "status": "success"
             }))
 
         return {
             "answer": full_response,
-            "contexts": [f"Title: {ctx['title']}\n{ctx['text']}" for ctx in contexts],
+            "contexts": [format_context(ctx) for ctx in contexts],
+            "backend": stream.backend.name,
             "status": "success"
         }
 
@@ -219,16 +393,46 @@ async def generate_answer_action(data: Dict, websocket=None):
         return {"error": error_msg, "status": "error"}
 
 
-async def LLM_generate_stream(params: Dict, base_url: Optional[str] = None, model: str = "gpt-4o-mini"):
-    """Stream response using OpenAI API."""
-    try:
-        client = openai.AsyncOpenAI(api_key=global_api_key, base_url=base_url)
+async def replay_cached_answer(cached: Dict, websocket, started: float) -> Dict:
+    """Send a cached answer the way a generated one is sent, in a quick series of stream_chunk frames."""
+    result = {
+        "answer": cached["answer"],
+        "contexts": cached["contexts"],
+        "backend": cached["backend"],
+        "cached": True,
+        "status": "success"
+    }
+
+    if websocket:
+        for content in replay_chunks(cached["answer"], stream_flush_bytes):
+            await websocket.send_message(json.dumps({
+                "type": "stream_chunk",
+                "content": content,
+                "status": "streaming"
+            }))
+        await websocket.send_message(json.dumps({"type": "stream_complete", **result}))
+
+    metrics.observe("generate.cached_total", time.perf_counter() - started)
+    return result
+
 
-        response = await client.chat.completions.create(
+async def LLM_generate_stream(
+    params: Dict,
+    base_url: Optional[str] = None,
+    model: str = "gpt-4o-mini",
+    backend: Optional[str] = None
+):
+    """Stream response from the requested backend, or an ad hoc base_url, failing over to the fallback backends."""
+    try:
+        response = await open_stream(
+            select_backends(backend or llm_backend, base_url, fallback_backends),
+            global_api_key,
+            first_token_timeout,
             model=model,
             messages=params["messages"],
             temperature=params["temperature"],
-            stream=True,
+            # Reports prompt, completion and cached prompt tokens in a final chunk
+            stream_options={"include_usage": True},
         )
 
         if not response:
@@ -249,7 +453,8 @@ async def chat_loop(
     api_key: Optional[str] = None,
     evaluation_test_cases: Optional[List[Dict[str, Any]]] = None,
     folder: Optional[str] = None,
-    base_url: Optional[str] = None
+    base_url: Optional[str] = None,
+    backend: Optional[str] = None
 ):
     """Main chat loop."""
     # Set API key
@@ -287,8 +492,8 @@ async def chat_loop(
         if inp.startswith("store "):
             try:
                 file_path = inp.split("store ")[1].strip()
-                if not file_path.endswith('.py'):
-                    logger.error("Only .py files are supported")
+                if not file_path.endswith(STORABLE_EXTENSIONS):
+                    logger.error(f"Only {', '.join(STORABLE_EXTENSIONS)} files are supported")
                     continue
 
                 logger.info(f"Storing file: {file_path}")
@@ -325,7 +530,11 @@ async def chat_loop(
         #     {context_text}
         #     </CONTEXT>"""
 
-        message = Message("user").add_text(f"Here is the question: <question>{inp}</question>\n\nThe following are contexts:\n")
+        if prompt_layout == CACHE_LAYOUT:
+            contexts = stable_order(contexts)
+            message = Message("user").add_text("The following are contexts:\n")
+        else:
+            message = Message("user").add_text(f"Here is the question: <question>{inp}</question>\n\nThe following are contexts:\n")
         images = dict()
 
         for i, context in enumerate(contexts):
@@ -335,12 +544,20 @@ async def chat_loop(
             if context["image_dir"] is not None and context["image_dir"] not in images:
                 images[context["image_dir"]] = i
 
-                message.add_image(Image.open(context["image_dir"]))
+                with metrics.span("prompt.image_encoding"):
+                    data_url = image_store.data_url(context["image_hash"]) if context.get("image_hash") else None
+                    if data_url is not None:
+                        message.add_image_url(data_url)
+                    else:  # Pages stored before the image store
+                        message.add_image(Image.open(context["image_dir"]))
                 message.add_text("\nText parsed from image:\n")
 
 
             message.add_text(f"{context['text']}\n</context>\n")
 
+        if prompt_layout == CACHE_LAYOUT:
+            message.add_text(f"\nHere is the question: <question>{inp}</question>")
+
         # Add messages to conversation
         conv.append_message(message)
 
@@ -352,7 +569,7 @@ async def chat_loop(
             "temperature": temperature
         }
 
-        stream = await LLM_generate_stream(gen_params, model=model_path, base_url=base_url)
+        stream = await LLM_generate_stream(gen_params, model=model_path, base_url=base_url, backend=backend)
 
         if stream is not None:
             response = await chatio.stream_output(stream)
@@ -0,0 +1,230 @@
+"""Background ingestion jobs for the WebSocket server."""
+from dataclasses import dataclass, field, asdict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+import multiprocessing as mp
+import os
+import queue
+import time
+import uuid
+
+import trio
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+FINISHED_STATES = (SUCCEEDED, FAILED)
+
+
+@dataclass
+class Job:
+    job_id: str
+    file_path: str
+    collection_name: str
+    folders: Optional[List[str]] = None
+    state: str = QUEUED
+    stage: Optional[str] = None
+    done: int = 0
+    total: int = 0
+    message: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    stage_started_at: Optional[float] = None
+
+    def eta_seconds(self) -> Optional[float]:
+        """Estimate the time left in the current stage from its rate so far."""
+        if self.state != RUNNING or not self.done or not self.total or self.stage_started_at is None:
+            return None
+
+        elapsed = time.time() - self.stage_started_at
+        return elapsed / self.done * (self.total - self.done)
+
+    def to_dict(self) -> Dict:
+        job = asdict(self)
+        job.pop("stage_started_at")
+        job["eta_seconds"] = self.eta_seconds()
+        return job
+
+
+def ingest_device() -> str:
+    """
+    Device of the worker's model: RAG_INGEST_DEVICE if set, otherwise the second GPU, or the CPU
+    on a single-GPU machine, so that it never sits next to the server's search model on cuda:0.
+    """
+    import torch
+
+    device = os.environ.get("RAG_INGEST_DEVICE")
+    if device:
+        return device
+    return "cuda:1" if torch.cuda.device_count() > 1 else "cpu"
+
+
+def _worker_main(jobs: mp.Queue, events: mp.Queue) -> None:
+    """Run ingestion jobs one at a time, reporting progress back to the server process."""
+    # Imported here so that the server process never loads the ingestion model
+    from instructorchat.retrieval.store import store_documents
+
+    # Loaded by the first job and kept for the following ones
+    device = ingest_device()
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        job_id = job["job_id"]
+        events.put({"job_id": job_id, "state": RUNNING})
+
+        def progress(stage: str, done: int, total: int) -> None:
+            events.put({"job_id": job_id, "stage": stage, "done": done, "total": total})
+
+        try:
+            success, message = store_documents(
+                job["file_path"], job["collection_name"], folders=job["folders"], progress=progress, device=device
+            )
+        except Exception as e:
+            success, message = False, f"Error during document storage: {str(e)}"
+
+        events.put({"job_id": job_id, "state": SUCCEEDED if success else FAILED, "message": message})
+
+
+class IngestionJobs:
+    """
+    Queue of store_documents jobs executed by a single worker process.
+    The worker is started on the first submitted job and keeps its model loaded between jobs,
+    on the device given by ingest_device() rather than next to the server's search model.
+    run() must be running in the server's nursery for job state to be updated.
+
+    Args:
+        on_finished (Callable[[Job], Awaitable[None]], optional): Awaited by run() once a job has
+            finished, successfully or not, e.g. to drop what depended on the collection it changed.
+    """
+
+    def __init__(self, on_finished: Optional[Callable[[Job], Awaitable[None]]] = None) -> None:
+        self.jobs: Dict[str, Job] = {}
+        self.on_finished = on_finished
+
+        self._ctx = mp.get_context("spawn")
+        self._jobs: Optional[mp.Queue] = None
+        self._events: Optional[mp.Queue] = None
+        self._worker = None
+        self._changed = trio.Event()
+        # Jobs failed outside run(), whose on_finished is still to be awaited
+        self._failed: List[Job] = []
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+
+        if self._worker is not None:
+            # Exited before run() noticed
+            self._worker_exited()
+
+        if self._jobs is None:
+            self._jobs = self._ctx.Queue()
+            self._events = self._ctx.Queue()
+
+        self._worker = self._ctx.Process(target=_worker_main, args=(self._jobs, self._events), daemon=True)
+        self._worker.start()
+
+    def submit(self, file_path: str, collection_name: str = "ece20875", folders: Optional[List[str]] = None) -> Job:
+        """Queue a file for ingestion and return its job immediately."""
+        # Before the job is added, so that the jobs of a dead worker can be failed without it
+        self._ensure_worker()
+
+        job = Job(job_id=str(uuid.uuid4()), file_path=file_path, collection_name=collection_name, folders=folders)
+        self.jobs[job.job_id] = job
+        self._jobs.put({
+            "job_id": job.job_id,
+            "file_path": file_path,
+            "collection_name": collection_name,
+            "folders": folders
+        })
+
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def _apply(self, event: Dict) -> bool:
+        """Update the job of a worker event, unless it has already finished. Returns whether it was updated."""
+        job = self.jobs.get(event["job_id"])
+        # A finished job stays finished, e.g. failed with its worker even if a late event says otherwise
+        if job is None or job.state in FINISHED_STATES:
+            return False
+
+        now = time.time()
+
+        if "state" in event:
+            job.state = event["state"]
+            if job.state == RUNNING:
+                job.started_at = now
+            elif job.state in FINISHED_STATES:
+                job.finished_at = now
+                job.message = event.get("message")
+
+        if "stage" in event:
+            if event["stage"] != job.stage:
+                job.stage = event["stage"]
+                job.stage_started_at = now
+            job.done = event["done"]
+            job.total = event["total"]
+
+        # Wake up every watcher, then arm a new event for the next change
+        self._changed.set()
+        self._changed = trio.Event()
+        return True
+
+    def _next_event(self) -> Optional[Dict]:
+        try:
+            return self._events.get(timeout=0.5)
+        except queue.Empty:
+            return None
+
+    async def run(self) -> None:
+        """Apply progress events from the worker as they arrive."""
+        while True:
+            if self._events is None:
+                await trio.sleep(0.5)
+                continue
+
+            event = await trio.to_thread.run_sync(self._next_event)
+            if event is not None:
+                if self._apply(event) and event.get("state") in FINISHED_STATES:
+                    await self._notify_finished(self.jobs[event["job_id"]])
+            elif self._worker is not None and not self._worker.is_alive():
+                self._worker_exited()
+
+            while self._failed:
+                await self._notify_finished(self._failed.pop(0))
+
+    async def _notify_finished(self, job: Job) -> None:
+        if self.on_finished is not None:
+            await self.on_finished(job)
+
+    def _worker_exited(self) -> None:
+        """Fail the jobs of a dead worker, and drop those it never took so that the next worker does not run them."""
+        self._worker = None
+        self._jobs = self._ctx.Queue()
+        self._failed.extend(self._fail_unfinished("Ingestion worker exited unexpectedly"))
+
+    def _fail_unfinished(self, message: str) -> List[Job]:
+        failed = [job for job in self.jobs.values() if job.state not in FINISHED_STATES]
+        for job in failed:
+            self._apply({"job_id": job.job_id, "state": FAILED, "message": message})
+        return failed
+
+    async def watch(self, job_id: str) -> AsyncIterator[Job]:
+        """Yield the job every time it changes, ending once it has finished."""
+        job = self.jobs[job_id]
+
+        while True:
+            changed = self._changed
+            yield job
+
+            if job.state in FINISHED_STATES:
+                return
+
+            await changed.wait()
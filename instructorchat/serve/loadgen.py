@@ -0,0 +1,437 @@
+"""
+Load test of the WebSocket server. Opens many connections, replays evaluation questions over
+them at a target rate, and reports throughput, time to first token, completion latency,
+errors and stream_chunk frames. Speaks the same protocol as test_client.py.
+
+With --offline the server is started in a child process with the fake LLM backend and an
+in-memory retriever in place of ColPali and the chunk store, so no network access is needed.
+
+Usage:
+python3 -m instructorchat.serve.loadgen --offline --connections 50 --rate 20 --duration 60
+python3 -m instructorchat.serve.loadgen --url ws://localhost:6666 --questions tests.json --rate 5 --requests 200 --folder hw1
+"""
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import argparse
+import collections
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import trio
+from trio_websocket import ConnectionClosed, open_websocket_url
+
+from instructorchat.metrics import PERCENTILES, percentile
+
+# Seconds a request may take before it is counted as timed out
+REQUEST_TIMEOUT = 120.0
+# Seconds the offline server may take to start accepting connections
+SERVER_START_TIMEOUT = 120.0
+
+OFFLINE_API_KEY = "offline"
+CONTEXTS_PER_QUESTION = 5
+
+# Used when no question file is given, and as the offline corpus
+DEFAULT_QUESTIONS = [
+    {"input": "How do I compute the variance of a sample in Python?",
+     "expected_output": "Use numpy.var with ddof=1, or statistics.variance, to compute the sample variance."},
+    {"input": "When is homework 3 due?",
+     "expected_output": "Homework deadlines are listed on the course schedule and Gradescope."},
+    {"input": "What is the difference between a list and a tuple?",
+     "expected_output": "Lists are mutable while tuples are immutable, so tuples can be dictionary keys."},
+    {"input": "How does linear regression choose its coefficients?",
+     "expected_output": "Ordinary least squares picks the coefficients that minimize the sum of squared residuals."},
+    {"input": "What topics are covered on the midterm exam?",
+     "expected_output": "The midterm covers Python basics, probability, distributions and hypothesis testing."},
+    {"input": "How should I plot a histogram of my data?",
+     "expected_output": "Use matplotlib.pyplot.hist with a suitable number of bins."},
+]
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def load_questions(path: Optional[str]) -> List[Dict]:
+    """Test cases of an evaluation file (a JSON array of objects with "input"), or the default ones."""
+    if path is None:
+        return DEFAULT_QUESTIONS
+
+    with open(path, "r") as f:
+        test_cases = json.load(f)
+
+    questions = [case for case in test_cases if case.get("input")]
+    if not questions:
+        raise ValueError(f"{path} has no test cases with an 'input'")
+    return questions
+
+
+class InMemoryRetriever:
+    """
+    Keyword-overlap retrieval over the expected outputs and contexts of the test cases,
+    standing in for retrieve_relevant_context when the server runs offline.
+
+    Args:
+        test_cases (List[Dict]): Test cases whose "expected_output" and "context" are the corpus.
+        latency (float, optional): Seconds each retrieval takes, to mimic a search. Defaults to 0.
+    """
+
+    def __init__(self, test_cases: List[Dict], latency: float = 0.0) -> None:
+        self.latency = latency
+        self.documents = []
+        for i, case in enumerate(test_cases):
+            texts = [case.get("expected_output")] + list(case.get("context") or [])
+            for j, text in enumerate(filter(None, texts)):
+                self.documents.append({"title": f"case_{i}_{j}", "text": text, "words": set(WORD_PATTERN.findall(text.lower()))})
+
+    async def __call__(
+        self,
+        query: str,
+        api_key: Optional[str] = None,
+        folder: Optional[str] = None,
+        collection_name: Optional[str] = None
+    ) -> List[Dict]:
+        if self.latency > 0:
+            await trio.sleep(self.latency)
+
+        words = set(WORD_PATTERN.findall(query.lower()))
+        scored = sorted(
+            ((len(words & document["words"]) / (len(words) or 1), document) for document in self.documents),
+            key=lambda pair: pair[0],
+            reverse=True
+        )
+
+        return [{
+            "title": document["title"],
+            "text": document["text"],
+            "image_dir": None,
+            "image_hash": None,
+            "metadata": {},
+            "score": score
+        } for score, document in scored[:CONTEXTS_PER_QUESTION]]
+
+
+async def serve_offline(host: str, port: int, test_cases: List[Dict], retrieval_latency: float) -> None:
+    """Run the WebSocket server with the fake LLM backend and an in-memory retriever."""
+    from trio_websocket import serve_websocket
+
+    from instructorchat.model.model_adapter import FAKE_BACKEND
+    from instructorchat.serve import inference
+    from instructorchat.serve.server import handle_websocket
+
+    await inference.initialize_model("gpt-4o-mini", OFFLINE_API_KEY, 0.7)
+    inference.llm_backend = FAKE_BACKEND
+    inference.retrieve_contexts = InMemoryRetriever(test_cases, retrieval_latency)
+
+    await serve_websocket(handle_websocket, host, port, ssl_context=None)
+
+
+@dataclass
+class RequestResult:
+    request_id: str
+    action: str
+    sent_at: float
+    first_chunk_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    frames: int = 0
+    answer_bytes: int = 0
+    error: Optional[str] = None
+    backend: Optional[str] = None
+
+    @property
+    def ttft(self) -> Optional[float]:
+        return None if self.first_chunk_at is None else self.first_chunk_at - self.sent_at
+
+    @property
+    def latency(self) -> Optional[float]:
+        return None if self.finished_at is None else self.finished_at - self.sent_at
+
+
+class LoadConnection:
+    """One WebSocket connection carrying overlapping requests, told apart by their request_id."""
+
+    def __init__(self, ws) -> None:
+        self.ws = ws
+        # Result, completion event and final frame of each request still waiting for its answer
+        self._pending: Dict[str, list] = {}
+
+    async def read_frames(self) -> None:
+        try:
+            while True:
+                frame = json.loads(await self.ws.get_message())
+                entry = self._pending.get(frame.get("request_id"))
+                if entry is None:
+                    continue
+
+                result, done, _ = entry
+                if frame.get("type") == "stream_chunk":
+                    result.frames += 1
+                    result.answer_bytes += len(frame.get("content", "").encode("utf-8"))
+                    if result.first_chunk_at is None:
+                        result.first_chunk_at = time.perf_counter()
+                    continue
+
+                result.finished_at = time.perf_counter()
+                if frame.get("status") == "error":
+                    result.error = frame.get("error", "unknown error")
+                elif frame.get("status") == "cancelled":
+                    result.error = "cancelled"
+                result.backend = frame.get("backend")
+                entry[2] = frame
+                done.set()
+
+        except ConnectionClosed:
+            for result, done, _ in self._pending.values():
+                result.error = result.error or "connection closed"
+                done.set()
+
+    async def request(self, action: str, data: Dict, timeout: float = REQUEST_TIMEOUT) -> RequestResult:
+        """Send a request and wait for its final frame."""
+        request_id = uuid.uuid4().hex
+        result = RequestResult(request_id, action, time.perf_counter())
+        done = trio.Event()
+        self._pending[request_id] = [result, done, None]
+
+        try:
+            await self.ws.send_message(json.dumps({"action": action, "data": data, "request_id": request_id}))
+            with trio.move_on_after(timeout):
+                await done.wait()
+            if not done.is_set():
+                result.error = "timeout"
+        except ConnectionClosed:
+            result.error = "connection closed"
+        finally:
+            self._pending.pop(request_id, None)
+
+        return result
+
+    async def fetch(self, action: str, data: Optional[Dict] = None) -> Optional[Dict]:
+        """The final frame of a request, e.g. of the metrics action."""
+        request_id = uuid.uuid4().hex
+        entry = [RequestResult(request_id, action, time.perf_counter()), trio.Event(), None]
+        self._pending[request_id] = entry
+
+        try:
+            await self.ws.send_message(json.dumps({"action": action, "data": data or {}, "request_id": request_id}))
+            with trio.move_on_after(REQUEST_TIMEOUT):
+                await entry[1].wait()
+        finally:
+            self._pending.pop(request_id, None)
+
+        return entry[2]
+
+
+async def run_load(
+    url: str,
+    questions: List[Dict],
+    connections: int,
+    rate: float,
+    num_requests: Optional[int],
+    duration: Optional[float],
+    request_data: Dict
+) -> Dict:
+    """
+    Replay the questions over the connections and collect one result per request.
+
+    Args:
+        url (str): WebSocket URL of the server.
+        questions (List[Dict]): Test cases, replayed in order and round robin.
+        connections (int): Connections opened to the server.
+        rate (float): Requests started per second across all connections, at fixed intervals
+            whether or not earlier ones finished. 0 sends each connection's next question when its last one is answered.
+        num_requests (int, optional): Requests to send. Defaults to unlimited within the duration.
+        duration (float, optional): Seconds to keep sending for. Defaults to until num_requests were sent.
+        request_data (Dict): Further fields of every generate_answer request, e.g. folder and backend.
+    """
+    results: List[RequestResult] = []
+    sent = 0
+
+    def next_question() -> Optional[Dict]:
+        nonlocal sent
+        if num_requests is not None and sent >= num_requests:
+            return None
+        if duration is not None and trio.current_time() - start >= duration:
+            return None
+        sent += 1
+        return {**request_data, "question": questions[(sent - 1) % len(questions)]["input"]}
+
+    async def ask(conn: LoadConnection, data: Dict) -> None:
+        results.append(await conn.request("generate_answer", data))
+
+    async def ask_in_turn(conn: LoadConnection) -> None:
+        while (data := next_question()) is not None:
+            await ask(conn, data)
+
+    # Connections are closed before their readers are waited for
+    async with trio.open_nursery() as readers, AsyncExitStack() as stack:
+        conns = []
+        for _ in range(connections):
+            conn = LoadConnection(await stack.enter_async_context(open_websocket_url(url)))
+            readers.start_soon(conn.read_frames)
+            conns.append(conn)
+
+        start = trio.current_time()
+        started = time.perf_counter()
+
+        async with trio.open_nursery() as requests:
+            if rate > 0:
+                i = 0
+                while (data := next_question()) is not None:
+                    requests.start_soon(ask, conns[i % len(conns)], data)
+                    i += 1
+                    await trio.sleep_until(start + i / rate)
+            else:
+                for conn in conns:
+                    requests.start_soon(ask_in_turn, conn)
+
+        elapsed = time.perf_counter() - started
+        server_metrics = await conns[0].fetch("metrics")
+        readers.cancel_scope.cancel()
+
+    return summarize(results, elapsed, server_metrics)
+
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    return {
+        "mean": sum(values) / len(values) if values else None,
+        **{f"p{round(q * 100)}": percentile(values, q) for q in PERCENTILES}
+    }
+
+
+def summarize(results: List[RequestResult], elapsed: float, server_metrics: Optional[Dict] = None) -> Dict:
+    """Throughput, latency percentiles, errors and frame counts of a run."""
+    succeeded = [result for result in results if result.error is None and result.finished_at is not None]
+    frames = [result.frames for result in succeeded]
+
+    return {
+        "requests": len(results),
+        "succeeded": len(succeeded),
+        "errors": len(results) - len(succeeded),
+        "error_rate": (len(results) - len(succeeded)) / len(results) if results else 0.0,
+        "error_kinds": dict(collections.Counter(result.error for result in results if result.error is not None)),
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(succeeded) / elapsed if elapsed > 0 else 0.0,
+        "ttft_seconds": _percentiles([result.ttft for result in succeeded if result.ttft is not None]),
+        "latency_seconds": _percentiles([result.latency for result in succeeded]),
+        "frames_total": sum(frames),
+        "frames_per_answer": sum(frames) / len(frames) if frames else 0.0,
+        "bytes_per_frame": sum(result.answer_bytes for result in succeeded) / sum(frames) if sum(frames) else 0.0,
+        "backends": dict(collections.Counter(result.backend for result in succeeded)),
+        "server": server_metrics,
+    }
+
+
+def print_report(report: Dict) -> None:
+    def ms(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value * 1000:.0f} ms"
+
+    print(f"\nRequests:    {report['requests']} ({report['succeeded']} succeeded, {report['errors']} failed, {report['error_rate']:.1%})")
+    for error, count in report["error_kinds"].items():
+        print(f"  {count} x {error}")
+    print(f"Elapsed:     {report['elapsed_seconds']:.1f} s")
+    print(f"Throughput:  {report['throughput_rps']:.2f} answers/s")
+    for label, key in (("TTFT", "ttft_seconds"), ("Latency", "latency_seconds")):
+        stats = report[key]
+        print(f"{label + ':':<12} mean {ms(stats['mean'])}, " + ", ".join(f"p{round(q * 100)} {ms(stats[f'p{round(q * 100)}'])}" for q in PERCENTILES))
+    print(f"Frames:      {report['frames_total']} ({report['frames_per_answer']:.1f} per answer, {report['bytes_per_frame']:.0f} bytes each)")
+
+    stages = ((report.get("server") or {}).get("stages")) or {}
+    if stages:
+        print("\nServer stages:")
+        for stage, stats in sorted(stages.items()):
+            print(f"  {stage:<24} n={stats['count']:<6} p50 {ms(stats.get('p50'))}, p95 {ms(stats.get('p95'))}, p99 {ms(stats.get('p99'))}")
+
+
+def _free_port(host: str) -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_for_server(process: subprocess.Popen, host: str, port: int) -> None:
+    with trio.fail_after(SERVER_START_TIMEOUT):
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Offline server exited with code {process.returncode}")
+            try:
+                stream = await trio.open_tcp_stream(host, port)
+                await stream.aclose()
+                return
+            except OSError:
+                await trio.sleep(0.2)
+
+
+async def main(args) -> None:
+    questions = load_questions(args.questions)
+    request_data = {key: value for key, value in (
+        ("folder", args.folder), ("collection", args.collection), ("backend", args.backend)
+    ) if value is not None}
+
+    process = None
+    url = args.url
+    if args.offline:
+        host = "127.0.0.1"
+        port = _free_port(host)
+        command = [sys.executable, "-m", "instructorchat.serve.loadgen", "--serve-offline", "--port", str(port),
+                   "--retrieval-ms", str(args.retrieval_ms)]
+        if args.questions:
+            command += ["--questions", args.questions]
+
+        env = {**os.environ, "FAKE_LLM_TOKENS_PER_SECOND": str(args.fake_tokens_per_second), "FAKE_LLM_TTFT_MS": str(args.fake_ttft_ms)}
+        # The server prints every message it receives
+        process = subprocess.Popen(command, env=env, stdout=None if args.verbose else subprocess.DEVNULL)
+        url = f"ws://{host}:{port}"
+        await _wait_for_server(process, host, port)
+
+    try:
+        print(f"Load testing {url}: {args.connections} connections, "
+              f"{f'{args.rate} requests/s' if args.rate > 0 else 'closed loop'}, "
+              f"{args.requests if args.requests is not None else 'unlimited'} requests"
+              f"{f' within {args.duration} s' if args.duration is not None else ''}")
+
+        report = await run_load(url, questions, args.connections, args.rate, args.requests, args.duration, request_data)
+        print_report(report)
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=4)
+            print(f"\nReport written to {args.output}")
+
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="ws://localhost:6666")
+    parser.add_argument("--questions", type=str, default=None, help="Evaluation test file, a JSON array of objects with 'input'")
+    parser.add_argument("--connections", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=5.0, help="Requests per second across all connections (0 for closed loop)")
+    parser.add_argument("--requests", type=int, default=None, help="Requests to send (default: 100 unless --duration is given)")
+    parser.add_argument("--duration", type=float, default=None, help="Seconds to keep sending for")
+    parser.add_argument("--folder", type=str, default=None, help="Folder to search, skipping classification")
+    parser.add_argument("--collection", type=str, default=None)
+    parser.add_argument("--backend", type=str, default=None, help="Model backend of every request")
+    parser.add_argument("--output", type=str, default=None, help="Write the report as JSON to this file")
+    parser.add_argument("--offline", action="store_true", help="Start a server with the fake LLM and an in-memory retriever")
+    parser.add_argument("--fake-tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--fake-ttft-ms", type=float, default=300.0)
+    parser.add_argument("--retrieval-ms", type=float, default=0.0, help="Time each offline retrieval takes")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the offline server")
+    parser.add_argument("--serve-offline", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_offline:
+        trio.run(serve_offline, "127.0.0.1", args.port, load_questions(args.questions), args.retrieval_ms / 1000)
+    else:
+        if args.requests is None and args.duration is None:
+            args.requests = 100
+        trio.run(main, args)
@@ -0,0 +1,68 @@
+"""Token usage accounting and the Prometheus endpoint of the inference server, over the metrics of instructorchat/metrics.py."""
+import logging
+
+import trio
+
+from instructorchat.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Largest request the metrics endpoint reads before answering
+MAX_REQUEST_BYTES = 8192
+
+
+def record_usage(usage) -> None:
+    """
+    Count the tokens of a completion from its usage (the last chunk of a stream
+    requested with include_usage), including prompt tokens served from the provider's prefix cache.
+    """
+    if usage is None:
+        return
+
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+
+    metrics.incr("llm_requests")
+    metrics.incr("llm_prompt_tokens", usage.prompt_tokens)
+    metrics.incr("llm_completion_tokens", usage.completion_tokens)
+    metrics.incr("llm_cached_prompt_tokens", cached_tokens)
+
+    logger.info(f"LLM usage: {usage.prompt_tokens} prompt ({cached_tokens} cached), {usage.completion_tokens} completion tokens")
+
+
+async def _answer_scrape(stream: trio.SocketStream) -> None:
+    try:
+        request = b""
+        while b"\r\n\r\n" not in request and len(request) < MAX_REQUEST_BYTES:
+            data = await stream.receive_some(MAX_REQUEST_BYTES)
+            if not data:
+                return
+            request += data
+
+        body = metrics.prometheus().encode("utf-8")
+        await stream.send_all(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            + f"Content-Length: {len(body)}\r\n".encode("ascii")
+            + b"Connection: close\r\n\r\n"
+            + body
+        )
+    except trio.BrokenResourceError:
+        pass
+    finally:
+        await stream.aclose()
+
+
+async def serve_prometheus(host: str, port: int) -> None:
+    """
+    Answer every HTTP request on host:port with the metrics in the Prometheus text format.
+    If the port cannot be bound the error is logged and the server keeps running without the endpoint.
+    """
+    try:
+        listeners = await trio.open_tcp_listeners(port, host=host)
+    except OSError as e:
+        logger.error(f"Prometheus metrics endpoint not started on {host}:{port}: {e}")
+        return
+
+    logger.info(f"Serving Prometheus metrics on http://{host}:{port}/metrics")
+    await trio.serve_listeners(_answer_scrape, listeners)
@@ -0,0 +1,110 @@
+"""Fitting chat history and retrieved contexts into a token budget for generate_answer."""
+from typing import Dict, List, Tuple
+import re
+
+from instructorchat.conversation import ENCODING_NAME, get_encoding
+
+# Defaults of the server's --prompt-token-budget
+PROMPT_TOKEN_BUDGET = 6000
+# Share of the budget held for recent history before contexts take the rest
+HISTORY_SHARE = 0.3
+# Longest single context, and the shortest tail worth sending of one that does not fit
+MAX_CONTEXT_TOKENS = 1200
+MIN_CONTEXT_TOKENS = 64
+# Role markers and separators around each message, as counted by OpenAI
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SENTENCE_END_PATTERN = re.compile(r"[.!?](?=\s|$)")
+
+# Prompt layouts: the question ahead of the contexts, or everything that repeats between
+# requests (system prompt, history, contexts in a fixed order) ahead of the question so
+# that the provider's prompt prefix cache can be hit
+LEGACY_LAYOUT = "legacy"
+CACHE_LAYOUT = "cache"
+PROMPT_LAYOUTS = (LEGACY_LAYOUT, CACHE_LAYOUT)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding(ENCODING_NAME).encode(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to at most max_tokens, at the last sentence end if that keeps half of it, else at a word."""
+    encoding = get_encoding(ENCODING_NAME)
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+
+    head = encoding.decode(tokens[:max_tokens])
+
+    sentence_ends = [m.end() for m in SENTENCE_END_PATTERN.finditer(head)]
+    if sentence_ends and sentence_ends[-1] >= len(head) // 2:
+        return head[:sentence_ends[-1]]
+
+    space = head.rfind(" ")
+    return (head[:space] if space > 0 else head) + " ..."
+
+
+def format_context(context: Dict) -> str:
+    return f"Title: {context['title']}\n{context['text']}"
+
+
+def stable_order(contexts: List[Dict]) -> List[Dict]:
+    """Contexts in an order that does not depend on their scores, so the same set always reads the same."""
+    return sorted(contexts, key=lambda context: (context["title"], context["text"]))
+
+
+def pack_prompt(
+    question: str,
+    history: List[Dict],
+    contexts: List[Dict],
+    budget: int = PROMPT_TOKEN_BUDGET
+) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Choose the history messages and contexts that fit in the budget together with the question.
+
+    The most recent history gets up to HISTORY_SHARE of the budget. Contexts then fill the
+    rest in order of retrieval score, each cut at a sentence boundary to MAX_CONTEXT_TOKENS
+    or to whatever room is left. Room the contexts leave is given back to older history.
+
+    Args:
+        question (str): The new question, always kept.
+        history (List[Dict]): Earlier messages, oldest first, each with a 'message'.
+        contexts (List[Dict]): Retrieved contexts with 'title', 'text' and 'score'.
+        budget (int, optional): Tokens for question, history and contexts. Defaults to PROMPT_TOKEN_BUDGET.
+
+    Returns:
+        Tuple[List[Dict], List[Dict]]: (history kept, oldest first), (contexts kept, best first).
+    """
+    remaining = budget - count_tokens(question) - MESSAGE_OVERHEAD_TOKENS
+    history_costs = [count_tokens(chat["message"]) + MESSAGE_OVERHEAD_TOKENS for chat in history]
+
+    # Newest history first, within its share
+    kept_from = len(history)
+    history_room = int(remaining * HISTORY_SHARE)
+    while kept_from > 0 and history_costs[kept_from - 1] <= history_room:
+        kept_from -= 1
+        history_room -= history_costs[kept_from]
+        remaining -= history_costs[kept_from]
+
+    packed_contexts = []
+    for context in sorted(contexts, key=lambda context: context.get("score", 0.0), reverse=True):
+        room = min(remaining, MAX_CONTEXT_TOKENS)
+        if room < MIN_CONTEXT_TOKENS:
+            break
+
+        cost = count_tokens(format_context(context))
+        if cost > room:
+            title_cost = count_tokens(f"Title: {context['title']}\n")
+            context = {**context, "text": truncate_to_tokens(context["text"], room - title_cost)}
+            cost = count_tokens(format_context(context))
+
+        packed_contexts.append(context)
+        remaining -= cost
+
+    # Older history goes in whatever the contexts left over
+    while kept_from > 0 and history_costs[kept_from - 1] <= remaining:
+        kept_from -= 1
+        remaining -= history_costs[kept_from]
+
+    return history[kept_from:], packed_contexts
@@ -2,99 +2,248 @@ import os
 import argparse
 import trio
 from trio_websocket import serve_websocket, ConnectionClosed, WebSocketRequest
-from typing import Final
+from typing import Dict, Final
 from dotenv import load_dotenv
 import traceback
 import json
 
+from instructorchat.model.clients import close_async_clients
+from instructorchat.model.model_adapter import register_backends
+from instructorchat.serve import inference
+
 from instructorchat.serve.inference import (
     initialize_model,
     return_conversation,
     store_documents_action,
+    upload_context_action,
+    job_status_action,
     generate_answer_action,
+    metrics_action,
+    ingestion_jobs,
     ping
 )
+from instructorchat.serve.metrics import serve_prometheus
+from instructorchat.serve.cache import AnswerCache
 
 HOST: Final[str] = os.getenv("NEXT_PUBLIC_IP", "localhost")
 PORT: Final[int] = 6666
 
+# Requests of one connection that may run at the same time, further requests wait for a slot
+MAX_CONCURRENT_REQUESTS: Final[int] = int(os.getenv("WS_MAX_CONCURRENT_REQUESTS", "4"))
+
 # Action dispatch dictionary for regular actions
 ACTION_DISPATCH = {
     "return_conversation": return_conversation,
     "store_documents": store_documents_action,
+    "upload_context": upload_context_action,
+    "metrics": metrics_action,
     "ping": ping
 }
 
 # Streaming actions that handle their own messaging
 STREAMING_ACTIONS = {
-    "generate_answer": generate_answer_action
+    "generate_answer": generate_answer_action,
+    "job_status": job_status_action
 }
 
+# Actions answered right away, without taking one of the connection's slots.
+# job_status only waits for its job to change, so it would otherwise hold a slot for the whole ingestion
+UNLIMITED_ACTIONS = {"ping", "metrics", "job_status"}
 
-async def handle_websocket(request: WebSocketRequest):
-    """Handle WebSocket connections with action-based dispatch."""
-    ws = await request.accept()
-    print("New WebSocket connection established")
-    print("================================================")
 
-    try:
-        while True:
-            message = await ws.get_message()
-            print(f"[RECEIVED] {message}")
+class RequestWebSocket:
+    """
+    The connection as seen by one request. Every frame sent through it carries the
+    request_id the client sent with the request, so that the responses to overlapping
+    requests on the same connection can be told apart.
+    """
 
-            try:
-                payload = json.loads(message)
-                action = payload.get("action")
-                data = payload.get("data", {})
+    def __init__(self, ws, request_id=None):
+        self.ws = ws
+        self.request_id = request_id
 
-                # Handle streaming actions 
-                if action in STREAMING_ACTIONS:
-                    await STREAMING_ACTIONS[action](data, websocket=ws)
-                    continue
+    async def send_message(self, message: str) -> None:
+        # Actions send JSON objects, so the id is spliced in instead of decoding and encoding them again
+        if self.request_id is not None and message.startswith("{"):
+            rest = message[1:]
+            separator = "" if rest.lstrip().startswith("}") else ", "
+            message = f'{{"request_id": {json.dumps(self.request_id)}{separator}{rest}'
 
-                # Handle not mentioned actions
-                if action not in ACTION_DISPATCH:
-                    await ws.send_message(json.dumps({
-                        "error": f"Unknown action: {action}",
-                        "status": "error"
-                    }))
-                    continue
+        await self.ws.send_message(message)
 
-                # Call non-streaming actions
-                result = await ACTION_DISPATCH[action](data, websocket=ws)
 
-                # Only send result if the function didn't already send a message
-                if result is not None:
-                    await ws.send_message(json.dumps(result))
+async def run_action(ws: RequestWebSocket, action, data, limiter: trio.CapacityLimiter, running: Dict):
+    """Run one request of a connection to completion, or until it is cancelled."""
+    with trio.CancelScope() as scope:
+        if ws.request_id is not None:
+            running[ws.request_id] = scope
 
-            except json.JSONDecodeError as e:
-                await ws.send_message(json.dumps({
-                    "error": f"Invalid JSON: {str(e)}",
-                    "status": "error"
-                }))
-            except Exception as e:
+        try:
+            if action in UNLIMITED_ACTIONS:
+                await dispatch_action(ws, action, data)
+            else:
+                async with limiter:
+                    await dispatch_action(ws, action, data)
+
+        except ConnectionClosed:
+            pass
+        except Exception as e:
+            try:
                 await ws.send_message(json.dumps({
                     "error": str(e),
                     "status": "error"
                 }))
+            except ConnectionClosed:
+                pass
+        finally:
+            if running.get(ws.request_id) is scope:
+                del running[ws.request_id]
+
+    if scope.cancelled_caught:
+        try:
+            await ws.send_message(json.dumps({"type": "cancelled", "status": "cancelled"}))
+        except ConnectionClosed:
+            pass
+
+
+async def cancel_action(ws: RequestWebSocket, data, running: Dict):
+    """Action: Cancel a running request of this connection by its request id."""
+    scope = running.get(data.get("request_id"))
+    if scope is None:
+        await ws.send_message(json.dumps({"error": "Unknown request id", "status": "error"}))
+        return
+
+    scope.cancel()
+    await ws.send_message(json.dumps({"result": "cancelled", "status": "success"}))
+
+
+async def dispatch_action(ws: RequestWebSocket, action, data):
+    # Handle streaming actions
+    if action in STREAMING_ACTIONS:
+        await STREAMING_ACTIONS[action](data, websocket=ws)
+        return
+
+    # Handle not mentioned actions
+    if action not in ACTION_DISPATCH:
+        await ws.send_message(json.dumps({
+            "error": f"Unknown action: {action}",
+            "status": "error"
+        }))
+        return
 
-    except ConnectionClosed:
-        print("WebSocket connection closed")
+    # Call non-streaming actions
+    result = await ACTION_DISPATCH[action](data, websocket=ws)
+
+    # Only send result if the function didn't already send a message
+    if result is not None:
+        await ws.send_message(json.dumps(result))
+
+
+async def handle_websocket(request: WebSocketRequest):
+    """
+    Handle WebSocket connections with action-based dispatch.
+    Each message is handled in its own task, so a ping or a second question does not wait
+    behind an answer that is still streaming.
+    """
+    ws = await request.accept()
+    print("New WebSocket connection established")
+    print("================================================")
+
+    limiter = trio.CapacityLimiter(MAX_CONCURRENT_REQUESTS)
+    # Cancel scopes of the requests still running, by request id
+    running: Dict = {}
+
+    async with trio.open_nursery() as nursery:
+        try:
+            while True:
+                message = await ws.get_message()
+                print(f"[RECEIVED] {message}")
+
+                try:
+                    payload = json.loads(message)
+                    reply = RequestWebSocket(ws, payload.get("request_id"))
+
+                    # Handled here rather than in a task, as it needs the connection's running requests
+                    if payload.get("action") == "cancel":
+                        await cancel_action(reply, payload.get("data", {}), running)
+                        continue
+
+                    nursery.start_soon(run_action, reply, payload.get("action"), payload.get("data", {}), limiter, running)
+
+                except json.JSONDecodeError as e:
+                    await ws.send_message(json.dumps({
+                        "error": f"Invalid JSON: {str(e)}",
+                        "status": "error"
+                    }))
+                except Exception as e:
+                    await ws.send_message(json.dumps({
+                        "error": str(e),
+                        "status": "error"
+                    }))
+
+        except ConnectionClosed:
+            print("WebSocket connection closed")
+            # Nobody is left to read the answers still being generated
+            nursery.cancel_scope.cancel()
 
 
 async def main() -> None:
     # Initialize the model before starting the server
     await initialize_model("gpt-4o-mini", api_key, args.temperature)
+    inference.stream_flush_interval = args.stream_flush_ms / 1000
+    inference.stream_flush_bytes = args.stream_flush_bytes
+    inference.prompt_token_budget = args.prompt_token_budget
+    inference.prompt_layout = args.prompt_layout
+    register_backends(",".join(args.register_backend))
+    inference.llm_backend = args.backend
+    inference.fallback_backends = [name for name in args.fallback_backends.split(",") if name]
+    inference.first_token_timeout = args.first_token_timeout
+    if args.answer_cache_url:
+        inference.answer_cache = AnswerCache(args.answer_cache_url, args.answer_cache_ttl)
     print("Model initialized successfully")
     print(f"Starting WebSocket server on {HOST}:{PORT}")
 
-    await serve_websocket(handle_websocket, HOST, PORT, ssl_context=None)
+    try:
+        async with trio.open_nursery() as nursery:
+            # Applies progress reported by the ingestion worker process
+            nursery.start_soon(ingestion_jobs.run)
+
+            if args.metrics_port:
+                nursery.start_soon(serve_prometheus, HOST, args.metrics_port)
+
+            await serve_websocket(handle_websocket, HOST, PORT, ssl_context=None)
+    finally:
+        # Shielded so that the connections are closed even when the server is being cancelled
+        with trio.CancelScope(shield=True):
+            await close_async_clients()
 
 if __name__ == "__main__":
     load_dotenv()
     parser = argparse.ArgumentParser()
     parser.add_argument("--api-key", type=str, help="OpenAI API key")
     parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--stream-flush-ms", type=float, default=30,
+                        help="Longest time an answer delta is held back to be sent with the next ones (0 sends every delta)")
+    parser.add_argument("--stream-flush-bytes", type=int, default=512,
+                        help="Buffered answer bytes that are sent right away")
+    parser.add_argument("--prompt-token-budget", type=int, default=6000,
+                        help="Tokens of question, history and retrieved contexts in an answer prompt")
+    parser.add_argument("--prompt-layout", choices=["cache", "legacy"], default="cache",
+                        help="'cache' sends the question after history and contexts so that providers can reuse the cached prompt prefix")
+    parser.add_argument("--register-backend", action="append", default=[], metavar="NAME=BASE_URL[#MODEL]",
+                        help="Add an OpenAI-compatible backend, in addition to those of LLM_BACKENDS")
+    parser.add_argument("--backend", type=str, default="openai",
+                        help="Backend of requests that do not name one: openai, fake or a registered one")
+    parser.add_argument("--fallback-backends", type=str, default="",
+                        help="Comma separated backends to fail over to, in order")
+    parser.add_argument("--first-token-timeout", type=float, default=10.0,
+                        help="Seconds a backend may take to start answering before failing over")
+    parser.add_argument("--answer-cache-url", type=str, default=os.environ.get("REDIS_URL"),
+                        help="Valkey URL of the answer cache (default: REDIS_URL, unset disables the cache)")
+    parser.add_argument("--answer-cache-ttl", type=int, default=3600,
+                        help="Seconds a cached answer is kept")
+    parser.add_argument("--metrics-port", type=int, default=9464,
+                        help="Port of the Prometheus metrics endpoint (0 disables it)")
     args = parser.parse_args()
 
     # Use API key from environment variable if not provided
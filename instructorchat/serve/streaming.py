@@ -0,0 +1,91 @@
+"""Coalescing of streamed answer deltas into fewer stream_chunk frames."""
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, List
+
+import trio
+
+# Defaults of the server's --stream-flush-ms and --stream-flush-bytes
+FLUSH_INTERVAL = 0.03
+FLUSH_BYTES = 512
+
+
+class ChunkCoalescer:
+    """
+    Buffers deltas and sends them joined, once FLUSH_BYTES are buffered or the oldest
+    buffered delta is FLUSH_INTERVAL seconds old. The first delta is sent on its own
+    right away, so that buffering does not delay the first token.
+
+    Args:
+        send (Callable[[str], Awaitable[None]]): Sends one chunk of text.
+        interval (float, optional): Longest time a delta is held back, in seconds. Defaults to 0.03.
+        max_bytes (int, optional): Buffered UTF-8 bytes that trigger a flush. Defaults to 512.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        interval: float = FLUSH_INTERVAL,
+        max_bytes: int = FLUSH_BYTES
+    ) -> None:
+        self.send = send
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.frames = 0
+
+        self._buffer: List[str] = []
+        self._size = 0
+        self._buffered = trio.Event()
+        self._buffered_at = 0.0
+        # Keeps chunks in order when the timer and add() flush at the same time
+        self._send_lock = trio.StrictFIFOLock()
+
+    async def add(self, delta: str) -> None:
+        self._buffer.append(delta)
+        self._size += len(delta.encode("utf-8"))
+
+        if self.frames == 0 or self._size >= self.max_bytes or self.interval <= 0:
+            await self.flush()
+        elif len(self._buffer) == 1:
+            self._buffered_at = trio.current_time()
+            self._buffered.set()
+
+    async def flush(self) -> None:
+        async with self._send_lock:
+            if not self._buffer:
+                return
+
+            text = "".join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            self.frames += 1
+
+            await self.send(text)
+
+    async def _flush_when_due(self) -> None:
+        while True:
+            await self._buffered.wait()
+            # Armed again before sleeping, so that a buffer started meanwhile wakes the next round
+            self._buffered = trio.Event()
+            await trio.sleep_until(self._buffered_at + self.interval)
+
+            # Unless the buffer was flushed for its size in the meantime and a younger one started
+            if self._buffer and trio.current_time() >= self._buffered_at + self.interval:
+                await self.flush()
+
+
+@asynccontextmanager
+async def coalesced(
+    send: Callable[[str], Awaitable[None]],
+    interval: float = FLUSH_INTERVAL,
+    max_bytes: int = FLUSH_BYTES
+) -> AsyncIterator[ChunkCoalescer]:
+    """A ChunkCoalescer with its flush timer running, flushed once the block completes."""
+    coalescer = ChunkCoalescer(send, interval, max_bytes)
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(coalescer._flush_when_due)
+        try:
+            yield coalescer
+            await coalescer.flush()
+        finally:
+            nursery.cancel_scope.cancel()
@@ -0,0 +1,35 @@
+import pytest
+import redis
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from instructorchat.retrieval.versions import bump_collection_version, version_key
+from instructorchat.serve.cache import AnswerCache
+
+URL = "redis://localhost:6379"
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    return server
+
+
+def test_bumped_collection_version_hides_cached_answers(server, monkeypatch):
+    monkeypatch.setenv("REDIS_URL", URL)
+    answers = AnswerCache(URL)
+    answers._put("ece20875", "hw1", "gpt-4o-mini", "What is a list?", {"answer": "A sequence."})
+
+    bump_collection_version("ece20875")
+
+    assert answers._get("ece20875", "hw1", "gpt-4o-mini", "what is a list") is None
+    assert answers.db.get(version_key("ece20875")) == "1"
+
+
+def test_bump_collection_version_without_url_does_nothing(server, monkeypatch):
+    monkeypatch.delenv("REDIS_URL", raising=False)
+
+    bump_collection_version("ece20875")
+
+    assert AnswerCache(URL).db.get(version_key("ece20875")) is None
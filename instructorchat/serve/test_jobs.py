@@ -0,0 +1,82 @@
+import queue
+from types import SimpleNamespace
+
+import trio
+
+from instructorchat.serve.jobs import FAILED, QUEUED, RUNNING, SUCCEEDED, IngestionJobs
+
+
+class FakeProcess:
+    """Stands in for the worker process, alive until exit() is called."""
+
+    def __init__(self, target, args, daemon):
+        self.jobs, self.events = args
+        self.alive = False
+
+    def start(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def exit(self):
+        self.alive = False
+
+
+def fake_jobs(on_finished=None):
+    jobs = IngestionJobs(on_finished)
+    jobs._ctx = SimpleNamespace(Queue=queue.Queue, Process=FakeProcess)
+    return jobs
+
+
+def queued(q):
+    return [q.get_nowait()["job_id"] for _ in range(q.qsize())]
+
+
+def test_jobs_of_a_dead_worker_stay_failed():
+    finished = []
+
+    async def on_finished(job):
+        finished.append(job.job_id)
+
+    jobs = fake_jobs(on_finished)
+    running = jobs.submit("a.jsonl")
+    waiting = jobs.submit("b.jsonl")
+    worker = jobs._worker
+    worker.events.put({"job_id": running.job_id, "state": RUNNING})
+
+    async def main():
+        with trio.move_on_after(5):
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(jobs.run)
+                await trio.sleep(0.1)
+                worker.exit()
+                while len(finished) < 2:
+                    await trio.sleep(0.1)
+                # A late event of the dead worker does not bring the job back
+                worker.events.put({"job_id": running.job_id, "state": SUCCEEDED, "message": "done"})
+                await trio.sleep(1)
+                nursery.cancel_scope.cancel()
+
+    trio.run(main)
+
+    assert (running.state, waiting.state) == (FAILED, FAILED)
+    assert sorted(finished) == sorted([running.job_id, waiting.job_id])
+
+    # The next worker gets a new queue, without the jobs the dead one never took
+    later = jobs.submit("c.jsonl")
+    assert jobs._worker is not worker
+    assert queued(jobs._worker.jobs) == [later.job_id]
+    assert queued(worker.jobs) == [running.job_id, waiting.job_id]
+
+
+def test_submit_after_an_unnoticed_exit_fails_the_old_jobs():
+    jobs = fake_jobs()
+    old = jobs.submit("a.jsonl")
+    jobs._worker.exit()
+
+    new = jobs.submit("b.jsonl")
+
+    assert old.state == FAILED
+    assert new.state == QUEUED
+    assert queued(jobs._worker.jobs) == [new.job_id]
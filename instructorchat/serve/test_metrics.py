@@ -0,0 +1,20 @@
+import socket
+
+import trio
+
+from instructorchat.serve.metrics import serve_prometheus
+
+
+def test_serve_prometheus_returns_when_port_is_taken():
+    taken = socket.socket()
+    taken.bind(("127.0.0.1", 0))
+    taken.listen()
+
+    async def main():
+        with trio.fail_after(5):
+            await serve_prometheus("127.0.0.1", taken.getsockname()[1])
+
+    try:
+        trio.run(main)
+    finally:
+        taken.close()
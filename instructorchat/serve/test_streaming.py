@@ -0,0 +1,50 @@
+import trio
+import trio.testing
+
+from instructorchat.serve.streaming import coalesced
+
+
+def run_stream(deltas, gap, interval=0.03, max_bytes=512):
+    """Feed deltas gap seconds apart through a coalescer, returning (time sent, text) of every frame."""
+    frames = []
+
+    async def main():
+        async def send(text):
+            frames.append((trio.current_time(), text))
+
+        async with coalesced(send, interval, max_bytes) as chunks:
+            # As while waiting for the model's first token, the flush timer is waiting before any delta
+            await trio.testing.wait_all_tasks_blocked()
+            for delta in deltas:
+                await chunks.add(delta)
+                await trio.sleep(gap)
+
+    trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
+    return frames
+
+
+def test_interval_flushes_after_first_token():
+    deltas = [f"tok{i} " for i in range(20)]
+    frames = run_stream(deltas, gap=0.01)
+
+    assert frames[0][1] == "tok0 "
+    assert len(frames) > 2
+    assert "".join(text for _, text in frames) == "".join(deltas)
+
+
+def test_no_delta_waits_longer_than_interval():
+    deltas = [f"tok{i} " for i in range(20)]
+    frames = run_stream(deltas, gap=0.01)
+
+    # Every delta i was added at i * 0.01 and must be sent within the interval of it
+    sent = 0
+    for at, text in frames:
+        for _ in range(text.count("tok")):
+            assert at - sent * 0.01 <= 0.03 + 1e-9
+            sent += 1
+
+
+def test_size_flush():
+    frames = run_stream(["x" * 100] * 10, gap=0.001, interval=10.0, max_bytes=250)
+
+    assert [len(text) for _, text in frames] == [100, 300, 300, 300]